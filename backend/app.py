@@ -4,23 +4,69 @@ import threading
 import re
 import openai
 import PyPDF2
+from PyPDF2.generic import ArrayObject, DecodedStreamObject, DictionaryObject, NameObject
 from fpdf import FPDF
-from datetime import datetime
+from fpdf.fonts import CORE_FONTS_CHARWIDTHS
+from datetime import datetime, timezone
 import copy
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify, send_file, Response, g
 from flask_cors import CORS
 import glob
 import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+import hashlib
+import sqlite3
+import unicodedata
+import math
+import heapq
+import random
+from collections import Counter, OrderedDict
+from array import array
+import sys
+import argparse
+import zlib
+import uuid
+import io
+import atexit
+import multiprocessing
+from contextlib import contextmanager
+from pathlib import Path
+
+# Découpage des PDFs : module séparé, seul importé par les processus de l'analyse
+from pdf_parsing import IncrementalSectionParser, extraire_sections_pdf, hash_fichier
 
 # --- GESTION DES DÉPENDANCES OPTIONNELLES ---
 try:
     from docx import Document
     from docx.shared import Pt, RGBColor
+    from docx.oxml import parse_xml
+    from lxml import etree
     DOCX_AVAILABLE = True
 except ImportError:
     DOCX_AVAILABLE = False
     print("AVERTISSEMENT: python-docx non installé. L'export Word ne sera pas disponible.")
 
+try:
+    # Internes de fpdf2 utilisés pour partager les polices analysées entre documents
+    from fontTools import ttLib
+    from fpdf.fonts import TTFFont, SubsetMap
+    PDF_FONT_CACHE_AVAILABLE = True
+except ImportError:
+    PDF_FONT_CACHE_AVAILABLE = False
+
+try:
+    import tiktoken
+    TIKTOKEN_AVAILABLE = True
+except ImportError:
+    TIKTOKEN_AVAILABLE = False
+    print("AVERTISSEMENT: tiktoken non installé. Le nombre de tokens des prompts sera estimé.")
+
+try:
+    # Verrous entre processus (serveur de production multi-processus, hors Windows)
+    import fcntl
+except ImportError:
+    fcntl = None
+
 # --- CONFIGURATION DE L'API OPENAI ---
 # IMPORTANT: Définissez cette variable d'environnement sur votre serveur !
 # Exemple: export OPENAI_API_KEY='sk-...'
@@ -32,14 +78,50 @@ app = Flask(__name__)
 CORS(app) 
 
 # --- CONSTANTES DE L'APPLICATION (reprises de votre script) ---
-PLACEHOLDER_PATTERN = r'(\[(?:À PRÉCISER|À VALIDER|COMPLÉTER|RÉFÉRENCE À INDIQUER).*?\])'
-REFERENCE_PATTERN = r'(\(voir exemple CCTP .*?(?:\s*->\s*.*?)?\))'
-CROSS_REF_PATTERN = r'(\{\{REF:(.*?)\|(.*?)\}\})'
+PLACEHOLDER_PATTERN = re.compile(r'(\[(?:À PRÉCISER|À VALIDER|COMPLÉTER|RÉFÉRENCE À INDIQUER).*?\])')
+REFERENCE_PATTERN = re.compile(r'(\(voir exemple CCTP .*?(?:\s*->\s*.*?)?\))')
+CROSS_REF_PATTERN = re.compile(r'(\{\{REF:(.*?)\|(.*?)\}\})')
+# Les trois marqueurs en une seule alternative, pour découper le texte en un seul parcours.
+# Pas de groupe autour des alternatives (le moteur garde sa recherche rapide du premier
+# caractère) : le type de marqueur se lit sur son premier caractère, '[', '(' ou '{'.
+EXPORT_TOKEN_PATTERN = re.compile(
+    r'\[(?:À PRÉCISER|À VALIDER|COMPLÉTER|RÉFÉRENCE À INDIQUER).*?\]'
+    r'|\(voir exemple CCTP .*?(?:\s*->\s*.*?)?\)'
+    r'|\{\{REF:(?P<typo>.*?)\|(?P<section>.*?)\}\}'
+)
+# Débuts de marqueurs : s'ils apparaissent dans un autre marqueur ou dans le texte restant,
+# l'ordre d'extraction (placeholders, exemples, puis références) change le résultat
+PLACEHOLDER_START_PATTERN = re.compile(r'\[(?:À PRÉCISER|À VALIDER|COMPLÉTER|RÉFÉRENCE À INDIQUER)')
+REFERENCE_START = "(voir exemple CCTP "
+CROSS_REF_START = "{{REF:"
+HTML_TAG_PATTERN = re.compile(r'<[^>]+>')
 MAX_EXAMPLES_IN_PROMPT = 3
-MAX_TOTAL_EXAMPLE_CHARS = 4000
+# Les exemples sont classés par pertinence (BM25) : un budget plus serré suffit
+MAX_EXAMPLE_TOKENS = int(os.getenv("CCTP_MAX_EXAMPLE_TOKENS", "800"))
+# Modèles utilisés pour rédiger une section et pour retoucher un texte existant
+GENERATION_MODEL = "gpt-4-1106-preview"
+MODIFICATION_MODEL = "gpt-3.5-turbo-0125"
+# Budget (en tokens) du prompt envoyé : CCTP_PROMPT_TOKEN_BUDGET_<MODÈLE> (ex. _GPT_4_1106_PREVIEW),
+# sinon CCTP_PROMPT_TOKEN_BUDGET, sinon la valeur par défaut du modèle
+PROMPT_TOKEN_BUDGET = int(os.getenv("CCTP_PROMPT_TOKEN_BUDGET", "2000"))
+
+def _budget_modele(model, default):
+    variable = "CCTP_PROMPT_TOKEN_BUDGET_" + re.sub(r"[^A-Z0-9]", "_", model.upper())
+    return int(os.getenv(variable) or os.getenv("CCTP_PROMPT_TOKEN_BUDGET") or default)
+
+PROMPT_TOKEN_BUDGETS = {
+    # Contexte de 128k tokens : le budget limite le coût et la part du quota par minute
+    GENERATION_MODEL: _budget_modele(GENERATION_MODEL, 8000),
+    # Contexte de 16k tokens, dont jusqu'à 4k pour la réponse (texte retouché, aussi long que l'original)
+    MODIFICATION_MODEL: _budget_modele(MODIFICATION_MODEL, 4000),
+}
+# Fins de phrase (ou de ligne) où un texte peut être coupé
+SENTENCE_END_PATTERN = re.compile(r'(?<=[.!?])\s+|\n+')
 
 # Variable globale pour le statut de l'analyse
-analysis_status = {"running": False, "progress": 0, "max_files": 0, "current_file": "", "error": None}
+analysis_status = {"running": False, "progress": 0, "max_files": 0, "current_file": "", "error": None, "reused": 0}
+# Une analyse sans nouvelles depuis ce délai (s) est considérée comme interrompue
+ANALYSIS_STALE_SECONDS = 600
 
 # --- CHEMINS VERS LES DOSSIERS DE DONNÉES ---
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -47,13 +129,1142 @@ MODELES_DIR = os.path.join(BASE_DIR, "modeles_cctp")
 PREVIEWS_DIR = os.path.join(BASE_DIR, "previews_cctp")
 KNOWLEDGE_BASE_DIR = os.path.join(BASE_DIR, "knowledge_base")
 KNOWLEDGE_BASE_PATH = os.path.join(KNOWLEDGE_BASE_DIR, "knowledge_base.txt")
+KNOWLEDGE_BASE_JSON_PATH = os.path.join(KNOWLEDGE_BASE_DIR, "knowledge_base.json")
+KNOWLEDGE_BASE_STORE_PATH = os.path.join(KNOWLEDGE_BASE_DIR, "knowledge_base.sqlite3")
+KNOWLEDGE_BASE_MANIFEST_PATH = os.path.join(KNOWLEDGE_BASE_DIR, "knowledge_base_manifest.json")
 BIBLIOTHEQUE_SECTIONS_PATH = os.path.join(BASE_DIR, "bibliotheque_sections.json")
 SYSTEM_PROMPT_PATH = os.path.join(BASE_DIR, "system_prompt.txt")
+PROMPTS_REGISTRY_PATH = os.path.join(BASE_DIR, "prompts_registry.json")
+CACHE_DIR = os.path.join(BASE_DIR, "cache")
+GENERATION_CACHE_PATH = os.path.join(CACHE_DIR, "generation_cache.sqlite3")
+EXPORTS_DIR = os.path.join(CACHE_DIR, "exports")
+ANALYSIS_STATUS_PATH = os.path.join(CACHE_DIR, "analysis_status.json")
+SECTION_LIBRARY_INDEX_PATH = os.path.join(CACHE_DIR, "section_library_index.json")
+METRICS_DIR = os.path.join(CACHE_DIR, "metrics")
 
 # S'assurer que les dossiers de données existent au démarrage
 os.makedirs(MODELES_DIR, exist_ok=True)
 os.makedirs(PREVIEWS_DIR, exist_ok=True)
 os.makedirs(KNOWLEDGE_BASE_DIR, exist_ok=True)
+os.makedirs(CACHE_DIR, exist_ok=True)
+
+# --- MÉTRIQUES (durées par étape, compteurs, format Prometheus) ---
+# Bornes (en secondes) des histogrammes de durées : de la milliseconde aux longues générations
+METRICS_DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+# Intervalle (s) minimal entre deux publications des métriques du processus sur disque
+METRICS_PUBLISH_INTERVAL = float(os.getenv("CCTP_METRICS_PUBLISH_INTERVAL", "5"))
+
+class Metrics:
+    """Compteurs et histogrammes du processus, exposés au format texte de Prometheus.
+
+    Chaque série est identifiée par son nom et ses étiquettes. Avec plusieurs
+    processus (serveur de production), chacun publie ses valeurs dans
+    `directory/<pid>.json` au plus toutes les `publish_interval` secondes ;
+    `render()` additionne celles des processus encore en vie.
+    """
+
+    def __init__(self, directory, publish_interval, buckets=METRICS_DURATION_BUCKETS):
+        self.directory = directory
+        self.publish_interval = publish_interval
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._help = {}
+        self._types = {}
+        self._counters = {}
+        self._histograms = {}
+        self._published_at = 0.0
+        self._publish_lock = threading.Lock()
+
+    def reset_after_fork(self):
+        """Dans un processus fils : ne pas recompter les valeurs du processus parent."""
+        self._lock = threading.Lock()
+        self._publish_lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._published_at = 0.0
+
+    def describe(self, name, kind, help_text):
+        self._types[name] = kind
+        self._help[name] = help_text
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+        self._maybe_publish()
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            series = self._histograms.get(key)
+            if series is None:
+                # Comptes par borne (non cumulés), puis somme et nombre d'observations
+                series = self._histograms[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+        self._maybe_publish()
+
+    @contextmanager
+    def span(self, stage):
+        """Mesure la durée du bloc dans `cctp_stage_duration_seconds{stage=...}`."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe("cctp_stage_duration_seconds", time.perf_counter() - start, stage=stage)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "counters": [[name, list(labels), value] for (name, labels), value in self._counters.items()],
+                "histograms": [[name, list(labels), list(series[0]), series[1], series[2]]
+                               for (name, labels), series in self._histograms.items()],
+            }
+
+    def _path(self, pid):
+        return os.path.join(self.directory, f"{pid}.json")
+
+    def _maybe_publish(self):
+        if self.directory and time.monotonic() - self._published_at >= self.publish_interval:
+            self.publish()
+
+    def publish(self):
+        """Écrit les valeurs du processus pour les autres processus du serveur."""
+        # Une seule écriture à la fois ; les autres threads n'attendent pas
+        if not self._publish_lock.acquire(blocking=False):
+            return
+        try:
+            self._published_at = time.monotonic()
+            os.makedirs(self.directory, exist_ok=True)
+            tmp_path = self._path(os.getpid()) + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self.snapshot(), f)
+            os.replace(tmp_path, self._path(os.getpid()))
+        except OSError as e:
+            print(f"⚠️ Métriques non publiées: {e}")
+        finally:
+            self._publish_lock.release()
+
+    @staticmethod
+    def _alive(pid):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except (PermissionError, OSError):
+            return True
+        return True
+
+    def _snapshots(self):
+        """Valeurs de ce processus (à jour) et des autres processus encore en vie."""
+        snapshots = [self.snapshot()]
+        if not self.directory:
+            return snapshots
+        for path in glob.glob(os.path.join(self.directory, "*.json")):
+            name = os.path.splitext(os.path.basename(path))[0]
+            if not name.isdigit() or int(name) == os.getpid():
+                continue
+            if not self._alive(int(name)):
+                # Processus terminé : ses valeurs ne font plus partie du total
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                continue
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        return snapshots
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        escaped = (str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, v in pairs)
+        return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+    def render(self):
+        """Texte au format d'exposition de Prometheus (version 0.0.4)."""
+        counters = {}
+        histograms = {}
+        for snapshot in self._snapshots():
+            for name, labels, value in snapshot["counters"]:
+                key = (name, tuple(tuple(pair) for pair in labels))
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, counts, total, count in snapshot["histograms"]:
+                key = (name, tuple(tuple(pair) for pair in labels))
+                series = histograms.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+                series[0] = [a + b for a, b in zip(series[0], counts)]
+                series[1] += total
+                series[2] += count
+
+        lines = []
+        names = sorted({name for name, _ in counters} | {name for name, _ in histograms})
+        for name in names:
+            if name in self._help:
+                lines.append(f"# HELP {name} {self._help[name]}")
+            lines.append(f"# TYPE {name} {self._types.get(name, 'untyped')}")
+            for (series_name, labels), value in sorted(counters.items()):
+                if series_name == name:
+                    lines.append(f"{name}{self._labels(labels)} {value:g}")
+            for (series_name, labels), (counts, total, count) in sorted(histograms.items()):
+                if series_name != name:
+                    continue
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    lines.append(f"{name}_bucket{self._labels(labels, [('le', f'{bound:g}')])} {cumulative}")
+                lines.append(f"{name}_bucket{self._labels(labels, [('le', '+Inf')])} {count}")
+                lines.append(f"{name}_sum{self._labels(labels)} {total:.6f}")
+                lines.append(f"{name}_count{self._labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics(METRICS_DIR, METRICS_PUBLISH_INTERVAL)
+metrics.describe("cctp_http_request_duration_seconds", "histogram", "Durée des requêtes HTTP par route, méthode et statut.")
+metrics.describe("cctp_stage_duration_seconds", "histogram", "Durée de chaque étape du traitement (recherche d'exemples, appel OpenAI, mise en page...).")
+metrics.describe("cctp_openai_requests_total", "counter", "Appels OpenAI par modèle et résultat.")
+metrics.describe("cctp_openai_tokens_total", "counter", "Tokens OpenAI consommés par modèle et type (prompt, completion).")
+metrics.describe("cctp_openai_retries_total", "counter", "Nouvelles tentatives d'appels OpenAI par type d'erreur.")
+metrics.describe("cctp_openai_errors_total", "counter", "Appels OpenAI abandonnés par type d'erreur.")
+metrics.describe("cctp_generation_cache_total", "counter", "Consultations du cache des générations (hit, miss).")
+
+# --- INDEX DES TITRES DE SECTIONS DE LA BASE DE CONNAISSANCES ---
+class _FoldTable(dict):
+    """Table de `str.translate` remplie à la demande : caractère -> caractère sans accent."""
+
+    def __missing__(self, code):
+        decomposed = unicodedata.normalize('NFKD', chr(code))
+        folded = ''.join(c for c in decomposed if not unicodedata.combining(c))
+        self[code] = folded
+        return folded
+
+_FOLD_TABLE = _FoldTable()
+
+def _fold_text(text):
+    """Minuscules + suppression des accents, caractère par caractère.
+
+    Le repliage se fait caractère par caractère pour que toute sous-chaîne
+    (en minuscules) reste une sous-chaîne une fois repliée.
+    """
+    return text.lower().translate(_FOLD_TABLE)
+
+class SectionTitleIndex:
+    """Index inversé (titres repliés + trigrammes) des sections de la knowledge base.
+
+    Une section correspond à un titre cible si l'un des deux titres (en
+    minuscules) contient l'autre. L'index fournit des candidats sur les titres
+    repliés, puis chaque candidat est vérifié avec le test d'origine : les
+    résultats sont identiques au parcours complet, dans l'ordre des entrées.
+
+    Les sections ajoutées par une mise à jour incrémentale prennent de
+    nouveaux identifiants en fin d'index ; celles qui sont retirées laissent
+    une entrée vide (None), si bien que les identifiants des autres entrées
+    (et les listes BM25 qui y renvoient) restent valables.
+    """
+
+    VERSION = 3
+    NGRAM = 3
+
+    def __init__(self, entries, titles, ngrams):
+        # entries[i] = [identifiant de section, fichier, titre], None si la section a été retirée
+        self.entries = entries
+        self.titles = titles
+        self.ngrams = ngrams
+        self._ngram_sets = {}
+
+    @classmethod
+    def _ngrams_of(cls, folded):
+        return {folded[i:i + cls.NGRAM] for i in range(len(folded) - cls.NGRAM + 1)}
+
+    @classmethod
+    def build(cls, sections):
+        """Construit l'index à partir de (id, fichier, titre, contenu), dans l'ordre du corpus."""
+        index = cls([], {}, {})
+        index.add(sections)
+        return index
+
+    def add(self, sections):
+        """Ajoute les sections non vides (id, fichier, titre, contenu) ; renvoie [(entrée, titre, contenu)]."""
+        added = []
+        for section_id, filename, titre, contenu in sections:
+            if not contenu.strip():
+                continue
+            titre = titre.strip()
+            entry_id = len(self.entries)
+            self.entries.append([section_id, filename, titre])
+            folded = _fold_text(titre)
+            self.titles.setdefault(folded, []).append(entry_id)
+            for gram in self._ngrams_of(folded):
+                self.ngrams.setdefault(gram, []).append(entry_id)
+            added.append((entry_id, titre, contenu))
+        self._ngram_sets = {}
+        return added
+
+    def remove(self, entry_ids):
+        """Retire des entrées de l'index (leur place reste vide)."""
+        for entry_id in entry_ids:
+            entry = self.entries[entry_id]
+            if entry is None:
+                continue
+            self.entries[entry_id] = None
+            folded = _fold_text(entry[2])
+            for table, keys in ((self.titles, (folded,)), (self.ngrams, self._ngrams_of(folded))):
+                for key in keys:
+                    ids = table[key]
+                    ids.remove(entry_id)
+                    if not ids:
+                        del table[key]
+        self._ngram_sets = {}
+
+    def live_count(self):
+        return sum(1 for entry in self.entries if entry is not None)
+
+    @classmethod
+    def from_json(cls, raw):
+        """Recharge un index sérialisé par `to_json()` (None si la version diffère)."""
+        try:
+            data = json.loads(raw)
+        except (TypeError, ValueError):
+            return None
+        if data.get('version') != cls.VERSION:
+            return None
+        return cls(data['entries'], data['titles'], data['ngrams'])
+
+    def to_json(self):
+        return json.dumps({
+            "version": self.VERSION,
+            "entries": self.entries,
+            "titles": self.titles,
+            "ngrams": self.ngrams,
+        }, ensure_ascii=False, separators=(',', ':'))
+
+    def _postings(self, gram):
+        postings = self._ngram_sets.get(gram)
+        if postings is None:
+            postings = set(self.ngrams.get(gram, ()))
+            self._ngram_sets[gram] = postings
+        return postings
+
+    def lookup(self, titre_section_cible):
+        """Renvoie les entrées dont le titre contient la cible ou y est contenu."""
+        return [self.entries[entry_id] for entry_id in self.lookup_ids(titre_section_cible)]
+
+    def lookup_ids(self, titre_section_cible):
+        """Identifiants (ordre du corpus) des entrées correspondant au titre cible."""
+        cible = titre_section_cible.lower()
+        folded = _fold_text(titre_section_cible)
+        candidates = set()
+
+        # Titre d'origine contenu dans la cible : toutes les sous-chaînes de la cible
+        for start in range(len(folded) + 1):
+            for end in range(start, len(folded) + 1):
+                ids = self.titles.get(folded[start:end])
+                if ids:
+                    candidates.update(ids)
+
+        # Cible contenue dans le titre d'origine : intersection des trigrammes
+        grams = self._ngrams_of(folded)
+        if grams:
+            postings = sorted((self._postings(g) for g in grams), key=len)
+            candidates.update(set.intersection(*postings))
+        else:
+            candidates.update(i for i, entry in enumerate(self.entries) if entry is not None)
+
+        matches = []
+        for entry_id in sorted(candidates):
+            titre = self.entries[entry_id][2].lower()
+            if titre == cible or cible in titre or titre in cible:
+                matches.append(entry_id)
+        return matches
+
+# --- CLASSEMENT DES EXEMPLES (BM25) ---
+RETRIEVAL_STOPWORDS = frozenset(
+    "au aux avec ce ces cette dans de des du elle en est et il ils la le les leur leurs "
+    "ne ni on ou par pas pour qu que qui sa se selon ses son sont sur un une ainsi etc "
+    "tout tous toute toutes doit doivent peut etre".split()
+)
+_RETRIEVAL_TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+def _tokenize_for_retrieval(text):
+    """Découpe un texte en termes repliés (sans accents) pour le classement."""
+    return [
+        token for token in _RETRIEVAL_TOKEN_PATTERN.findall(_fold_text(text or ""))
+        if len(token) > 1 and token not in RETRIEVAL_STOPWORDS
+    ]
+
+class ExampleRanker:
+    """Classement BM25 des sections de la knowledge base sur le titre et le contenu.
+
+    La base stocke par terme les fréquences brutes sous forme de listes
+    creuses (entrées de l'index des titres, occurrences dans le titre,
+    occurrences dans le contenu) et la longueur de chaque entrée ; les poids
+    BM25 (idf, longueur moyenne) sont calculés à la requête. Une requête ne
+    lit que les listes de ses propres termes, et ajouter ou retirer un
+    document ne modifie que les listes des termes qu'il contient.
+    """
+
+    K1 = 1.2
+    B = 0.75
+    TITLE_FIELD_WEIGHT = 2.0
+    # Poids des différentes parties de la requête
+    QUERY_WEIGHTS = (("titre", 1.0), ("notes", 0.5), ("typo", 0.3))
+
+    def __init__(self, title_index, postings_source, lengths):
+        self.title_index = title_index
+        # postings_source(termes) -> {terme: (entrées, occurrences titre, occurrences contenu)}
+        self._fetch_postings = postings_source
+        # lengths[2 * i], lengths[2 * i + 1] : nombre de termes du titre et du contenu de l'entrée i
+        self._lengths = lengths
+        self._size = title_index.live_count()
+        self._avg_lengths = [
+            (sum(lengths[field::2]) / self._size if self._size else 0.0) or 1.0
+            for field in (0, 1)
+        ]
+
+    @staticmethod
+    def entry_terms(titre, contenu):
+        """Fréquences des termes du titre et du contenu d'une entrée."""
+        return Counter(_tokenize_for_retrieval(titre)), Counter(_tokenize_for_retrieval(contenu))
+
+    def _term_weights(self, scores, query_weight, postings):
+        entry_ids, *field_tfs = postings
+        for field, (field_weight, tfs) in enumerate(zip((self.TITLE_FIELD_WEIGHT, 1.0), field_tfs)):
+            doc_freq = len(tfs) - tfs.count(0)
+            if not doc_freq:
+                continue
+            idf = math.log(1 + (self._size - doc_freq + 0.5) / (doc_freq + 0.5))
+            avg_length = self._avg_lengths[field]
+            for doc_id, freq in zip(entry_ids, tfs):
+                if not freq:
+                    continue
+                norm = self.K1 * (1 - self.B + self.B * self._lengths[2 * doc_id + field] / avg_length)
+                weight = field_weight * idf * freq * (self.K1 + 1) / (freq + norm)
+                scores[doc_id] = scores.get(doc_id, 0.0) + query_weight * weight
+
+    def _query_terms(self, titre_section_cible, notes_utilisateur, nom_typo):
+        sources = {"titre": titre_section_cible, "notes": notes_utilisateur, "typo": nom_typo}
+        query = {}
+        for source, weight in self.QUERY_WEIGHTS:
+            for term in set(_tokenize_for_retrieval(sources[source])):
+                query[term] = query.get(term, 0.0) + weight
+        return query
+
+    def rank(self, titre_section_cible, notes_utilisateur="", nom_typo="", limit=MAX_EXAMPLES_IN_PROMPT):
+        """Renvoie les `limit` entrées les plus pertinentes, de la meilleure à la moins bonne.
+
+        Les sections dont le titre correspond (critère historique) passent en
+        premier ; à défaut, on retient les sections qui partagent au moins un
+        terme avec le titre cible.
+        """
+        query = self._query_terms(titre_section_cible, notes_utilisateur, nom_typo)
+        postings = self._fetch_postings(list(query))
+        scores = {}
+        for term, query_weight in query.items():
+            if term in postings:
+                self._term_weights(scores, query_weight, postings[term])
+
+        candidates = self.title_index.lookup_ids(titre_section_cible)
+        if not candidates:
+            title_terms = set(_tokenize_for_retrieval(titre_section_cible))
+            candidates = {
+                doc_id
+                for term in title_terms if term in postings
+                for doc_id in postings[term][0]
+            }
+        # À score égal : ordre du corpus (fichier, puis section), quel que soit l'historique des mises à jour
+        entries = self.title_index.entries
+        best = heapq.nsmallest(
+            limit, candidates,
+            key=lambda doc_id: (-scores.get(doc_id, 0.0), entries[doc_id][1], entries[doc_id][0])
+        )
+        return [entries[doc_id] for doc_id in best]
+
+# --- STOCKAGE DE LA BASE DE CONNAISSANCES (SQLite) ---
+def _pack_integers(values):
+    """Entiers positifs -> BLOB compact (entiers 32 bits, little-endian)."""
+    values = array('I', values)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values.tobytes()
+
+def _unpack_integers(blob):
+    values = array('I')
+    values.frombytes(blob)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+def _pack_postings(rows):
+    """[(entrée, occurrences titre, occurrences contenu)] -> trois BLOBs compacts."""
+    return tuple(_pack_integers(column) for column in zip(*rows))
+
+def _compress_text(text):
+    return zlib.compress(text.encode('utf-8'))
+
+def _decompress_text(blob):
+    return zlib.decompress(blob).decode('utf-8')
+
+def _unpack_postings(*blobs):
+    return tuple(_unpack_integers(blob) for blob in blobs)
+
+class KnowledgeBaseDB:
+    """Base de connaissances dans un seul fichier SQLite.
+
+    Un enregistrement par document, par typologie et par section (contenus
+    compressés avec zlib) ; l'index des titres et les fréquences BM25 sont
+    écrits dans la même transaction que les sections, si bien qu'ils
+    correspondent toujours au contenu. Les recherches ne lisent que les
+    sections et les termes dont elles ont besoin.
+    """
+
+    # Incrémenté à chaque changement de format : une base plus ancienne est vidée puis reconstruite
+    SCHEMA_VERSION = 2
+    TABLES = ("meta", "documents", "typologies", "sections", "postings")
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value BLOB NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS documents (id INTEGER PRIMARY KEY, filename TEXT NOT NULL UNIQUE)",
+        "CREATE TABLE IF NOT EXISTS typologies ("
+        " document_id INTEGER NOT NULL, typo_index INTEGER NOT NULL, nom_typo TEXT NOT NULL,"
+        " PRIMARY KEY (document_id, typo_index))",
+        "CREATE TABLE IF NOT EXISTS sections ("
+        " id INTEGER PRIMARY KEY, document_id INTEGER NOT NULL, typo_index INTEGER NOT NULL,"
+        " section_index INTEGER NOT NULL, titre TEXT NOT NULL, contenu BLOB NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS sections_document ON sections(document_id, typo_index, section_index)",
+        "CREATE TABLE IF NOT EXISTS postings ("
+        " term TEXT PRIMARY KEY, entry_ids BLOB NOT NULL, title_tfs BLOB NOT NULL, content_tfs BLOB NOT NULL)",
+    )
+    # Limite prudente du nombre de paramètres par requête (anciennes versions de SQLite)
+    MAX_PARAMS = 900
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _open(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        (version,), = conn.execute("PRAGMA user_version").fetchall()
+        if version != self.SCHEMA_VERSION:
+            # La base est dérivée de knowledge_base.json : sans `source`, elle sera reconstruite
+            for table in self.TABLES:
+                conn.execute(f"DROP TABLE IF EXISTS {table}")
+            conn.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+        for statement in self.SCHEMA:
+            conn.execute(statement)
+        conn.commit()
+        return conn
+
+    def _connection(self):
+        if self._conn is None:
+            self._conn = self._open()
+        return self._conn
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            return self._connection().execute(sql, params).fetchall()
+
+    @classmethod
+    def _execute_in(cls, conn, sql, values):
+        """Exécute `sql` (contenant {marks}) par paquets de valeurs pour une clause IN."""
+        rows = []
+        for start in range(0, len(values), cls.MAX_PARAMS):
+            chunk = values[start:start + cls.MAX_PARAMS]
+            rows.extend(conn.execute(sql.format(marks=",".join("?" * len(chunk))), chunk).fetchall())
+        return rows
+
+    def _query_in(self, sql, values):
+        with self._lock:
+            return self._execute_in(self._connection(), sql, values)
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def reset_after_fork(self):
+        """Dans un processus fils : ne pas réutiliser la connexion SQLite du parent."""
+        self._lock = threading.Lock()
+        self._conn = None
+
+    @staticmethod
+    def _rows(kb_data, document_id, section_id):
+        """Lignes documents, typologies et sections de `kb_data`, numérotées à partir des identifiants donnés."""
+        documents, typologies, sections = [], [], []
+        for filename, typos in kb_data.items():
+            if not isinstance(typos, list):
+                continue
+            documents.append((document_id, filename))
+            for typo_idx, typologie in enumerate(typos):
+                if not isinstance(typologie, dict) or 'sections' not in typologie:
+                    continue
+                typologies.append((document_id, typo_idx, typologie.get('nom_typo', '')))
+                for section_idx, section in enumerate(typologie['sections']):
+                    if not isinstance(section, dict):
+                        continue
+                    sections.append((
+                        section_id, document_id, typo_idx, section_idx,
+                        section.get('titre', ''), section.get('contenu', ''),
+                    ))
+                    section_id += 1
+            document_id += 1
+        return documents, typologies, sections
+
+    @staticmethod
+    def _index_sections(title_index, lengths, documents, sections):
+        """Ajoute les sections à l'index des titres et à `lengths` ; renvoie {terme: [(entrée, titre, contenu)]}."""
+        filenames = dict(documents)
+        added = title_index.add(
+            (section_id, filenames[document_id], titre, contenu)
+            for section_id, document_id, _, _, titre, contenu in sections
+        )
+        postings = {}
+        for entry_id, titre, contenu in added:
+            title_tf, content_tf = ExampleRanker.entry_terms(titre, contenu)
+            lengths.extend((sum(title_tf.values()), sum(content_tf.values())))
+            for term in title_tf.keys() | content_tf.keys():
+                postings.setdefault(term, []).append((entry_id, title_tf[term], content_tf[term]))
+        return postings
+
+    @staticmethod
+    def _insert_rows(conn, documents, typologies, sections):
+        conn.executemany("INSERT INTO documents VALUES (?, ?)", documents)
+        conn.executemany("INSERT INTO typologies VALUES (?, ?, ?)", typologies)
+        conn.executemany(
+            "INSERT INTO sections VALUES (?, ?, ?, ?, ?, ?)",
+            (row[:5] + (_compress_text(row[5]),) for row in sections)
+        )
+
+    @staticmethod
+    def _write_meta(conn, title_index, lengths, source):
+        conn.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)", [
+            ("title_index", _compress_text(title_index.to_json())),
+            ("entry_lengths", _pack_integers(lengths)),
+            ("written_at", _compress_text(datetime.now().isoformat(timespec='seconds'))),
+            ("source", _compress_text(json.dumps(source))),
+        ])
+
+    def write(self, kb_data, source=None):
+        """Remplace tout le contenu par `kb_data` ({fichier: [typologies]}) en une transaction.
+
+        Les lectures en cours (autres connexions) continuent de voir l'ancienne
+        version jusqu'à la validation. `source` identifie le fichier JSON dont
+        le contenu provient (voir `source()`).
+        """
+        documents, typologies, sections = self._rows(kb_data, 1, 1)
+        title_index, lengths = SectionTitleIndex.build(()), array('I')
+        postings = self._index_sections(title_index, lengths, documents, sections)
+
+        # Connexion dédiée : la connexion de lecture reste disponible pendant l'écriture
+        conn = self._open()
+        try:
+            with conn:
+                for table in self.TABLES:
+                    conn.execute(f"DELETE FROM {table}")
+                self._insert_rows(conn, documents, typologies, sections)
+                conn.executemany(
+                    "INSERT INTO postings VALUES (?, ?, ?, ?)",
+                    ((term, *_pack_postings(rows)) for term, rows in postings.items())
+                )
+                self._write_meta(conn, title_index, lengths, source)
+            self._compact(conn)
+        finally:
+            conn.close()
+
+    def update(self, kb_data, removed=(), source=None):
+        """Remplace les documents de `kb_data` et retire ceux de `removed`, sans toucher aux autres.
+
+        Seules les sections de ces documents et les listes BM25 de leurs
+        termes sont réécrites, en une transaction ; l'espace libéré est
+        réutilisé par les écritures suivantes (pas de VACUUM). Renvoie False,
+        sans rien modifier, si la base doit plutôt être réécrite avec
+        `write()` : index absent, ou plus d'entrées retirées que d'entrées
+        actives.
+        """
+        filenames = list(kb_data) + [filename for filename in removed if filename not in kb_data]
+        conn = self._open()
+        try:
+            # Verrou d'écriture dès les lectures : l'index lu est celui qui sera modifié
+            conn.execute("BEGIN IMMEDIATE")
+            with conn:
+                title_index, lengths = self._read_search_index(conn)
+                if title_index is None:
+                    return False
+                old_documents = [row[0] for row in self._execute_in(
+                    conn, "SELECT id FROM documents WHERE filename IN ({marks})", filenames
+                )]
+
+                # Entrées des anciennes versions des documents : termes à retirer des listes
+                entry_of_section = {
+                    entry[0]: entry_id for entry_id, entry in enumerate(title_index.entries) if entry is not None
+                }
+                removals, removed_entries = {}, []
+                for section_id, blob in self._execute_in(
+                    conn, "SELECT id, contenu FROM sections WHERE document_id IN ({marks})", old_documents
+                ):
+                    entry_id = entry_of_section.get(section_id)
+                    if entry_id is None:
+                        continue
+                    title_tf, content_tf = ExampleRanker.entry_terms(
+                        title_index.entries[entry_id][2], _decompress_text(blob)
+                    )
+                    for term in title_tf.keys() | content_tf.keys():
+                        removals.setdefault(term, set()).add(entry_id)
+                    lengths[2 * entry_id] = lengths[2 * entry_id + 1] = 0
+                    removed_entries.append(entry_id)
+                title_index.remove(removed_entries)
+
+                (next_document, next_section), = conn.execute(
+                    "SELECT (SELECT COALESCE(MAX(id), 0) + 1 FROM documents),"
+                    " (SELECT COALESCE(MAX(id), 0) + 1 FROM sections)"
+                ).fetchall()
+                documents, typologies, sections = self._rows(kb_data, next_document, next_section)
+                additions = self._index_sections(title_index, lengths, documents, sections)
+                if 2 * title_index.live_count() < len(title_index.entries):
+                    return False
+
+                for table, column in (("sections", "document_id"), ("typologies", "document_id"), ("documents", "id")):
+                    self._execute_in(conn, f"DELETE FROM {table} WHERE {column} IN ({{marks}})", old_documents)
+                self._insert_rows(conn, documents, typologies, sections)
+
+                affected = sorted(removals.keys() | additions.keys())
+                current = {
+                    term: zip(*_unpack_postings(*blobs))
+                    for term, *blobs in self._execute_in(
+                        conn, "SELECT term, entry_ids, title_tfs, content_tfs FROM postings WHERE term IN ({marks})", affected
+                    )
+                }
+                upserts, deletes = [], []
+                for term in affected:
+                    gone = removals.get(term, ())
+                    rows = [row for row in current.get(term, ()) if row[0] not in gone]
+                    rows.extend(additions.get(term, ()))
+                    if rows:
+                        upserts.append((term, *_pack_postings(rows)))
+                    else:
+                        deletes.append(term)
+                conn.executemany("INSERT OR REPLACE INTO postings VALUES (?, ?, ?, ?)", upserts)
+                self._execute_in(conn, "DELETE FROM postings WHERE term IN ({marks})", deletes)
+                self._write_meta(conn, title_index, lengths, source)
+            return True
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _compact(conn):
+        """Vide le journal WAL et récupère l'espace libéré, si aucune lecture ne l'empêche.
+
+        Les données sont déjà validées : un échec ici (lecture en cours dans un
+        autre thread ou processus, « database is locked ») n'est pas une erreur,
+        le prochain passage s'en chargera.
+        """
+        for statement in ("PRAGMA wal_checkpoint(TRUNCATE)", "VACUUM"):
+            try:
+                conn.execute(statement)
+            except sqlite3.OperationalError as e:
+                print(f"⚠️ Compactage de la base de connaissances reporté ({statement}): {e}")
+                return
+
+    def source(self):
+        """[taille, mtime_ns, sha256] du fichier JSON dont la base a été construite, ou None."""
+        rows = self._query("SELECT value FROM meta WHERE key = 'source'")
+        return json.loads(_decompress_text(rows[0][0])) if rows else None
+
+    def set_source(self, source):
+        """Met à jour l'identité du fichier JSON source (contenu inchangé, date modifiée)."""
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                conn.execute("INSERT OR REPLACE INTO meta VALUES ('source', ?)", (_compress_text(json.dumps(source)),))
+
+    @staticmethod
+    def _read_search_index(conn):
+        rows = dict(conn.execute("SELECT key, value FROM meta WHERE key IN ('title_index', 'entry_lengths')"))
+        if len(rows) < 2:
+            return None, None
+        title_index = SectionTitleIndex.from_json(_decompress_text(rows['title_index']))
+        if title_index is None:
+            return None, None
+        return title_index, _unpack_integers(rows['entry_lengths'])
+
+    def search_index(self):
+        """(index des titres, longueurs des entrées pour BM25), ou (None, None) si absents ou obsolètes."""
+        with self._lock:
+            return self._read_search_index(self._connection())
+
+    def postings(self, terms):
+        """Listes BM25 des termes demandés : {terme: (entrées, occurrences titre, occurrences contenu)}."""
+        rows = self._query_in(
+            "SELECT term, entry_ids, title_tfs, content_tfs FROM postings WHERE term IN ({marks})", list(terms)
+        )
+        return {term: _unpack_postings(*blobs) for term, *blobs in rows}
+
+    def filenames(self):
+        return [filename for filename, in self._query("SELECT filename FROM documents ORDER BY id")]
+
+    def section_contents(self, section_ids):
+        """Contenus des sections demandées : {identifiant: contenu}."""
+        rows = self._query_in("SELECT id, contenu FROM sections WHERE id IN ({marks})", list(section_ids))
+        return {section_id: _decompress_text(blob) for section_id, blob in rows}
+
+    def read_document(self, filename):
+        """Typologies et sections d'un document, au format de knowledge_base.json (None si absent)."""
+        rows = self._query("SELECT id FROM documents WHERE filename = ?", (filename,))
+        if not rows:
+            return None
+        document_id = rows[0][0]
+        typologies = {
+            typo_idx: {"nom_typo": nom_typo, "sections": []}
+            for typo_idx, nom_typo in self._query(
+                "SELECT typo_index, nom_typo FROM typologies WHERE document_id = ? ORDER BY typo_index", (document_id,)
+            )
+        }
+        for typo_idx, titre, contenu in self._query(
+            "SELECT typo_index, titre, contenu FROM sections WHERE document_id = ? ORDER BY id", (document_id,)
+        ):
+            typologies[typo_idx]["sections"].append({"titre": titre, "contenu": _decompress_text(contenu)})
+        return list(typologies.values())
+
+    def iter_legacy_text(self):
+        """Produit la base au format texte historique (knowledge_base.txt), document par document."""
+        for document_id, filename in self._query("SELECT id, filename FROM documents ORDER BY id"):
+            parts = [f"\n\n--- EXTRAIT DU DOCUMENT : {filename} ---\n\n"]
+            for titre, contenu in self._query(
+                "SELECT titre, contenu FROM sections WHERE document_id = ? ORDER BY id", (document_id,)
+            ):
+                parts.append(f"{titre}\n{_decompress_text(contenu)}\n\n")
+            yield "".join(parts)
+
+    def stats(self):
+        (documents,), = self._query("SELECT COUNT(*) FROM documents")
+        (sections,), = self._query("SELECT COUNT(*) FROM sections")
+        return {"documents": documents, "sections": sections}
+
+# --- CACHE DE LA BASE DE CONNAISSANCES ---
+class KnowledgeBaseStore:
+    """Point d'accès unique à la base de connaissances pour tout le processus.
+
+    La base SQLite (non versionnée) est le seul fichier écrit par l'analyse
+    des PDFs, qui n'y met à jour que les documents modifiés.
+    knowledge_base.json (versionné, lisible) n'en est qu'une copie : il est
+    importé au premier accès et chaque fois que son contenu change (mise à
+    jour du dépôt...), et n'est réécrit que sur demande (`export_json()`,
+    `python app.py --export-knowledge-base`).
+
+    La base SQLite reste sur disque : seul l'index des titres est gardé en
+    mémoire, et n'est relu que si le fichier change (taille, date de
+    modification, journal WAL) ou après `invalidate()`. Sans JSON ni base, le
+    format texte legacy est lu tel quel.
+    """
+
+    def __init__(self, store_path, json_path, text_path):
+        self.store_path = store_path
+        self.json_path = json_path
+        self.text_path = text_path
+        self.db = KnowledgeBaseDB(store_path)
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+        self._json_checked = None
+        self._data = None
+        self._index = None
+        self._lengths = None
+        self._ranker = None
+        self._signature = None
+        self.hits = 0
+        self.misses = 0
+        self.last_load_seconds = None
+        self.loaded_at = None
+
+    def _current_signature(self):
+        """Identifie la version des fichiers sur disque (chemin, mtime, taille)."""
+        try:
+            st = os.stat(self.store_path)
+        except OSError:
+            pass
+        else:
+            try:
+                wal = os.stat(self.store_path + "-wal")
+                # Journal vide (créé à l'ouverture d'une connexion) : rien de plus que le fichier principal
+                wal_signature = (wal.st_mtime_ns, wal.st_size) if wal.st_size else None
+            except OSError:
+                wal_signature = None
+            return (self.store_path, st.st_mtime_ns, st.st_size, wal_signature)
+        # Sans base ni JSON (sinon `_ensure_store` a construit la base) : format texte legacy
+        try:
+            st = os.stat(self.text_path)
+        except OSError:
+            return None
+        return (self.text_path, st.st_mtime_ns, st.st_size, None)
+
+    def _json_signature(self):
+        try:
+            st = os.stat(self.json_path)
+        except OSError:
+            return None
+        return [st.st_size, st.st_mtime_ns]
+
+    def _ensure_store(self):
+        """Construit la base SQLite depuis knowledge_base.json si elle manque ou ne correspond plus.
+
+        Seule une date ou une taille changée déclenche la comparaison des
+        empreintes : un JSON seulement « touché » (git checkout) n'est pas relu.
+        """
+        signature = self._json_signature()
+        if signature is None or signature == self._json_checked:
+            return
+        with self._build_lock, _VerrouFichier(self.store_path + ".lock"):
+            source = self.db.source() if os.path.exists(self.store_path) else None
+            if source is None or source[:2] != signature:
+                with open(self.json_path, "rb") as f:
+                    payload = f.read()
+                digest = hashlib.sha256(payload).hexdigest()
+                if source is not None and source[2] == digest:
+                    self.db.set_source(signature + [digest])
+                else:
+                    self.db.write(json.loads(payload), signature + [digest])
+                    print(f"Base de connaissances construite depuis {os.path.basename(self.json_path)} "
+                          f"dans {os.path.basename(self.store_path)}")
+            self._json_checked = signature
+
+    def _load(self, signature):
+        if signature is None:
+            return {}, None, None
+        path = signature[0]
+        if path != self.store_path:
+            # Fallback vers le format texte si la base n'existe pas
+            with open(path, "r", encoding="utf-8") as f:
+                return f.read(), None, None
+        index, lengths = self.db.search_index()
+        if index is None:
+            raise ValueError(f"Index des titres absent ou obsolète dans {self.store_path}")
+        return self.db, index, lengths
+
+    def get(self):
+        """Renvoie la base (KnowledgeBaseDB, texte legacy ou {} si absente)."""
+        self._ensure_store()
+        signature = self._current_signature()
+        with self._lock:
+            if self._data is not None and signature == self._signature:
+                self.hits += 1
+                return self._data
+            self.misses += 1
+            start = time.perf_counter()
+            with metrics.span("kb_load"):
+                self._data, self._index, self._lengths = self._load(signature)
+            self._ranker = None
+            self._signature = signature
+            self.last_load_seconds = time.perf_counter() - start
+            self.loaded_at = datetime.now()
+            return self._data
+
+    def get_search(self):
+        """Renvoie (base, index des titres, classement BM25).
+
+        L'index et le classement valent None pour le format texte legacy.
+        """
+        data = self.get()
+        with self._lock:
+            if data is not self._data or self._index is None:
+                return data, None, None
+            if self._ranker is None:
+                self._ranker = ExampleRanker(self._index, self.db.postings, self._lengths)
+            return data, self._index, self._ranker
+
+    def replace(self, kb_data):
+        """Réécrit la base avec `kb_data` ({fichier: [typologies]}) puis invalide le cache.
+
+        knowledge_base.json n'est pas touché : la base garde l'identité du
+        dernier JSON importé, qui n'est donc pas réimporté par-dessus.
+        """
+        self._ensure_store()
+        with self._build_lock, _VerrouFichier(self.store_path + ".lock"):
+            self.db.write(kb_data, self.db.source())
+        self.invalidate()
+
+    def update(self, kb_data, changed, removed):
+        """Comme `replace()`, mais seuls les documents `changed` et `removed` sont réécrits.
+
+        La base revient à une réécriture complète si la mise à jour
+        incrémentale n'est pas possible (voir `KnowledgeBaseDB.update`).
+        """
+        self._ensure_store()
+        with self._build_lock, _VerrouFichier(self.store_path + ".lock"):
+            source = self.db.source()
+            if not self.db.update({filename: kb_data[filename] for filename in changed}, removed, source):
+                self.db.write(kb_data, source)
+        self.invalidate()
+
+    def export_json(self):
+        """Écrit le contenu de la base dans knowledge_base.json ; renvoie le nombre de documents.
+
+        La base prend l'identité du fichier écrit : il ne sera pas réimporté.
+        """
+        self._ensure_store()
+        with self._build_lock, _VerrouFichier(self.store_path + ".lock"):
+            kb_data = {filename: self.db.read_document(filename) for filename in sorted(self.db.filenames())}
+            payload = json.dumps(kb_data, indent=2, ensure_ascii=False).encode("utf-8")
+            tmp_path = self.json_path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(payload)
+            os.replace(tmp_path, self.json_path)
+            source = self._json_signature() + [hashlib.sha256(payload).hexdigest()]
+            self.db.set_source(source)
+            self._json_checked = source[:2]
+        self.invalidate()
+        return len(kb_data)
+
+    def invalidate(self):
+        """Force le rechargement au prochain accès."""
+        with self._lock:
+            self._data = None
+            self._index = None
+            self._lengths = None
+            self._ranker = None
+            self._signature = None
+
+    def stats(self):
+        with self._lock:
+            return {
+                "loaded": self._data is not None,
+                "source": os.path.basename(self._signature[0]) if self._signature else None,
+                "hits": self.hits,
+                "misses": self.misses,
+                "last_load_ms": round(self.last_load_seconds * 1000, 2) if self.last_load_seconds is not None else None,
+                "loaded_at": self.loaded_at.isoformat(timespec='seconds') if self.loaded_at else None,
+            }
+
+kb_store = KnowledgeBaseStore(KNOWLEDGE_BASE_STORE_PATH, KNOWLEDGE_BASE_JSON_PATH, KNOWLEDGE_BASE_PATH)
+
+# --- CACHE DES GÉNÉRATIONS ---
+# Taille maximale du cache sur disque (textes + prompts), en Mo
+GENERATION_CACHE_MAX_MB = float(os.getenv("CCTP_GENERATION_CACHE_MAX_MB", "64"))
+
+class GenerationCache:
+    """Cache persistant (SQLite) des textes générés, adressé par le contenu du prompt.
+
+    La clé est un SHA-256 du modèle, de la température et du prompt final :
+    deux demandes identiques (notes, typologie, consigne, exemples) partagent
+    le même résultat. Au-delà de `max_bytes`, les entrées les moins récemment
+    utilisées sont supprimées.
+    """
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = None
+        self.hits = 0
+        self.misses = 0
+
+    def _connection(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=10)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS generations ("
+                " key TEXT PRIMARY KEY, model TEXT NOT NULL, text TEXT NOT NULL,"
+                " size INTEGER NOT NULL, prompt_size INTEGER NOT NULL,"
+                " created_at REAL NOT NULL, last_access REAL NOT NULL,"
+                " hits INTEGER NOT NULL DEFAULT 0)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS generations_lru ON generations(last_access)")
+            self._conn.commit()
+        return self._conn
+
+    @staticmethod
+    def make_key(model, temperature, prompt):
+        payload = json.dumps([model, temperature, prompt], ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """Renvoie le texte en cache, ou None."""
+        with self._lock:
+            conn = self._connection()
+            row = conn.execute("SELECT text FROM generations WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            conn.execute(
+                "UPDATE generations SET last_access = ?, hits = hits + 1 WHERE key = ?",
+                (time.time(), key),
+            )
+            conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, key, model, prompt, text):
+        now = time.time()
+        size = len(text.encode("utf-8"))
+        prompt_size = len(prompt.encode("utf-8"))
+        with self._lock:
+            conn = self._connection()
+            conn.execute(
+                "INSERT OR REPLACE INTO generations (key, model, text, size, prompt_size, created_at, last_access, hits)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, COALESCE((SELECT hits FROM generations WHERE key = ?), 0))",
+                (key, model, text, size, prompt_size, now, now, key),
+            )
+            self._evict(conn)
+            conn.commit()
+
+    def _evict(self, conn):
+        total = conn.execute("SELECT COALESCE(SUM(size + prompt_size), 0) FROM generations").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, entry_size in conn.execute(
+            "SELECT key, size + prompt_size FROM generations ORDER BY last_access"
+        ).fetchall():
+            conn.execute("DELETE FROM generations WHERE key = ?", (key,))
+            total -= entry_size
+            if total <= self.max_bytes:
+                break
+
+    def clear(self):
+        with self._lock:
+            conn = self._connection()
+            conn.execute("DELETE FROM generations")
+            conn.commit()
+
+    def stats(self):
+        with self._lock:
+            entries, stored, saved, total_hits = self._connection().execute(
+                "SELECT COUNT(*), COALESCE(SUM(size + prompt_size), 0),"
+                " COALESCE(SUM(hits * (size + prompt_size)), 0), COALESCE(SUM(hits), 0)"
+                " FROM generations"
+            ).fetchone()
+            return {
+                "entries": entries,
+                "bytes_stored": stored,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hits_total": total_hits,
+                "bytes_saved": saved,
+            }
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def reset_after_fork(self):
+        """Dans un processus fils : ne pas réutiliser la connexion SQLite du parent."""
+        self._lock = threading.Lock()
+        self._conn = None
+
+generation_cache = GenerationCache(GENERATION_CACHE_PATH, int(GENERATION_CACHE_MAX_MB * 1024 * 1024))
 
 # --- PROMPT PAR DÉFAUT ---
 DEFAULT_SYSTEM_PROMPT = (
@@ -65,22 +1276,167 @@ DEFAULT_SYSTEM_PROMPT = (
     "4.  **Formatage** : Réponds DIRECTEMENT avec le texte de la section. N'inclus PAS de titre, de numérotation ni le nom de la typologie dans ta réponse."
 )
 
+# --- REGISTRE DES PROMPTS ---
+# Intervalle minimal (s) entre deux vérifications des fichiers de prompts sur disque
+PROMPT_RELOAD_INTERVAL = 2.0
+
+class UnknownPromptError(KeyError):
+    """Le prompt (ou la version) demandé n'existe pas dans le registre."""
+
+    def __str__(self):
+        return str(self.args[0]) if self.args else ""
+
+class PromptRegistry:
+    """Prompts gardés en mémoire : prompt système + prompts nommés et versionnés.
+
+    Le prompt système reste stocké dans `system_prompt.txt` ; les prompts
+    nommés (variantes par section, A/B tests) sont dans `prompts_registry.json`
+    sous la forme {id: {"name": ..., "versions": [{"version", "text", "created_at"}]}}.
+    Les fichiers ne sont relus que s'ils ont changé sur disque, et au plus une
+    fois par `PROMPT_RELOAD_INTERVAL`.
+    """
+
+    SYSTEM_ID = "system"
+
+    def __init__(self, system_path, registry_path, default_prompt):
+        self.system_path = system_path
+        self.registry_path = registry_path
+        self.default_prompt = default_prompt
+        self._lock = threading.Lock()
+        self._system_prompt = None
+        self._prompts = None
+        self._signatures = {}
+        self._checked_at = 0.0
+
+    @staticmethod
+    def _signature(path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def _read_system_prompt(self):
+        if os.path.exists(self.system_path):
+            try:
+                with open(self.system_path, "r", encoding="utf-8") as f:
+                    prompt = f.read().strip()
+                    if prompt:
+                        return prompt
+            except Exception:
+                pass
+        return self.default_prompt
+
+    def _read_registry(self):
+        try:
+            with open(self.registry_path, "r", encoding="utf-8") as f:
+                prompts = json.load(f)
+            return prompts if isinstance(prompts, dict) else {}
+        except (OSError, ValueError):
+            return {}
+
+    def _refresh(self):
+        """Recharge ce qui a changé sur disque (à appeler sous verrou)."""
+        now = time.monotonic()
+        if self._prompts is not None and now - self._checked_at < PROMPT_RELOAD_INTERVAL:
+            return
+        self._checked_at = now
+        system_sig = self._signature(self.system_path)
+        if self._system_prompt is None or system_sig != self._signatures.get("system"):
+            self._system_prompt = self._read_system_prompt()
+            self._signatures["system"] = system_sig
+        registry_sig = self._signature(self.registry_path)
+        if self._prompts is None or registry_sig != self._signatures.get("registry"):
+            self._prompts = self._read_registry()
+            self._signatures["registry"] = registry_sig
+
+    def _write_registry(self):
+        tmp_path = self.registry_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._prompts, f, indent=2, ensure_ascii=False)
+        os.replace(tmp_path, self.registry_path)
+        self._signatures["registry"] = self._signature(self.registry_path)
+
+    def system_prompt(self):
+        with self._lock:
+            self._refresh()
+            return self._system_prompt
+
+    def save_system_prompt(self, new_prompt):
+        with self._lock:
+            with open(self.system_path, "w", encoding="utf-8") as f:
+                f.write(new_prompt.strip())
+            self._system_prompt = new_prompt.strip() or self.default_prompt
+            self._signatures["system"] = self._signature(self.system_path)
+
+    def get(self, prompt_id=None, version=None):
+        """(texte, version) d'un prompt : le système par défaut, sinon la version demandée (ou la dernière).
+
+        Le prompt système n'est pas versionné (version None). Lève
+        UnknownPromptError (une KeyError) si l'identifiant ou la version
+        n'existe pas, ou si le prompt n'a aucune version.
+        """
+        with self._lock:
+            self._refresh()
+            if not prompt_id or prompt_id == self.SYSTEM_ID:
+                return self._system_prompt, None
+            versions = self._prompts.get(prompt_id, {}).get("versions")
+            if not versions:
+                raise UnknownPromptError(prompt_id)
+            if version is None:
+                return versions[-1]["text"], versions[-1]["version"]
+            for entry in versions:
+                if entry["version"] == version:
+                    return entry["text"], version
+            raise UnknownPromptError(f"{prompt_id} v{version}")
+
+    def save(self, prompt_id, text, name=None):
+        """Enregistre une nouvelle version d'un prompt nommé et renvoie son numéro."""
+        with self._lock:
+            self._refresh()
+            entry = self._prompts.setdefault(prompt_id, {"name": name or prompt_id, "versions": []})
+            if name:
+                entry["name"] = name
+            version = entry["versions"][-1]["version"] + 1 if entry["versions"] else 1
+            entry["versions"].append({
+                "version": version,
+                "text": text.strip(),
+                "created_at": datetime.now().isoformat(timespec='seconds'),
+            })
+            self._write_registry()
+            return version
+
+    def delete(self, prompt_id):
+        with self._lock:
+            self._refresh()
+            del self._prompts[prompt_id]
+            self._write_registry()
+
+    def describe(self):
+        """Liste des prompts nommés (sans leur texte)."""
+        with self._lock:
+            self._refresh()
+            return [
+                {
+                    "id": prompt_id,
+                    "name": entry.get("name", prompt_id),
+                    "latest_version": entry["versions"][-1]["version"] if entry["versions"] else None,
+                    "versions": [
+                        {"version": v["version"], "created_at": v.get("created_at")} for v in entry["versions"]
+                    ],
+                }
+                for prompt_id, entry in sorted(self._prompts.items())
+            ]
+
+prompt_registry = PromptRegistry(SYSTEM_PROMPT_PATH, PROMPTS_REGISTRY_PATH, DEFAULT_SYSTEM_PROMPT)
+
 def load_system_prompt():
     """Charge le prompt système personnalisé, ou retourne le prompt par défaut si absent."""
-    if os.path.exists(SYSTEM_PROMPT_PATH):
-        try:
-            with open(SYSTEM_PROMPT_PATH, "r", encoding="utf-8") as f:
-                prompt = f.read().strip()
-                if prompt:
-                    return prompt
-        except Exception:
-            pass
-    return DEFAULT_SYSTEM_PROMPT
+    return prompt_registry.system_prompt()
 
 def save_system_prompt(new_prompt):
     """Sauvegarde le prompt système personnalisé."""
-    with open(SYSTEM_PROMPT_PATH, "w", encoding="utf-8") as f:
-        f.write(new_prompt.strip())
+    prompt_registry.save_system_prompt(new_prompt)
 
 @app.route('/api/system-prompt', methods=['GET'])
 def get_system_prompt():
@@ -97,19 +1453,106 @@ def set_system_prompt():
     save_system_prompt(prompt)
     return jsonify({"message": "Prompt système sauvegardé."})
 
+@app.route('/api/prompts', methods=['GET'])
+def list_prompts():
+    """Liste les prompts nommés et leurs versions."""
+    return jsonify(prompt_registry.describe())
+
+@app.route('/api/prompts/<prompt_id>', methods=['GET'])
+def get_prompt(prompt_id):
+    """Renvoie le texte d'un prompt nommé (dernière version ou `?version=N`)."""
+    try:
+        prompt, version = prompt_registry.get(prompt_id, request.args.get('version', type=int))
+        return jsonify({"id": prompt_id, "version": version, "prompt": prompt})
+    except KeyError:
+        return jsonify({"error": "Prompt introuvable."}), 404
+
+@app.route('/api/prompts/<prompt_id>', methods=['POST'])
+def save_prompt(prompt_id):
+    """Enregistre une nouvelle version d'un prompt nommé."""
+    data = request.json
+    prompt = data.get("prompt", "").strip()
+    if not prompt:
+        return jsonify({"error": "Le prompt ne peut pas être vide."}), 400
+    if prompt_id == PromptRegistry.SYSTEM_ID:
+        return jsonify({"error": "Utilisez /api/system-prompt pour le prompt système."}), 400
+    version = prompt_registry.save(prompt_id, prompt, data.get("name"))
+    return jsonify({"message": "Prompt sauvegardé.", "id": prompt_id, "version": version}), 201
+
+@app.route('/api/prompts/<prompt_id>', methods=['DELETE'])
+def delete_prompt(prompt_id):
+    """Supprime un prompt nommé et toutes ses versions."""
+    try:
+        prompt_registry.delete(prompt_id)
+    except KeyError:
+        return jsonify({"error": "Prompt introuvable."}), 404
+    return jsonify({"message": "Prompt supprimé."})
+
+# --- POLICES DU PDF (analysées une fois par processus) ---
+FONTS_DIR = os.path.join(BASE_DIR, "fonts")
+PDF_FONTS = (("", "DejaVuSans.ttf"), ("B", "DejaVuSans-Bold.ttf"))
+
+class PDFFontCache:
+    """Garde les polices TrueType analysées (métriques, table des caractères) pour tout le processus.
+
+    fpdf2 réduit chaque police aux glyphes utilisés au moment de `output()`,
+    en modifiant l'objet fontTools sur place : chaque document reçoit donc
+    une copie des métriques partagées et sa propre police fontTools, ouverte
+    à la demande depuis les octets du fichier gardés en mémoire.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._fonts = {}
+        self.loads = 0
+
+    def _template(self, pdf, path, fontkey, style):
+        with self._lock:
+            entry = self._fonts.get((path, fontkey))
+            if entry is None:
+                with open(path, "rb") as f:
+                    data = f.read()
+                template = TTFFont(pdf, Path(path), fontkey, style)
+                # Seules les métriques sont partagées ; la police fontTools est propre à chaque document
+                template.ttfont.close()
+                template.ttfont = None
+                entry = self._fonts[(path, fontkey)] = (template, data)
+                self.loads += 1
+            return entry
+
+    def add_to(self, pdf, family, style, path):
+        """Équivalent de `pdf.add_font(family, style, path)` sans relire ni réanalyser le fichier."""
+        fontkey = f"{family.lower()}{style}"
+        template, data = self._template(pdf, path, fontkey, style)
+        font = copy.copy(template)
+        font.i = len(pdf.fonts) + 1
+        font.ttfont = ttLib.TTFont(io.BytesIO(data), recalcTimestamp=False, lazy=True)
+        font.subset = SubsetMap(font)
+        font.missing_glyphs = []
+        font.biggest_size_pt = 0
+        font._hbfont = None
+        pdf.fonts[fontkey] = font
+
+pdf_font_cache = PDFFontCache()
+
 # --- CLASSE PDF (identique à votre script original) ---
 class PDF(FPDF):
     def __init__(self, *args, **kwargs):
-        self.chapter_map = kwargs.pop('chapter_map', [])
+        self.chapter_map = kwargs.pop('chapter_map', {})
+        # Faux pour un fragment d'export : la numérotation est ajoutée après l'assemblage
+        self.page_numbers = kwargs.pop('page_numbers', True)
         super().__init__(*args, **kwargs)
         try:
-            # IMPORTANT: Assurez-vous que le dossier `fonts` se trouve dans `backend/`
-            self.add_font('DejaVu', '', 'fonts/DejaVuSans.ttf', uni=True)
-            self.add_font('DejaVu', 'B', 'fonts/DejaVuSans-Bold.ttf', uni=True)
-        except RuntimeError as e:
+            # Chemins absolus : l'export ne dépend plus du dossier courant
+            for style, filename in PDF_FONTS:
+                font_path = os.path.join(FONTS_DIR, filename)
+                if not (PDF_FONT_CACHE_AVAILABLE and self._add_cached_font(style, font_path)):
+                    self.add_font('DejaVu', style, font_path)
+        except (RuntimeError, OSError) as e:
             print(f"ERREUR FATALE: Impossible de trouver les polices pour FPDF. {e}")
             print("Assurez-vous que les fichiers 'DejaVuSans.ttf' et 'DejaVuSans-Bold.ttf' sont dans un dossier nommé 'fonts' à la racine du dossier 'backend'.")
-            raise SystemExit("Polices FPDF non trouvées.")
+            # Pas de SystemExit : le rendu tourne dans un thread d'export, l'erreur doit remonter à la tâche
+            raise RuntimeError("Polices FPDF non trouvées.") from e
 
         self.normal_color = (105, 108, 111)
         self.placeholder_color = (220, 53, 69)
@@ -117,6 +1560,23 @@ class PDF(FPDF):
         self.cross_ref_color = (0, 123, 255)
         self.set_text_color(*self.normal_color)
 
+    def _add_cached_font(self, style, font_path):
+        """Ajoute la police depuis le cache ; faux (et cache désactivé) si fpdf2 n'est pas compatible."""
+        global PDF_FONT_CACHE_AVAILABLE
+        try:
+            pdf_font_cache.add_to(self, 'DejaVu', style, font_path)
+            return True
+        except OSError:
+            # Fichier de police absent : même erreur que sans cache
+            raise
+        except Exception as e:
+            # Le cache repose sur des internes de fpdf2 : une autre version peut les changer
+            if PDF_FONT_CACHE_AVAILABLE:
+                PDF_FONT_CACHE_AVAILABLE = False
+                print(f"AVERTISSEMENT: cache des polices PDF désactivé (version de fpdf2 incompatible : {e!r})")
+            self.fonts.pop(f"dejavu{style}", None)
+            return False
+
     def header(self):
         self.set_font('DejaVu', 'B', 9)
         self.set_text_color(180, 180, 180)
@@ -125,6 +1585,8 @@ class PDF(FPDF):
         self.set_text_color(*self.normal_color)
 
     def footer(self):
+        if not self.page_numbers:
+            return
         self.set_y(-15)
         self.set_font('DejaVu', '', 8)
         self.set_text_color(*self.normal_color)
@@ -162,10 +1624,38 @@ class PDF(FPDF):
         """Cette méthode n'est plus utilisée car les transformations sont faites en amont"""
         return text
 
+def compute_chapter_map(project_data):
+    """Numérotation des sections du projet, identique à `chapterMap` côté frontend."""
+    chapter_map = []
+    for typo_idx, typo_data in enumerate(project_data):
+        for section_idx, section in enumerate(typo_data.get("sections", [])):
+            chapter_map.append({
+                "nom_typo": typo_data.get("nomTypologie"),
+                "titre_section": section.get("titre"),
+                "number": f"{typo_idx + 1}.{section_idx + 1}",
+            })
+    return chapter_map
+
+def build_chapter_index(chapter_map):
+    """Index (nom_typo, titre_section) -> numéro ; la première occurrence l'emporte."""
+    if isinstance(chapter_map, dict):
+        return chapter_map
+    chapter_index = {}
+    for item in chapter_map:
+        chapter_index.setdefault((item['nom_typo'], item['titre_section']), item['number'])
+    return chapter_index
+
 def extract_parts_for_export(text, chapter_map, include_ai_notes=True):
-    """Sépare texte principal, placeholders, exemples, crossrefs pour export."""
+    """Sépare texte principal, placeholders, exemples, crossrefs pour export.
+
+    Le texte nettoyé est découpé en un seul parcours : chaque marqueur
+    (placeholder, exemple, référence croisée) est retiré du texte principal
+    et ajouté une seule fois à sa liste, dans l'ordre d'apparition.
+    `chapter_map` est la liste du frontend ou l'index de `build_chapter_index`.
+    """
     if not text:
         return "", [], [], []
+    chapter_index = build_chapter_index(chapter_map)
     
     # Nettoyer le texte d'abord
     cleaned_text = _clean_text_for_export(text)
@@ -173,55 +1663,436 @@ def extract_parts_for_export(text, chapter_map, include_ai_notes=True):
     placeholders = []
     exemples = []
     crossrefs = []
-    main_text = cleaned_text
-    
-    # Extraire les placeholders [À ...] si demandé
-    if include_ai_notes:
-        placeholder_matches = re.findall(PLACEHOLDER_PATTERN, main_text)
-        for match in placeholder_matches:
-            if match not in placeholders:  # Éviter les doublons
-                placeholders.append(match)
-    main_text = re.sub(PLACEHOLDER_PATTERN, '', main_text)
-    
-    # Extraire les exemples (voir exemple CCTP ...) si demandé
-    if include_ai_notes:
-        example_matches = re.findall(REFERENCE_PATTERN, main_text)
-        for match in example_matches:
-            if match not in exemples:  # Éviter les doublons
-                exemples.append(match)
-    main_text = re.sub(REFERENCE_PATTERN, '', main_text)
+    seen = set()  # Éviter les doublons
+    main_parts = []
+    position = 0
     
-    # Traiter les cross-references {{REF:...|...}}
-    def crossref_repl(match):
-        typo = match.group(1)
-        section = match.group(2)
-        ref = next((c for c in chapter_map if c['nom_typo'] == typo and c['titre_section'] == section), None)
-        if ref:
-            ref_text = f"(voir section {ref['number']} {section})"
-            if ref_text not in crossrefs:  # Éviter les doublons
-                crossrefs.append(ref_text)
+    for match in EXPORT_TOKEN_PATTERN.finditer(cleaned_text):
+        main_parts.append(cleaned_text[position:match.start()])
+        position = match.end()
+        token = match.group()
+        kind = token[0]
+        if kind != '[' and (PLACEHOLDER_START_PATTERN.search(token) or (kind == '{' and REFERENCE_START in token)):
+            # Marqueur prioritaire à l'intérieur d'un autre
+            return _extract_parts_sequential(cleaned_text, chapter_index, include_ai_notes)
+        
+        if kind == '{':
+            # Traiter les cross-references {{REF:...|...}}
+            token = _texte_reference(chapter_index, match.group('typo'), match.group('section'))
+            target = crossrefs
+        elif not include_ai_notes:
+            # Placeholders et exemples sont retirés du texte sans être exportés
+            continue
+        elif kind == '[':
+            target = placeholders
         else:
-            error_ref = f"(référence introuvable: {typo}|{section})"
-            if error_ref not in crossrefs:  # Éviter les doublons
-                crossrefs.append(error_ref)
-        return ''
-    
-    main_text = re.sub(CROSS_REF_PATTERN, crossref_repl, main_text)
+            target = exemples
+        
+        if token not in seen:
+            seen.add(token)
+            target.append(token)
+    main_parts.append(cleaned_text[position:])
+    main_text = "".join(main_parts)
+    if REFERENCE_START in main_text or CROSS_REF_START in main_text:
+        # Marqueur incomplet, ou formé en retirant d'autres marqueurs
+        return _extract_parts_sequential(cleaned_text, chapter_index, include_ai_notes)
     
     # Nettoyer le texte principal des espaces multiples
-    main_text = re.sub(r'\s+', ' ', main_text).strip()
+    main_text = " ".join(main_text.split())
     
     return main_text, placeholders, exemples, crossrefs
 
-# --- FONCTIONS LOGIQUES (adaptées de votre script) ---
+def _texte_reference(chapter_index, typo, section):
+    number = chapter_index.get((typo, section))
+    if number is not None:
+        return f"(voir section {number} {section})"
+    return f"(référence introuvable: {typo}|{section})"
 
-def openai_chat_completion(model, messages, temperature=0.3):
-    """Wrapper compatible avec openai>=1.0."""
-    return openai.chat.completions.create(
-        model=model,
-        messages=messages,
-        temperature=temperature,
-    )
+def _extract_parts_sequential(cleaned_text, chapter_index, include_ai_notes):
+    """Comme `extract_parts_for_export`, en trois passes : placeholders, exemples, puis références.
+
+    Réservé aux textes où des marqueurs s'imbriquent : chaque passe
+    travaille sur le texte débarrassé des marqueurs des passes précédentes.
+    """
+    text = cleaned_text
+    parts = []
+    for pattern in (PLACEHOLDER_PATTERN, REFERENCE_PATTERN):
+        found = []
+        if include_ai_notes:
+            for token in pattern.findall(text):
+                if token not in found:
+                    found.append(token)
+        parts.append(found)
+        text = pattern.sub('', text)
+    
+    crossrefs = []
+    def crossref_repl(match):
+        token = _texte_reference(chapter_index, match.group(2), match.group(3))
+        if token not in crossrefs:
+            crossrefs.append(token)
+        return ''
+    text = CROSS_REF_PATTERN.sub(crossref_repl, text)
+    
+    return " ".join(text.split()), parts[0], parts[1], crossrefs
+
+# --- COMPTAGE DES TOKENS ---
+_TOKEN_ENCODINGS = {}
+_TOKEN_ENCODINGS_LOCK = threading.Lock()
+# Estimation sans tiktoken : un token par tranche de 4 caractères d'un mot, un par signe
+_TOKEN_ESTIMATE_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+def _encodage_tokens(model):
+    """Encodeur tiktoken du modèle, ou None si tiktoken ou ses tables sont indisponibles."""
+    if not TIKTOKEN_AVAILABLE:
+        return None
+    with _TOKEN_ENCODINGS_LOCK:
+        if model not in _TOKEN_ENCODINGS:
+            try:
+                try:
+                    encoding = tiktoken.encoding_for_model(model)
+                except KeyError:
+                    encoding = tiktoken.get_encoding("cl100k_base")
+            except Exception as e:
+                # Tables non téléchargeables (hors ligne) : on se contente de l'estimation
+                print(f"⚠️ Encodeur tiktoken indisponible pour {model}, tokens estimés: {e}")
+                encoding = None
+            _TOKEN_ENCODINGS[model] = encoding
+        return _TOKEN_ENCODINGS[model]
+
+def _nom_tokenizer(model):
+    encoding = _encodage_tokens(model)
+    return f"tiktoken:{encoding.name}" if encoding is not None else "estimation"
+
+def _compter_tokens(text, model):
+    """Nombre de tokens de `text` pour `model` (exact avec tiktoken, sinon estimé)."""
+    if not text:
+        return 0
+    encoding = _encodage_tokens(model)
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    return sum((len(token) + 3) // 4 for token in _TOKEN_ESTIMATE_PATTERN.findall(text))
+
+# --- CLIENT OPENAI (quotas, priorités, reprises) ---
+# Quotas du compte OpenAI : requêtes et tokens par minute
+OPENAI_RPM_LIMIT = int(os.getenv("CCTP_OPENAI_RPM", "500"))
+OPENAI_TPM_LIMIT = int(os.getenv("CCTP_OPENAI_TPM", "150000"))
+# Nombre maximal d'appels OpenAI en cours, tous utilisateurs confondus
+OPENAI_MAX_CONCURRENCY = int(os.getenv("CCTP_OPENAI_MAX_CONCURRENCY", "8"))
+OPENAI_MAX_RETRIES = int(os.getenv("CCTP_OPENAI_MAX_RETRIES", "4"))
+OPENAI_TIMEOUT = float(os.getenv("CCTP_OPENAI_TIMEOUT", "120"))
+# Délai de base et délai maximal (s) entre deux tentatives
+OPENAI_RETRY_BASE_DELAY = float(os.getenv("CCTP_OPENAI_RETRY_BASE_DELAY", "0.5"))
+OPENAI_RETRY_MAX_DELAY = float(os.getenv("CCTP_OPENAI_RETRY_MAX_DELAY", "20"))
+# Tokens réservés pour la réponse tant que la consommation réelle n'est pas connue
+OPENAI_COMPLETION_RESERVE = int(os.getenv("CCTP_OPENAI_COMPLETION_RESERVE", "1000"))
+# URL de l'API (vide = OpenAI) : permet de viser un serveur local, cf. fake_openai_server.py
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL") or None
+
+# Priorités d'ordonnancement : une section demandée à l'écran passe avant les lots
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+
+# Erreurs pour lesquelles une nouvelle tentative a un sens (429, 5xx, réseau, délai dépassé)
+OPENAI_RETRYABLE_ERRORS = (openai.RateLimitError, openai.InternalServerError, openai.APIConnectionError)
+
+class TokenBucket:
+    """Seau de `per_minute` jetons, rechargé en continu sur une minute."""
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def wait_time(self, amount, now):
+        """Secondes à attendre avant de pouvoir prendre `amount` jetons (0 si tout de suite).
+
+        Une demande plus grosse que le seau passe dès qu'il est plein.
+        """
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        missing = min(amount, self.capacity) - self.tokens
+        return max(0.0, missing / self.rate)
+
+    def take(self, amount):
+        # Le solde peut devenir négatif : la dette se rembourse avec la recharge
+        self.tokens -= amount
+
+    def give(self, amount):
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+class OpenAIScheduler:
+    """File de priorité des appels OpenAI, sous quotas RPM/TPM et limite de concurrence.
+
+    Un appel démarre quand il est en tête de file (priorité, puis ordre
+    d'arrivée), qu'une place est libre et que les deux seaux ont assez de
+    jetons. Un 429 suspend tous les appels pendant le délai demandé.
+    """
+
+    def __init__(self, rpm, tpm, max_concurrency):
+        self.max_concurrency = max(1, max_concurrency)
+        self._requests = TokenBucket(rpm)
+        self._tokens = TokenBucket(tpm)
+        self._cond = threading.Condition()
+        self._waiting = []
+        self._sequence = 0
+        self._running = 0
+        self._paused_until = 0.0
+        self.started = 0
+        self.retries = 0
+        self.rate_limited = 0
+        self.failures = 0
+        self.wait_seconds = 0.0
+
+    def set_limits(self, rpm, tpm, max_concurrency):
+        """Change les quotas (par exemple pour les partager entre plusieurs processus)."""
+        with self._cond:
+            self.max_concurrency = max(1, max_concurrency)
+            self._requests = TokenBucket(rpm)
+            self._tokens = TokenBucket(tpm)
+            self._cond.notify_all()
+
+    def acquire(self, priority, tokens):
+        """Attend son tour puis réserve une place, une requête et `tokens` tokens."""
+        with self._cond:
+            self._sequence += 1
+            ticket = (priority, self._sequence)
+            heapq.heappush(self._waiting, ticket)
+            start = time.monotonic()
+            try:
+                while True:
+                    now = time.monotonic()
+                    delay = None
+                    if self._waiting[0] == ticket and self._running < self.max_concurrency:
+                        delay = max(
+                            self._paused_until - now,
+                            self._requests.wait_time(1, now),
+                            self._tokens.wait_time(tokens, now),
+                        )
+                        if delay <= 0:
+                            heapq.heappop(self._waiting)
+                            self._requests.take(1)
+                            self._tokens.take(tokens)
+                            self._running += 1
+                            self.started += 1
+                            self.wait_seconds += now - start
+                            # Le suivant peut peut-être partir aussi
+                            self._cond.notify_all()
+                            return
+                    self._cond.wait(delay)
+            except BaseException:
+                self._waiting.remove(ticket)
+                heapq.heapify(self._waiting)
+                self._cond.notify_all()
+                raise
+
+    def release(self, reserved, used=None):
+        """Libère la place ; corrige le seau de tokens avec la consommation réelle si connue."""
+        with self._cond:
+            self._running -= 1
+            if used is not None:
+                if used < reserved:
+                    self._tokens.give(reserved - used)
+                else:
+                    self._tokens.take(used - reserved)
+            self._cond.notify_all()
+
+    def record_retry(self, error, delay):
+        with self._cond:
+            self.retries += 1
+            if isinstance(error, openai.RateLimitError):
+                self.rate_limited += 1
+                self._paused_until = max(self._paused_until, time.monotonic() + delay)
+                self._cond.notify_all()
+
+    def record_failure(self):
+        with self._cond:
+            self.failures += 1
+
+    def stats(self):
+        with self._cond:
+            return {
+                "running": self._running,
+                "queued": len(self._waiting),
+                "started": self.started,
+                "retries": self.retries,
+                "rate_limited": self.rate_limited,
+                "failures": self.failures,
+                "wait_seconds": round(self.wait_seconds, 3),
+            }
+
+def _mesurer_appel_openai(model, result, usage=None):
+    """Compte un appel OpenAI (une tentative) et les tokens consommés."""
+    metrics.inc("cctp_openai_requests_total", model=model, result=result)
+    if usage is not None:
+        metrics.inc("cctp_openai_tokens_total", getattr(usage, "prompt_tokens", 0) or 0, model=model, kind="prompt")
+        metrics.inc("cctp_openai_tokens_total", getattr(usage, "completion_tokens", 0) or 0, model=model, kind="completion")
+
+def _estimer_tokens(messages, model):
+    """Tokens à réserver pour une requête : messages (+4 par message) et réponse attendue."""
+    prompt_tokens = sum(_compter_tokens(str(m.get("content", "")), model) + 4 for m in messages)
+    return prompt_tokens + OPENAI_COMPLETION_RESERVE
+
+class OpenAIClient:
+    """Client OpenAI partagé : une session HTTP (pool de connexions) pour tous les appels.
+
+    Chaque appel passe par l'ordonnanceur, et les erreurs transitoires (429,
+    5xx, réseau) sont retentées avec un délai exponentiel à gigue aléatoire,
+    en respectant l'en-tête Retry-After.
+    """
+
+    def __init__(self, scheduler, base_url=None, api_key=None, timeout=OPENAI_TIMEOUT, max_retries=OPENAI_MAX_RETRIES):
+        self.scheduler = scheduler
+        self.base_url = base_url
+        self.api_key = api_key
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self._client = None
+        self._client_key = None
+        self._lock = threading.Lock()
+
+    def reset_after_fork(self):
+        """Dans un processus fils : ouvrir un nouveau pool de connexions HTTP."""
+        self._client = None
+        self._client_key = None
+        self._lock = threading.Lock()
+
+    def _get_client(self):
+        api_key = self.api_key or openai.api_key
+        with self._lock:
+            if self._client is None or self._client_key != api_key:
+                # Les reprises sont gérées ici, pas par le SDK
+                self._client = openai.OpenAI(api_key=api_key, base_url=self.base_url, timeout=self.timeout, max_retries=0)
+                self._client_key = api_key
+            return self._client
+
+    @staticmethod
+    def _retry_delay(attempt, error):
+        backoff = min(OPENAI_RETRY_MAX_DELAY, OPENAI_RETRY_BASE_DELAY * (2 ** attempt))
+        delay = random.uniform(0, backoff)
+        response = getattr(error, "response", None)
+        if response is not None:
+            try:
+                retry_after = float(response.headers.get("retry-after", ""))
+            except ValueError:
+                retry_after = None
+            if retry_after is not None:
+                # Petite gigue pour que les appels suspendus ne repartent pas ensemble
+                delay = min(OPENAI_RETRY_MAX_DELAY, retry_after) + random.uniform(0, OPENAI_RETRY_BASE_DELAY)
+        return delay
+
+    def _wait_before_retry(self, attempt, error):
+        """Vrai s'il faut retenter : note la reprise et attend si besoin."""
+        if attempt >= self.max_retries:
+            self.scheduler.record_failure()
+            metrics.inc("cctp_openai_errors_total", error=error.__class__.__name__)
+            return False
+        metrics.inc("cctp_openai_retries_total", error=error.__class__.__name__)
+        delay = self._retry_delay(attempt, error)
+        print(f"⚠️ Appel OpenAI en échec ({error.__class__.__name__}), nouvelle tentative dans {delay:.1f}s")
+        self.scheduler.record_retry(error, delay)
+        if not isinstance(error, openai.RateLimitError):
+            # Un 429 suspend déjà la file entière dans l'ordonnanceur
+            time.sleep(delay)
+        return True
+
+    def chat(self, model, messages, temperature=0.3, priority=PRIORITY_INTERACTIVE):
+        reserved = _estimer_tokens(messages, model)
+        attempt = 0
+        while True:
+            with metrics.span("openai_queue"):
+                self.scheduler.acquire(priority, reserved)
+            used = None
+            try:
+                with metrics.span("openai_request"):
+                    response = self._get_client().chat.completions.create(
+                        model=model,
+                        messages=messages,
+                        temperature=temperature,
+                    )
+                usage = getattr(response, "usage", None)
+                used = getattr(usage, "total_tokens", None)
+                _mesurer_appel_openai(model, "ok", usage)
+                return response
+            except OPENAI_RETRYABLE_ERRORS as e:
+                _mesurer_appel_openai(model, e.__class__.__name__)
+                error = e
+            except Exception as e:
+                _mesurer_appel_openai(model, e.__class__.__name__)
+                metrics.inc("cctp_openai_errors_total", error=e.__class__.__name__)
+                raise
+            finally:
+                self.scheduler.release(reserved, used)
+            if not self._wait_before_retry(attempt, error):
+                raise error
+            attempt += 1
+
+    def chat_stream(self, model, messages, temperature=0.3, priority=PRIORITY_INTERACTIVE):
+        """Fragments de texte de la réponse ; on ne retente que si rien n'a encore été produit."""
+        reserved = _estimer_tokens(messages, model)
+        attempt = 0
+        while True:
+            with metrics.span("openai_queue"):
+                self.scheduler.acquire(priority, reserved)
+            used = None
+            usage = None
+            started = False
+            stream = None
+            start = time.perf_counter()
+            try:
+                stream = self._get_client().chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    temperature=temperature,
+                    stream=True,
+                    stream_options={"include_usage": True},
+                )
+                for chunk in stream:
+                    if getattr(chunk, "usage", None) is not None:
+                        usage = chunk.usage
+                        used = usage.total_tokens
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        if not started:
+                            metrics.observe("cctp_stage_duration_seconds", time.perf_counter() - start, stage="openai_first_token")
+                        started = True
+                        yield delta
+                metrics.observe("cctp_stage_duration_seconds", time.perf_counter() - start, stage="openai_request")
+                _mesurer_appel_openai(model, "ok", usage)
+                return
+            except OPENAI_RETRYABLE_ERRORS as e:
+                _mesurer_appel_openai(model, e.__class__.__name__)
+                if started:
+                    self.scheduler.record_failure()
+                    metrics.inc("cctp_openai_errors_total", error=e.__class__.__name__)
+                    raise
+                error = e
+            except Exception as e:
+                _mesurer_appel_openai(model, e.__class__.__name__)
+                metrics.inc("cctp_openai_errors_total", error=e.__class__.__name__)
+                raise
+            finally:
+                if stream is not None:
+                    stream.close()
+                self.scheduler.release(reserved, used)
+            if not self._wait_before_retry(attempt, error):
+                raise error
+            attempt += 1
+
+openai_scheduler = OpenAIScheduler(OPENAI_RPM_LIMIT, OPENAI_TPM_LIMIT, OPENAI_MAX_CONCURRENCY)
+openai_client = OpenAIClient(openai_scheduler, base_url=OPENAI_BASE_URL)
+
+def openai_chat_completion(model, messages, temperature=0.3, priority=PRIORITY_INTERACTIVE):
+    """Appel de chat completion via le client partagé (quotas, priorité, reprises)."""
+    return openai_client.chat(model, messages, temperature, priority)
+
+def openai_chat_completion_stream(model, messages, temperature=0.3, priority=PRIORITY_INTERACTIVE):
+    """Variante en flux de openai_chat_completion : produit les fragments de texte."""
+    return openai_client.chat_stream(model, messages, temperature, priority)
+
+# --- FONCTIONS LOGIQUES (adaptées de votre script) ---
 
 def _get_base_prompt_generation():
     """Fonction qui contient le prompt de base de VF_LOW_TOKEN.py"""
@@ -263,7 +2134,7 @@ Réponds uniquement avec le prompt complet incluant la nouvelle instruction."""}
         ]
         
         response = openai_chat_completion(
-            model="gpt-4-1106-preview",
+            model=GENERATION_MODEL,
             messages=messages,
             temperature=0.3,
         )
@@ -276,38 +2147,100 @@ Réponds uniquement avec le prompt complet incluant la nouvelle instruction."""}
         # En cas d'erreur, ajouter simplement l'instruction à la fin
         return base_prompt + f"\n\n5.  **Instruction supplémentaire** : {modification_text}"
 
-def _construire_prompt_generation(nom_typo, titre_section_propre, notes_utilisateur, contexte_precedent, exemples_pertinents, custom_instruction):
-    # Obtenir le prompt de base de VF_LOW_TOKEN
-    base_instruction = _get_base_prompt_generation()
-    
-    # Obtenir le prompt système personnalisé s'il existe
-    system_prompt = load_system_prompt()
-    
-    # Si le prompt système n'est pas le prompt par défaut, cela signifie qu'il a été modifié
-    if system_prompt != DEFAULT_SYSTEM_PROMPT:
-        # Utiliser le prompt système personnalisé comme instruction de base
-        instruction_ia = system_prompt
-    else:
-        # Utiliser le prompt de base original
-        instruction_ia = base_instruction
+def _construire_prompt_generation(nom_typo, titre_section_propre, notes_utilisateur, contexte_precedent, exemples_pertinents, custom_instruction, prompt_id=None, prompt_version=None, model=GENERATION_MODEL):
+    """Construit le prompt de génération dans le budget de tokens du modèle.
+
+    Renvoie (prompt, détail des tokens par partie). Si le budget est dépassé,
+    les notes, le contexte puis les exemples (du moins pertinent au plus
+    pertinent) sont raccourcis, toujours à une fin de phrase. L'instruction
+    n'est jamais coupée : si elle ne tient pas à elle seule, le détail le
+    signale (`depasseBudget`).
+    """
+    # Prompt système (personnalisé ou défaut) ou variante nommée, depuis le registre en mémoire.
+    # Le prompt par défaut est identique au prompt de base de VF_LOW_TOKEN.
+    instruction_ia, _ = prompt_registry.get(prompt_id, prompt_version)
     
     # Ajouter la consigne spécifique pour cette section si elle existe
     if custom_instruction:
         instruction_ia += f"\n\nCONSIGNE SPÉCIFIQUE POUR CETTE SECTION: {custom_instruction}"
 
-    # Construire le prompt final avec les variables
-    base_prompt = (
-        f"{instruction_ia}\n\n"
-        f"---\n\n"
+    # Construire le prompt final avec les variables, partie par partie
+    budget = _budget_prompt(model)
+    instruction = f"{instruction_ia}\n\n---\n\n"
+    section = (
         f"**Typologie à décrire**: \"{nom_typo}\"\n"
         f"**Section à rédiger**: \"{titre_section_propre}\"\n\n"
-        f"**Notes de l'utilisateur pour cette section**:\n```\n{notes_utilisateur or 'Aucune note fournie.'}\n```\n\n"
-        f"**Contexte (structure des autres sections de la typologie)**:\n{contexte_precedent or 'Aucun.'}\n\n"
-        "**Exemples pertinents (extraits de CCTP existants)**:\n"
-        f"{_format_exemples_pour_prompt(exemples_pertinents) if exemples_pertinents else 'Aucun.'}\n"
     )
-    
-    return base_prompt
+    titre_exemples = "**Exemples pertinents (extraits de CCTP existants)**:\n"
+    tokens = {
+        "instruction": _compter_tokens(instruction, model),
+        "section": _compter_tokens(section, model),
+    }
+
+    # Les notes ne sont raccourcies que si elles ne tiennent pas, même sans contexte ni exemples
+    notes_tronquees = False
+    if notes_utilisateur:
+        enveloppe = _compter_tokens(
+            "**Notes de l'utilisateur pour cette section**:\n```\n\n```\n\n"
+            "**Contexte (structure des autres sections de la typologie)**:\nAucun.\n\n"
+            f"{titre_exemples}Aucun.\n", model
+        )
+        notes_courtes = _couper_aux_phrases(notes_utilisateur, max(0, budget - sum(tokens.values()) - enveloppe), model)
+        notes_tronquees = notes_courtes != notes_utilisateur
+        notes_utilisateur = notes_courtes
+    notes = f"**Notes de l'utilisateur pour cette section**:\n```\n{notes_utilisateur or 'Aucune note fournie.'}\n```\n\n"
+    tokens["notes"] = _compter_tokens(notes, model)
+    reste = budget - sum(tokens.values()) - _compter_tokens(titre_exemples + "Aucun.\n", model)
+
+    # Le contexte n'est raccourci que s'il ne tient pas, même sans exemples
+    contexte_tronque = False
+    if contexte_precedent:
+        enveloppe = _compter_tokens("**Contexte (structure des autres sections de la typologie)**:\n\n\n", model)
+        contexte_court = _couper_aux_phrases(contexte_precedent, max(0, reste - enveloppe), model)
+        contexte_tronque = contexte_court != contexte_precedent
+        contexte_precedent = contexte_court
+    contexte = f"**Contexte (structure des autres sections de la typologie)**:\n{contexte_precedent or 'Aucun.'}\n\n"
+    tokens["contexte"] = _compter_tokens(contexte, model)
+    reste = min(MAX_EXAMPLE_TOKENS, budget - sum(tokens.values()) - _compter_tokens(titre_exemples + "\n", model))
+
+    # Exemples par ordre de pertinence : le premier qui ne tient pas est coupé, les suivants écartés
+    retenus, details = [], []
+    for exemple in exemples_pertinents or []:
+        # Bloc de l'exemple tel que formaté dans le prompt, séparateur compris
+        cout = _compter_tokens(_format_exemples_pour_prompt([exemple]) + "\n\n", model)
+        tronque = cout > reste
+        if tronque:
+            entete = _format_exemples_pour_prompt([dict(exemple, texte="")]) + "\n\n"
+            texte = _couper_aux_phrases(exemple.get('texte', ''), reste - _compter_tokens(entete, model), model)
+            if not texte:
+                break
+            exemple = dict(exemple, texte=texte)
+            cout = _compter_tokens(_format_exemples_pour_prompt([exemple]) + "\n\n", model)
+        retenus.append(exemple)
+        details.append({"source": exemple.get('source', ''), "tokens": cout, "tronque": tronque})
+        reste -= cout
+        if tronque:
+            break
+    exemples = f"{titre_exemples}{_format_exemples_pour_prompt(retenus) if retenus else 'Aucun.'}\n"
+    tokens["exemples"] = _compter_tokens(exemples, model)
+
+    prompt = instruction + section + notes + contexte + exemples
+    total = _compter_tokens(prompt, model)
+    if total > budget:
+        print(f"AVERTISSEMENT: prompt de {total} tokens pour un budget de {budget} ({model}) : "
+              "l'instruction et la consigne spécifique ne tiennent pas dans le budget.")
+    return prompt, {
+        "model": model,
+        "tokenizer": _nom_tokenizer(model),
+        "budget": budget,
+        "total": total,
+        "depasseBudget": total > budget,
+        "parts": tokens,
+        "notesTronquees": notes_tronquees,
+        "contexteTronque": contexte_tronque,
+        "exemples": details,
+        "exemplesEcartes": len(exemples_pertinents or []) - len(retenus),
+    }
 
 def _construire_prompt_modification(action, nom_typo, titre_section_propre, texte_actuel_ia):
     action_map = {
@@ -325,8 +2258,8 @@ def _construire_prompt_modification(action, nom_typo, titre_section_propre, text
         "Ta réponse doit contenir UNIQUEMENT le texte modifié, sans titre ni introduction."
     )
 
-def _retrouver_exemples_pertinents(titre_section_cible, contenu_kb_json):
-    """Recherche des exemples pertinents dans la knowledge base JSON avec le nom de section d'origine"""
+def _retrouver_exemples_pertinents(titre_section_cible, contenu_kb_json, title_index=None, ranker=None, notes_utilisateur="", nom_typo=""):
+    """Recherche des exemples pertinents dans la knowledge base (SQLite ou JSON) avec le nom de section d'origine"""
     if not contenu_kb_json:
         return []
     
@@ -342,6 +2275,25 @@ def _retrouver_exemples_pertinents(titre_section_cible, contenu_kb_json):
         else:
             kb_data = contenu_kb_json
         
+        # Base SQLite : classement par pertinence, sinon recherche via l'index des titres
+        if isinstance(kb_data, KnowledgeBaseDB):
+            if ranker is not None:
+                entries = ranker.rank(titre_section_cible, notes_utilisateur, nom_typo)
+            elif title_index is not None:
+                entries = title_index.lookup(titre_section_cible)[:MAX_EXAMPLES_IN_PROMPT]
+            else:
+                return []
+            # Seules les sections retenues sont lues
+            contenus = kb_data.section_contents([section_id for section_id, _, _ in entries])
+            for section_id, filename, titre_section_original in entries:
+                exemples_trouves.append({
+                    "section": titre_section_cible,
+                    "section_originale": titre_section_original,
+                    "source": filename,
+                    "texte": contenus.get(section_id, '').strip()
+                })
+            return _limiter_exemples(exemples_trouves)
+        
         # Parcourir tous les fichiers dans la knowledge base
         for filename, typologies in kb_data.items():
             if not isinstance(typologies, list):
@@ -374,22 +2326,7 @@ def _retrouver_exemples_pertinents(titre_section_cible, contenu_kb_json):
         print(f"Erreur lors de la récupération des exemples: {e}")
         return []
     
-    # Limiter les exemples
-    limited_examples = []
-    total_chars = 0
-    for ex in exemples_trouves:
-        if len(limited_examples) >= MAX_EXAMPLES_IN_PROMPT:
-            break
-        if total_chars + len(ex["texte"]) > MAX_TOTAL_EXAMPLE_CHARS:
-            chars_to_add = MAX_TOTAL_EXAMPLE_CHARS - total_chars
-            if chars_to_add > 100:
-                ex["texte"] = ex["texte"][:chars_to_add] + "..."
-                limited_examples.append(ex)
-            break
-        limited_examples.append(ex)
-        total_chars += len(ex["texte"])
-    
-    return limited_examples
+    return _limiter_exemples(exemples_trouves)
 
 def _retrouver_exemples_pertinents_legacy(titre_section_cible, contenu_total_exemples):
     """Méthode de fallback pour l'ancien format de knowledge base"""
@@ -425,22 +2362,31 @@ def _retrouver_exemples_pertinents_legacy(titre_section_cible, contenu_total_exe
         print(f"Erreur lors de la récupération des exemples: {e}")
         return []
     
-    # Limiter les exemples
-    limited_examples = []
-    total_chars = 0
-    for ex in exemples_trouves:
-        if len(limited_examples) >= MAX_EXAMPLES_IN_PROMPT:
-            break
-        if total_chars + len(ex["texte"]) > MAX_TOTAL_EXAMPLE_CHARS:
-            chars_to_add = MAX_TOTAL_EXAMPLE_CHARS - total_chars
-            if chars_to_add > 100:
-                ex["texte"] = ex["texte"][:chars_to_add] + "..."
-                limited_examples.append(ex)
-            break
-        limited_examples.append(ex)
-        total_chars += len(ex["texte"])
-    
-    return limited_examples
+    return _limiter_exemples(exemples_trouves)
+
+def _limiter_exemples(exemples_trouves):
+    """Limite le nombre d'exemples pour le prompt (leur taille est limitée en tokens à la construction du prompt)."""
+    return exemples_trouves[:MAX_EXAMPLES_IN_PROMPT]
+
+def _couper_aux_phrases(text, max_tokens, model):
+    """Plus long début de `text` tenant en `max_tokens` tokens et finissant une phrase ('' sinon)."""
+    if _compter_tokens(text, model) <= max_tokens:
+        return text
+    ends = [m.start() for m in SENTENCE_END_PATTERN.finditer(text)]
+    # Le compte croît avec la longueur du début : recherche dichotomique
+    low, high, best = 0, len(ends) - 1, ""
+    while low <= high:
+        middle = (low + high) // 2
+        candidate = text[:ends[middle]].rstrip()
+        if _compter_tokens(candidate, model) <= max_tokens:
+            best = candidate
+            low = middle + 1
+        else:
+            high = middle - 1
+    return best
+
+def _budget_prompt(model):
+    return PROMPT_TOKEN_BUDGETS.get(model, PROMPT_TOKEN_BUDGET)
 
 def _format_exemples_pour_prompt(exemples):
     """Formate les exemples pour le prompt."""
@@ -457,52 +2403,201 @@ def _format_exemples_pour_prompt(exemples):
     
     return formatted.strip()
 
-def enrichir_bibliotheque_sections():
-    """Met à jour la bibliothèque de sections à partir des modèles existants."""
-    sections = set()
-    
-    try:
-        # Parcourir tous les modèles
-        for filename in os.listdir(MODELES_DIR):
-            if filename.endswith('.json'):
-                file_path = os.path.join(MODELES_DIR, filename)
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    project_data = json.load(f)
-                
-                # Extraire les titres de sections
-                for typologie in project_data:
-                    for section in typologie.get('sections', []):
-                        titre = section.get('titre', '').strip()
-                        if titre:
-                            sections.add(titre)
-        
-        # Sauvegarder la bibliothèque mise à jour
-        sections_list = sorted(list(sections))
-        with open(BIBLIOTHEQUE_SECTIONS_PATH, 'w', encoding='utf-8') as f:
-            json.dump(sections_list, f, indent=2, ensure_ascii=False)
-            
-    except Exception as e:
-        print(f"Erreur lors de l'enrichissement de la bibliothèque: {e}")
-        # Créer une bibliothèque vide si erreur
-        with open(BIBLIOTHEQUE_SECTIONS_PATH, 'w', encoding='utf-8') as f:
-            json.dump([], f)
+# --- BIBLIOTHÈQUE DE SECTIONS ---
+class _VerrouFichier:
+    """Verrou exclusif entre processus (fcntl.flock sur `path`) ; sans effet là où fcntl manque."""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def __enter__(self):
+        if fcntl is not None:
+            self._file = open(self.path, "a")
+            fcntl.flock(self._file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        if self._file is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+
+class SectionLibrary:
+    """Bibliothèque des titres de sections, tenue à jour modèle par modèle.
+
+    Chaque titre est compté par modèle : sauvegarder un modèle ne met à jour
+    que ses propres compteurs, et le fichier de la bibliothèque n'est réécrit
+    que si l'ensemble des titres a changé. L'index (compteurs + signature de
+    chaque fichier modèle) est conservé dans `index_path` ; au premier accès,
+    seuls les modèles modifiés hors de l'application sont relus. Si l'index a
+    été réécrit par un autre processus, il est relu avant toute mise à jour.
+    """
+
+    VERSION = 1
+
+    def __init__(self, models_dir, library_path, index_path):
+        self.models_dir = models_dir
+        self.library_path = library_path
+        self.index_path = index_path
+        self._lock = threading.Lock()
+        self._models = None
+        self._counts = Counter()
+        self._titles = []
+        self._index_signature = None
+
+    @staticmethod
+    def count_titles(project_data):
+        """Compteur des titres de sections (non vides) d'un projet."""
+        titles = Counter()
+        for typologie in project_data or []:
+            for section in typologie.get('sections', []):
+                titre = section.get('titre', '').strip()
+                if titre:
+                    titles[titre] += 1
+        return titles
+
+    @staticmethod
+    def _signature(path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return [st.st_size, st.st_mtime_ns]
+
+    def _model_path(self, model_name):
+        return os.path.join(self.models_dir, f"{model_name}.json")
+
+    def _read_model(self, model_name):
+        with open(self._model_path(model_name), 'r', encoding='utf-8') as f:
+            return self.count_titles(json.load(f))
+
+    def _read_index(self):
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if not isinstance(index, dict) or index.get("version") != self.VERSION:
+            return {}
+        return index.get("models", {})
+
+    def _write_json(self, path, data, **kwargs):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, **kwargs)
+        os.replace(tmp_path, path)
+
+    def _persist(self, titles_changed):
+        """Écrit l'index, et la bibliothèque si ses titres ont changé (sous verrou)."""
+        if titles_changed:
+            self._titles = sorted(self._counts)
+        try:
+            if titles_changed:
+                self._write_json(self.library_path, self._titles, indent=2)
+            self._write_json(self.index_path, {"version": self.VERSION, "models": self._models})
+            self._index_signature = self._signature(self.index_path)
+        except OSError as e:
+            # L'état en mémoire reste juste ; le fichier sera réécrit à la prochaine mise à jour
+            print(f"⚠️ Impossible d'enregistrer la bibliothèque de sections: {e}")
+
+    def _set_model(self, model_name, titles, signature):
+        """Remplace les compteurs d'un modèle ; vrai si l'ensemble des titres a changé."""
+        previous = self._models.pop(model_name, None)
+        old_titles = Counter(previous["titles"]) if previous else Counter()
+        changed = False
+        for titre in old_titles.keys() - titles.keys():
+            self._counts[titre] -= old_titles[titre]
+            if self._counts[titre] <= 0:
+                del self._counts[titre]
+                changed = True
+        for titre, count in titles.items():
+            if titre not in self._counts:
+                changed = True
+            self._counts[titre] += count - old_titles.get(titre, 0)
+        if signature is not None:
+            self._models[model_name] = {"signature": signature, "titles": dict(titles)}
+        return changed
+
+    def _sync(self, reset=False):
+        """Charge l'index et relit les modèles modifiés hors de l'application (sous verrou)."""
+        index = {} if reset else self._read_index()
+        self._models = {}
+        self._counts = Counter()
+        names = set()
+        try:
+            filenames = os.listdir(self.models_dir)
+        except OSError:
+            filenames = []
+        for filename in filenames:
+            if not filename.endswith('.json'):
+                continue
+            model_name = filename[:-5]
+            signature = self._signature(self._model_path(model_name))
+            entry = index.get(model_name)
+            if entry and entry.get("signature") == signature:
+                titles = Counter(entry.get("titles", {}))
+            else:
+                try:
+                    titles = self._read_model(model_name)
+                except (OSError, ValueError, AttributeError) as e:
+                    print(f"⚠️ Modèle '{model_name}' ignoré par la bibliothèque de sections: {e}")
+                    continue
+            names.add(model_name)
+            self._set_model(model_name, titles, signature)
+        titles = sorted(self._counts)
+        titles_changed = titles != self._read_library()
+        # Rien à réécrire si l'index était à jour
+        if reset or titles_changed or set(index) != names or any(
+                index[name].get("signature") != self._models[name]["signature"] for name in names):
+            self._persist(True)
+        else:
+            self._index_signature = self._signature(self.index_path)
+        self._titles = titles
+
+    def _read_library(self):
+        try:
+            with open(self.library_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _ensure_loaded(self):
+        if self._models is None or self._signature(self.index_path) != self._index_signature:
+            self._sync()
+
+    def titles(self):
+        """Liste triée des titres de sections de tous les modèles."""
+        with self._lock:
+            self._ensure_loaded()
+            return list(self._titles)
+
+    def update_model(self, model_name, titles):
+        """Prend en compte les titres (Counter) d'un modèle qui vient d'être écrit sur disque."""
+        with self._lock, _VerrouFichier(self.index_path + ".lock"):
+            self._ensure_loaded()
+            changed = self._set_model(model_name, titles, self._signature(self._model_path(model_name)))
+            self._persist(changed)
+
+    def rebuild(self):
+        """Reconstruit entièrement la bibliothèque en relisant tous les modèles."""
+        with self._lock, _VerrouFichier(self.index_path + ".lock"):
+            self._sync(reset=True)
+            return len(self._titles)
+
+section_library = SectionLibrary(MODELES_DIR, BIBLIOTHEQUE_SECTIONS_PATH, SECTION_LIBRARY_INDEX_PATH)
 
 def _render_cross_references_for_export(text, chapter_map):
     """Rend les références croisées pour l'export."""
     if not text:
         return ""
+    chapter_index = build_chapter_index(chapter_map)
     
     def replace_func(match):
-        nom_typo = match.group(1)
-        nom_section = match.group(2)
-        
-        for item in chapter_map:
-            if item['nom_typo'] == nom_typo and item['titre_section'] == nom_section:
-                return f"(voir section {item['number']} {nom_section})"
-        return f"(référence introuvable: {nom_typo}|{nom_section})"
+        return _texte_reference(chapter_index, match.group(2), match.group(3))
     
     # Transformer uniquement les références non encore transformées
-    return re.sub(CROSS_REF_PATTERN, replace_func, text)
+    return CROSS_REF_PATTERN.sub(replace_func, text)
 
 def _clean_text_for_export(text):
     """Nettoie le texte pour l'export en évitant les doublons."""
@@ -510,26 +2605,43 @@ def _clean_text_for_export(text):
         return ""
     
     # Supprimer toutes les balises HTML
-    text = re.sub(r'<[^>]+>', '', text)
+    text = HTML_TAG_PATTERN.sub('', text)
     
     # Nettoyer les entités HTML
     text = text.replace('&lt;', '<').replace('&gt;', '>')
     
     # Nettoyer les espaces multiples et les retours à la ligne multiples
-    text = re.sub(r'\s+', ' ', text)
-    text = re.sub(r'\n\s*\n', '\n\n', text)
-    
-    return text.strip()
+    return " ".join(text.split())
 
 # --- ROUTES DE L'API (les points d'accès pour le frontend) ---
 def get_kb_status():
     """Renvoie le statut de la base de connaissance."""
-    if os.path.exists(KNOWLEDGE_BASE_PATH):
-        mod_time = os.path.getmtime(KNOWLEDGE_BASE_PATH)
+    kb_path = next((p for p in (KNOWLEDGE_BASE_STORE_PATH, KNOWLEDGE_BASE_JSON_PATH, KNOWLEDGE_BASE_PATH) if os.path.exists(p)), None)
+    if kb_path:
+        mod_time = os.path.getmtime(kb_path)
         return f"Base analysée le {datetime.fromtimestamp(mod_time).strftime('%d/%m/%Y %H:%M')}"
     else:
         return "Base de connaissance non trouvée."
     
+@app.before_request
+def _debut_mesure_requete():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def _fin_mesure_requete(response):
+    # Pour une réponse en flux, la durée s'arrête à l'envoi des en-têtes
+    start = g.pop("request_start", None)
+    if start is not None:
+        route = request.url_rule.rule if request.url_rule is not None else "<inconnue>"
+        metrics.observe("cctp_http_request_duration_seconds", time.perf_counter() - start,
+                        route=route, method=request.method, status=response.status_code)
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Métriques au format texte de Prometheus (durées par route et par étape, appels et tokens OpenAI)."""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
 @app.route('/api/status', methods=['GET'])
 def get_status():
     """Route simple pour vérifier que le serveur est en ligne et si l'API key est configurée."""
@@ -537,9 +2649,350 @@ def get_status():
         "status": "online",
         "openai_configured": bool(openai.api_key),
         "docx_available": DOCX_AVAILABLE,
-        "knowledge_base_status": get_kb_status()
+        "knowledge_base_status": get_kb_status(),
+        "knowledge_base_cache": kb_store.stats(),
+        "export_cache": export_render_cache.stats(),
+        "openai_scheduler": openai_scheduler.stats()
     })
 
+@app.route('/api/knowledge-base/text', methods=['GET'])
+def get_knowledge_base_text():
+    """Renvoie la base de connaissances au format texte historique, produit à la volée."""
+    try:
+        contenu_kb = kb_store.get()
+    except Exception as e:
+        return jsonify({"error": f"Impossible de lire la base de connaissances: {str(e)}"}), 500
+    if isinstance(contenu_kb, str):
+        return Response(contenu_kb, mimetype='text/plain; charset=utf-8')
+    if not isinstance(contenu_kb, KnowledgeBaseDB):
+        return jsonify({"error": "Base de connaissance non trouvée."}), 404
+    return Response(contenu_kb.iter_legacy_text(), mimetype='text/plain; charset=utf-8')
+
+# --- STOCKAGE DES PROJETS ---
+# Délai (en secondes) entre la dernière modification d'un projet et son écriture sur disque
+PROJECT_SAVE_DELAY = float(os.getenv("CCTP_PROJECT_SAVE_DELAY", "1.0"))
+# Serveur multi-processus (même réglage que les exports, fixé par gunicorn.conf.py) :
+# chaque modification est écrite avant la réponse, sous un verrou commun aux processus
+PROJECT_SHARED_PROCESSES = os.getenv("CCTP_EXPORT_SHARED_JOBS", "0") == "1"
+PROJECT_LOCK_PATH = os.path.join(CACHE_DIR, "projects.lock")
+
+class ProjectPatchError(ValueError):
+    """Opération de modification invalide (chemin inconnu, index hors limites...)."""
+
+class ProjectVersionConflict(Exception):
+    """Le projet a changé depuis la version sur laquelle le client s'appuie."""
+
+    def __init__(self, version):
+        super().__init__(version)
+        self.version = version
+
+class ProjectStore:
+    """Copie en mémoire des projets (typologies + prévisualisations), écrite en différé.
+
+    Les modifications (opérations au format JSON-Patch sur "/project/..." et
+    "/previews/...") s'appliquent à la copie en mémoire ; l'écriture sur disque
+    a lieu `delay` secondes après la dernière modification, par fichier
+    temporaire + renommage. La version d'un projet est une empreinte de son
+    contenu, ce qui permet de détecter une sauvegarde basée sur un état périmé.
+
+    Avec plusieurs processus (serveur de production, `lock_path` donné),
+    chacun a sa copie : les modifications sont alors écrites avant de
+    répondre (pas d'écriture différée), sous un verrou entre processus, et
+    une copie est relue dès que les fichiers ont changé sur disque. Un
+    processus voit donc toujours la dernière version enregistrée, quel que
+    soit celui qui l'a reçue. L'empreinte étant calculée sur le contenu, tous
+    les processus donnent la même version au même état.
+
+    Avec un seul processus, une écriture différée dont les fichiers ont été
+    réécrits entre-temps par un autre programme est abandonnée.
+    """
+
+    ROOTS = {"project": list, "previews": dict}
+
+    def __init__(self, models_dir, previews_dir, delay, lock_path=None):
+        self.models_dir = models_dir
+        self.previews_dir = previews_dir
+        self.delay = delay
+        self.lock_path = lock_path
+        self._lock = threading.RLock()
+        self._projects = {}
+
+    @contextmanager
+    def _locked(self):
+        """Verrou du processus, plus le verrou entre processus en mode partagé."""
+        with self._lock:
+            if self.lock_path is None:
+                yield
+            else:
+                with _VerrouFichier(self.lock_path):
+                    yield
+
+    def reset_after_fork(self):
+        """Dans un processus fils : repartir sans copie ni verrou hérités."""
+        self._lock = threading.RLock()
+        self._projects = {}
+
+    @staticmethod
+    def _version(doc):
+        payload = json.dumps(doc, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:16]
+
+    def _signature(self, model_name):
+        signature = []
+        for path in self._paths(model_name).values():
+            try:
+                st = os.stat(path)
+                # Chaque écriture remplace le fichier (nouvel inode) : changement visible même dans la même milliseconde
+                signature.append((st.st_ino, st.st_mtime_ns, st.st_size))
+            except OSError:
+                signature.append(None)
+        return signature
+
+    def _paths(self, model_name):
+        return {
+            "project": os.path.join(self.models_dir, f"{model_name}.json"),
+            "previews": os.path.join(self.previews_dir, f"{model_name}_previews.json"),
+        }
+
+    def _load(self, model_name):
+        """Entrée en mémoire du projet, lue sur disque au premier accès (sous verrou)."""
+        entry = self._projects.get(model_name)
+        if entry is not None:
+            # Copie sans modification en attente : relire si un autre processus a écrit
+            if entry["dirty"] or self._signature(model_name) == entry["signature"]:
+                return entry
+            del self._projects[model_name]
+        paths = self._paths(model_name)
+        if not os.path.exists(paths["project"]):
+            return None
+        with open(paths["project"], 'r', encoding='utf-8') as f:
+            project_data = json.load(f)
+        previews_data = {}
+        if os.path.exists(paths["previews"]):
+            with open(paths["previews"], 'r', encoding='utf-8') as f:
+                previews_data = json.load(f)
+        doc = {"project": project_data, "previews": previews_data}
+        entry = {
+            "doc": doc,
+            "version": self._version(doc),
+            "dirty": set(),
+            "timer": None,
+            "signature": self._signature(model_name),
+        }
+        self._projects[model_name] = entry
+        return entry
+
+    def get(self, model_name):
+        """(projet, prévisualisations, version) ou None si le modèle n'existe pas.
+
+        Les données sont copiées sous verrou : une modification concurrente
+        (`apply`) ne peut ni les changer pendant leur sérialisation ni les
+        désaccorder de la version renvoyée.
+        """
+        with self._locked():
+            entry = self._load(model_name)
+            if entry is None:
+                return None
+            doc = copy.deepcopy(entry["doc"])
+            return doc["project"], doc["previews"], entry["version"]
+
+    def replace(self, model_name, project_data, previews_data):
+        """Remplace tout le projet et l'écrit immédiatement ; renvoie la nouvelle version."""
+        with self._locked():
+            entry = self._load(model_name)
+            if entry is None:
+                entry = {"doc": {}, "version": None, "dirty": set(), "timer": None, "signature": None}
+                self._projects[model_name] = entry
+            entry["doc"] = {"project": project_data, "previews": previews_data}
+            entry["version"] = self._version(entry["doc"])
+            entry["dirty"].update(self.ROOTS)
+            self._flush_entry(model_name, entry)
+            return entry["version"]
+
+    def apply(self, model_name, operations, base_version=None):
+        """Applique les opérations d'un seul tenant et planifie l'écriture ; renvoie la version.
+
+        Si une opération échoue, les précédentes sont annulées et le projet
+        reste inchangé. En mode partagé, le projet est écrit avant de rendre
+        la main.
+        """
+        titles = None
+        with self._locked():
+            entry = self._load(model_name)
+            if entry is None:
+                raise FileNotFoundError(model_name)
+            if base_version is not None and base_version != entry["version"]:
+                raise ProjectVersionConflict(entry["version"])
+            undo = []
+            touched = set()
+            try:
+                for operation in operations:
+                    undo.append(self._apply_operation(entry["doc"], operation))
+                    touched.add(self._parse_path(operation.get("path"))[0])
+            except Exception:
+                for revert in reversed(undo):
+                    revert()
+                raise
+            if touched:
+                entry["version"] = self._version(entry["doc"])
+                entry["dirty"].update(touched)
+                if self.lock_path is None:
+                    self._schedule(model_name, entry)
+                else:
+                    try:
+                        titles = self._write(model_name, entry)
+                    except OSError:
+                        # Copie non enregistrée : relue depuis le disque au prochain accès
+                        del self._projects[model_name]
+                        raise
+            version = entry["version"]
+        if titles is not None:
+            section_library.update_model(model_name, titles)
+        return version
+
+    @classmethod
+    def _parse_path(cls, path):
+        """Découpe un chemin JSON-Pointer ("/project/0/sections/2/titre") en segments."""
+        if not isinstance(path, str) or not path.startswith("/"):
+            raise ProjectPatchError(f"Chemin invalide : {path!r}")
+        tokens = [t.replace("~1", "/").replace("~0", "~") for t in path[1:].split("/")]
+        if tokens[0] not in cls.ROOTS:
+            raise ProjectPatchError(f"Chemin invalide : {path!r} (doit commencer par /project ou /previews)")
+        return tokens
+
+    @staticmethod
+    def _list_index(container, token, path, allow_end):
+        if allow_end and token == "-":
+            return len(container)
+        if not token.isdigit():
+            raise ProjectPatchError(f"Index invalide dans {path!r}")
+        index = int(token)
+        if index > len(container) or (index == len(container) and not allow_end):
+            raise ProjectPatchError(f"Index hors limites dans {path!r}")
+        return index
+
+    def _apply_operation(self, doc, operation):
+        """Applique une opération et renvoie la fonction qui l'annule."""
+        if not isinstance(operation, dict):
+            raise ProjectPatchError("Chaque opération doit être un objet.")
+        op = operation.get("op")
+        path = operation.get("path")
+        tokens = self._parse_path(path)
+        if op not in ("add", "replace", "remove"):
+            raise ProjectPatchError(f"Opération non supportée : {op!r}")
+        if op != "remove" and "value" not in operation:
+            raise ProjectPatchError(f"Valeur manquante pour {path!r}")
+        value = operation.get("value")
+
+        if len(tokens) == 1:
+            # Racine : seul le remplacement complet est possible, avec le bon type
+            if op != "replace" or not isinstance(value, self.ROOTS[tokens[0]]):
+                raise ProjectPatchError(f"Seul un remplacement complet est possible sur {path!r}")
+            old = doc[tokens[0]]
+            doc[tokens[0]] = value
+            return lambda: doc.__setitem__(tokens[0], old)
+
+        parent = doc
+        for token in tokens[:-1]:
+            if isinstance(parent, list):
+                parent = parent[self._list_index(parent, token, path, False)]
+            elif isinstance(parent, dict) and token in parent:
+                parent = parent[token]
+            else:
+                raise ProjectPatchError(f"Chemin introuvable : {path!r}")
+        key = tokens[-1]
+
+        if isinstance(parent, list):
+            index = self._list_index(parent, key, path, op == "add")
+            if op == "add":
+                parent.insert(index, value)
+                return lambda: parent.pop(index)
+            old = parent[index]
+            if op == "remove":
+                parent.pop(index)
+                return lambda: parent.insert(index, old)
+            parent[index] = value
+            return lambda: parent.__setitem__(index, old)
+
+        if not isinstance(parent, dict):
+            raise ProjectPatchError(f"Chemin introuvable : {path!r}")
+        if key not in parent:
+            if op != "add":
+                raise ProjectPatchError(f"Chemin introuvable : {path!r}")
+            parent[key] = value
+            return lambda: parent.pop(key)
+        old = parent[key]
+        if op == "remove":
+            del parent[key]
+        else:
+            parent[key] = value
+        return lambda: parent.__setitem__(key, old)
+
+    def _schedule(self, model_name, entry):
+        """(Re)programme l'écriture différée du projet (sous verrou)."""
+        if entry["timer"] is not None:
+            entry["timer"].cancel()
+        timer = threading.Timer(self.delay, self.flush, args=(model_name,))
+        timer.daemon = True
+        entry["timer"] = timer
+        timer.start()
+
+    def _flush_entry(self, model_name, entry):
+        """Écrit les fichiers modifiés du projet (sous verrou)."""
+        if entry["timer"] is not None:
+            entry["timer"].cancel()
+            entry["timer"] = None
+        paths = self._paths(model_name)
+        for root in sorted(entry["dirty"]):
+            tmp_path = paths[root] + ".tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(entry["doc"][root], f, indent=2, ensure_ascii=False)
+            os.replace(tmp_path, paths[root])
+            entry["dirty"].discard(root)
+        entry["signature"] = self._signature(model_name)
+
+    def _write(self, model_name, entry):
+        """Écrit le projet (sous verrou) ; renvoie le compte de ses titres s'ils ont pu changer, sinon None."""
+        project_changed = "project" in entry["dirty"]
+        self._flush_entry(model_name, entry)
+        return SectionLibrary.count_titles(entry["doc"]["project"]) if project_changed else None
+
+    def flush(self, model_name=None):
+        """Écrit sur disque les projets en attente (tous si `model_name` est None)."""
+        written = {}
+        with self._locked():
+            names = [model_name] if model_name is not None else list(self._projects)
+            for name in names:
+                entry = self._projects.get(name)
+                if entry is None or not entry["dirty"]:
+                    continue
+                if entry["signature"] is not None and self._signature(name) != entry["signature"]:
+                    # Un autre processus a enregistré ce projet depuis : sa version, plus récente, l'emporte
+                    print(f"⚠️ Sauvegarde différée du projet '{name}' abandonnée : modifié par un autre processus")
+                    entry["timer"] = None
+                    del self._projects[name]
+                    continue
+                try:
+                    titles = self._write(name, entry)
+                except OSError as e:
+                    print(f"⚠️ Sauvegarde différée du projet '{name}' impossible: {e}")
+                    self._schedule(name, entry)
+                    continue
+                if titles is not None:
+                    written[name] = titles
+        # Les titres de sections ont pu changer
+        for name, titles in written.items():
+            section_library.update_model(name, titles)
+
+    def pending(self):
+        with self._lock:
+            return sorted(name for name, entry in self._projects.items() if entry["dirty"])
+
+project_store = ProjectStore(MODELES_DIR, PREVIEWS_DIR, PROJECT_SAVE_DELAY,
+                             PROJECT_LOCK_PATH if PROJECT_SHARED_PROCESSES else None)
+# Ne pas perdre les modifications en attente à l'arrêt du serveur
+atexit.register(project_store.flush)
+
 @app.route('/api/models', methods=['GET'])
 def get_models():
     """Liste les modèles de projet (.json) disponibles dans le dossier modeles_cctp."""
@@ -561,60 +3014,252 @@ def create_model():
     if os.path.exists(file_path):
         return jsonify({"error": "Ce nom de modèle existe déjà."}), 409
 
-    try:
-        with open(file_path, 'w', encoding='utf-8') as f:
-            json.dump([], f) # Crée un projet avec une liste de typologies vide
-        return jsonify({"message": f"Modèle '{model_name}' créé avec succès."}), 201
-    except Exception as e:
-        return jsonify({"error": f"Impossible de créer le fichier modèle: {str(e)}"}), 500
+    try:
+        with open(file_path, 'w', encoding='utf-8') as f:
+            json.dump([], f) # Crée un projet avec une liste de typologies vide
+        return jsonify({"message": f"Modèle '{model_name}' créé avec succès."}), 201
+    except Exception as e:
+        return jsonify({"error": f"Impossible de créer le fichier modèle: {str(e)}"}), 500
+
+@app.route('/api/sections-library/rebuild', methods=['POST'])
+def rebuild_sections_library():
+    """Reconstruit la bibliothèque de sections en relisant tous les modèles."""
+    try:
+        project_store.flush()
+        count = section_library.rebuild()
+        return jsonify({"message": "Bibliothèque de sections reconstruite.", "sections": count})
+    except Exception as e:
+        return jsonify({"error": f"Erreur lors de la reconstruction de la bibliothèque: {str(e)}"}), 500
+
+@app.route('/api/data/<model_name>', methods=['GET'])
+def get_model_data(model_name):
+    """Charge les données d'un modèle (projet + prévisualisations)."""
+    try:
+        stored = project_store.get(model_name)
+        if stored is None:
+            return jsonify({"error": "Modèle non trouvé."}), 404
+        project_data, previews_data, version = stored
+        sections_library = section_library.titles()
+
+        return jsonify({"project": project_data, "previews": previews_data, "sectionsLibrary": sections_library, "version": version})
+    except Exception as e:
+        return jsonify({"error": f"Erreur de lecture des fichiers du modèle: {str(e)}"}), 500
+
+@app.route('/api/data/<model_name>', methods=['POST'])
+def save_model_data(model_name):
+    """Sauvegarde les données (projet + prévisualisations) pour un modèle donné."""
+    data = request.json
+    project_data = data.get('project')
+    previews_data = data.get('previews')
+
+    try:
+        version = project_store.replace(model_name, project_data, previews_data)
+        
+        # Mettre à jour la bibliothèque avec les nouvelles sections créées
+        section_library.update_model(model_name, SectionLibrary.count_titles(project_data))
+        
+        return jsonify({"message": "Projet sauvegardé avec succès.", "version": version})
+    except Exception as e:
+        return jsonify({"error": f"Erreur lors de la sauvegarde du projet: {str(e)}"}), 500
+
+@app.route('/api/data/<model_name>', methods=['PATCH'])
+def patch_model_data(model_name):
+    """Applique des opérations JSON-Patch (add, replace, remove) au projet en mémoire.
+
+    Corps : {"ops": [{"op": "replace", "path": "/previews/Lot 1/Généralités", "value": "..."}],
+    "baseVersion": 3}. L'écriture sur disque est différée de quelques instants.
+    """
+    data = request.json or {}
+    operations = data.get('ops')
+    if not isinstance(operations, list):
+        return jsonify({"error": "La liste d'opérations 'ops' est requise."}), 400
+
+    try:
+        version = project_store.apply(model_name, operations, data.get('baseVersion'))
+        return jsonify({"message": "Modifications enregistrées.", "version": version})
+    except FileNotFoundError:
+        return jsonify({"error": "Modèle non trouvé."}), 404
+    except ProjectVersionConflict as e:
+        return jsonify({"error": "Le projet a été modifié entre-temps, rechargez-le ou sauvegardez-le en entier.", "version": e.version}), 409
+    except ProjectPatchError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": f"Erreur lors de la sauvegarde du projet: {str(e)}"}), 500
+
+# --- GÉNÉRATION DE TEXTE ---
+GENERATION_ACTION = "génération du contenu..."
+GENERATION_TEMPERATURE = 0.3
+# Nombre maximal d'appels OpenAI simultanés pour une génération par lot
+BATCH_MAX_PARALLEL = int(os.getenv("CCTP_BATCH_MAX_PARALLEL", "4"))
+
+def clean_ai_output(text):
+    """Nettoyage du texte généré (robuste)."""
+    try:
+        lines = text.splitlines()
+        cleaned = []
+        for line in lines:
+            l = line.strip()
+            # Supprimer les séparateurs "---"
+            if l == "---":
+                continue
+            # Supprimer les titres en gras markdown (**TITRE**)
+            if re.match(r"^\*{2}.+\*{2}$", l):
+                continue
+            # Supprimer les titres tout en majuscules (hors phrases normales)
+            if l.isupper() and len(l) < 80:
+                continue
+            # Supprimer les titres type markdown (# ou ## ...)
+            if re.match(r"^#+\s", l):
+                continue
+            # Supprimer les lignes vides
+            if not l:
+                continue
+            cleaned.append(line)
+        return "\n".join(cleaned).strip()
+    except Exception as e:
+        print(f"[CCTP] Erreur nettoyage texte IA: {e}")
+        return text.strip() if text else ""
+
+class StreamingOutputCleaner:
+    """Applique `clean_ai_output` au fil de l'eau sur un texte reçu par fragments.
+
+    Une ligne est envoyée dès qu'on sait qu'aucune règle de nettoyage ne pourra
+    la supprimer (en pratique dès son premier caractère minuscule) ; seules la
+    ligne en cours et ses espaces de fin restent en mémoire. La concaténation
+    des fragments produits est identique à `clean_ai_output(texte.strip())`.
+    """
+
+    def __init__(self):
+        self._line = ""        # ligne en cours de réception
+        self._keep = None      # None : indécis, True : conservée, False : supprimée
+        self._sent = 0         # caractères de la ligne en cours déjà envoyés
+        self._pending = ""     # espaces de fin de la dernière ligne conservée
+        self._started = False  # au moins une ligne conservée a été envoyée
+
+    @staticmethod
+    def _decide(line, complete):
+        l = line.strip()
+        if complete:
+            return not (
+                not l or l == "---" or re.match(r"^\*{2}.+\*{2}$", l)
+                or (l.isupper() and len(l) < 80) or re.match(r"^#+\s", l)
+            )
+        if not l or "---".startswith(l) or l.startswith("*"):
+            return None
+        if l.startswith("#"):
+            rest = l.lstrip("#")
+            if not rest:
+                return None
+            if rest[0].isspace():
+                return False
+        if len(l) >= 80 or any(c.islower() for c in l):
+            return True
+        return None
+
+    def _emit(self, complete):
+        if self._keep is None:
+            self._keep = self._decide(self._line, complete)
+        if not self._keep:
+            return ""
+        out = ""
+        if self._sent == 0 and not self._started:
+            # Première ligne conservée : pas d'espaces en tête
+            self._sent = len(self._line) - len(self._line.lstrip())
+            self._started = True
+        elif self._sent == 0:
+            out = self._pending + "\n"
+            self._pending = ""
+        # Les espaces de fin sont retenus : ils disparaissent sur la dernière ligne
+        body_end = len(self._line.rstrip())
+        if body_end > self._sent:
+            out += self._line[self._sent:body_end]
+            self._sent = body_end
+        if complete:
+            self._pending = self._line[self._sent:]
+        return out
+
+    def _end_line(self):
+        out = self._emit(complete=True)
+        self._line, self._keep, self._sent = "", None, 0
+        return out
+
+    def feed(self, fragment):
+        """Ajoute un fragment et renvoie le texte nettoyé envoyable tout de suite."""
+        out = []
+        parts = fragment.split("\n")
+        for i, part in enumerate(parts):
+            self._line += part
+            out.append(self._end_line() if i < len(parts) - 1 else self._emit(complete=False))
+        return "".join(out)
 
-@app.route('/api/data/<model_name>', methods=['GET'])
-def get_model_data(model_name):
-    """Charge les données d'un modèle (projet + prévisualisations)."""
-    project_path = os.path.join(MODELES_DIR, f"{model_name}.json")
-    previews_path = os.path.join(PREVIEWS_DIR, f"{model_name}_previews.json")
+    def finish(self):
+        """Termine le flux et renvoie le reste du texte nettoyé."""
+        return self._end_line()
 
-    if not os.path.exists(project_path):
-        return jsonify({"error": "Modèle non trouvé."}), 404
+def _preparer_generation(nom_typo, section_data):
+    """Recherche les exemples et construit (prompt, modèle, détail des tokens) pour une section.
 
-    try:
-        with open(project_path, 'r', encoding='utf-8') as f:
-            project_data = json.load(f)
-        
-        previews_data = {}
-        if os.path.exists(previews_path):
-            with open(previews_path, 'r', encoding='utf-8') as f:
-                previews_data = json.load(f)
-        
-        with open(BIBLIOTHEQUE_SECTIONS_PATH, 'r', encoding='utf-8') as f:
-            sections_library = json.load(f)
+    `promptId` / `promptVersion` sélectionnent une variante du registre des
+    prompts. Lève KeyError si le titre de la section est absent, et
+    UnknownPromptError si le prompt demandé n'existe pas.
+    """
+    titre_section = section_data['titreSection']
+    notes_utilisateur = section_data.get('notes', '')
+    texte_actuel_ia = section_data.get('texteActuel', '')
+    action = section_data.get('action', GENERATION_ACTION)
+    contexte_summarized = section_data.get('contexteSummarized', '')
+    custom_instruction = section_data.get('customInstruction', '')
+    prompt_id = section_data.get('promptId')
+    prompt_version = section_data.get('promptVersion')
 
-        return jsonify({"project": project_data, "previews": previews_data, "sectionsLibrary": sections_library})
-    except Exception as e:
-        return jsonify({"error": f"Erreur de lecture des fichiers du modèle: {str(e)}"}), 500
+    if action != GENERATION_ACTION:
+        with metrics.span("prompt_build"):
+            prompt = _construire_prompt_modification(action, nom_typo, titre_section, texte_actuel_ia)
+        total = _compter_tokens(prompt, MODIFICATION_MODEL)
+        # Le texte à retoucher est envoyé en entier : le budget n'est que signalé
+        tokens = {
+            "model": MODIFICATION_MODEL,
+            "tokenizer": _nom_tokenizer(MODIFICATION_MODEL),
+            "budget": _budget_prompt(MODIFICATION_MODEL),
+            "total": total,
+            "depasseBudget": total > _budget_prompt(MODIFICATION_MODEL),
+        }
+        return prompt, MODIFICATION_MODEL, tokens
 
-@app.route('/api/data/<model_name>', methods=['POST'])
-def save_model_data(model_name):
-    """Sauvegarde les données (projet + prévisualisations) pour un modèle donné."""
-    data = request.json
-    project_data = data.get('project')
-    previews_data = data.get('previews')
+    # Knowledge base en cache (JSON, ou format texte en fallback)
+    with metrics.span("knowledge_base"):
+        contenu_kb, kb_index, kb_ranker = kb_store.get_search()
+    with metrics.span("example_retrieval"):
+        exemples = _retrouver_exemples_pertinents(titre_section, contenu_kb, kb_index, kb_ranker, notes_utilisateur, nom_typo)
+    with metrics.span("prompt_build"):
+        prompt, tokens = _construire_prompt_generation(nom_typo, titre_section, notes_utilisateur, contexte_summarized, exemples, custom_instruction, prompt_id, prompt_version, GENERATION_MODEL)
+    return prompt, GENERATION_MODEL, tokens
 
-    project_path = os.path.join(MODELES_DIR, f"{model_name}.json")
-    previews_path = os.path.join(PREVIEWS_DIR, f"{model_name}_previews.json")
+def _generer_texte(prompt, model_to_use, force=False, priority=PRIORITY_INTERACTIVE):
+    """Appelle OpenAI et renvoie le texte nettoyé (chaîne vide si rien).
 
-    try:
-        with open(project_path, 'w', encoding='utf-8') as f:
-            json.dump(project_data, f, indent=2, ensure_ascii=False)
-        with open(previews_path, 'w', encoding='utf-8') as f:
-            json.dump(previews_data, f, indent=2, ensure_ascii=False)
-        
-        # Mettre à jour la bibliothèque avec les nouvelles sections créées
-        enrichir_bibliotheque_sections()
-        
-        return jsonify({"message": "Projet sauvegardé avec succès."})
-    except Exception as e:
-        return jsonify({"error": f"Erreur lors de la sauvegarde du projet: {str(e)}"}), 500
+    Le résultat est lu dans le cache des générations sauf si `force` est vrai ;
+    il y est toujours enregistré. `priority` place l'appel dans la file OpenAI.
+    """
+    cache_key = GenerationCache.make_key(model_to_use, GENERATION_TEMPERATURE, prompt)
+    if not force:
+        cached = generation_cache.get(cache_key)
+        metrics.inc("cctp_generation_cache_total", result="miss" if cached is None else "hit")
+        if cached is not None:
+            return cached
+
+    response = openai_chat_completion(
+        model=model_to_use,
+        messages=[{"role": "user", "content": prompt}],
+        temperature=GENERATION_TEMPERATURE,
+        priority=priority,
+    )
+    with metrics.span("clean_output"):
+        texte_genere = clean_ai_output(response.choices[0].message.content.strip())
+    # Si le texte est vide, retourne une chaîne vide proprement
+    texte_genere = texte_genere or ""
+    generation_cache.put(cache_key, model_to_use, prompt, texte_genere)
+    return texte_genere
 
 @app.route('/api/generate', methods=['POST'])
 def handle_generation():
@@ -624,223 +3269,823 @@ def handle_generation():
     
     data = request.json
     try:
-        # Extraire les données nécessaires de la requête
-        nom_typo = data['nomTypo']
-        titre_section = data['titreSection']
-        notes_utilisateur = data.get('notes', '')
-        texte_actuel_ia = data.get('texteActuel', '')
-        action = data.get('action', 'génération du contenu...')
-        contexte_summarized = data.get('contexteSummarized', '')
-        custom_instruction = data.get('customInstruction', '')
-
-        contenu_kb = {}
-        # Charger la knowledge base JSON
-        kb_json_path = os.path.join(KNOWLEDGE_BASE_DIR, "knowledge_base.json")
-        if os.path.exists(kb_json_path):
-            with open(kb_json_path, "r", encoding="utf-8") as f:
-                contenu_kb = json.load(f)
-        # Fallback vers le format texte si JSON n'existe pas
-        elif os.path.exists(KNOWLEDGE_BASE_PATH):
-            with open(KNOWLEDGE_BASE_PATH, "r", encoding="utf-8") as f:
-                contenu_kb = f.read()
-        
-        exemples = _retrouver_exemples_pertinents(titre_section, contenu_kb)
+        prompt, model_to_use, tokens = _preparer_generation(data['nomTypo'], data)
+        return jsonify({"text": _generer_texte(prompt, model_to_use, force=bool(data.get('force'))), "tokens": tokens})
 
-        if action == "génération du contenu...":
-            prompt = _construire_prompt_generation(nom_typo, titre_section, notes_utilisateur, contexte_summarized, exemples, custom_instruction)
-            model_to_use = "gpt-4-1106-preview"
-        else:
-            prompt = _construire_prompt_modification(action, nom_typo, titre_section, texte_actuel_ia)
-            model_to_use = "gpt-3.5-turbo-0125"
+    except UnknownPromptError as e:
+        return jsonify({"error": f"Prompt introuvable : {e}"}), 404
+    except KeyError as e:
+        print(f"[CCTP] Erreur KeyError: {e}")
+        return jsonify({"error": f"Donnée manquante dans la requête: {e}"}), 400
+    except openai.RateLimitError as e:
+        print(f"[CCTP] Quota OpenAI dépassé malgré les nouvelles tentatives: {e}")
+        return jsonify({"error": "Quota OpenAI atteint, réessayez dans quelques instants."}), 429
+    except Exception as e:
+        print(f"[CCTP] Erreur lors de la génération OpenAI: {e}")
+        return jsonify({"error": f"Erreur lors de la génération OpenAI: {str(e)}"}), 500
 
-        response = openai_chat_completion(
-            model=model_to_use,
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.3,
-        )
-        texte_genere = response.choices[0].message.content.strip()
+def _sse_event(event, payload):
+    """Formate un événement Server-Sent Events."""
+    return f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
 
-        # --- Nettoyage du texte généré (robuste) ---
-        def clean_ai_output(text):
-            try:
-                lines = text.splitlines()
-                cleaned = []
-                for line in lines:
-                    l = line.strip()
-                    # Supprimer les séparateurs "---"
-                    if l == "---":
-                        continue
-                    # Supprimer les titres en gras markdown (**TITRE**)
-                    if re.match(r"^\*{2}.+\*{2}$", l):
-                        continue
-                    # Supprimer les titres tout en majuscules (hors phrases normales)
-                    if l.isupper() and len(l) < 80:
-                        continue
-                    # Supprimer les titres type markdown (# ou ## ...)
-                    if re.match(r"^#+\s", l):
-                        continue
-                    # Supprimer les lignes vides
-                    if not l:
-                        continue
-                    cleaned.append(line)
-                return "\n".join(cleaned).strip()
-            except Exception as e:
-                print(f"[CCTP] Erreur nettoyage texte IA: {e}")
-                return text.strip() if text else ""
+@app.route('/api/generate/stream', methods=['POST'])
+def handle_generation_stream():
+    """Variante en flux (Server-Sent Events) de /api/generate.
 
-        texte_genere = clean_ai_output(texte_genere)
-        # Si le texte est vide, retourne une chaîne vide proprement
-        if texte_genere is None:
-            texte_genere = ""
-        return jsonify({"text": texte_genere})
+    Événements : `token` ({"text": fragment nettoyé}) au fil de la génération,
+    puis `done` ({"cached": ..., "tokens": détail du prompt}), ou `error`
+    ({"error": message}) en cas d'échec.
+    """
+    if not openai.api_key:
+        return jsonify({"error": "La clé API OpenAI n'est pas configurée sur le serveur."}), 503
 
+    data = request.json
+    try:
+        prompt, model_to_use, tokens = _preparer_generation(data['nomTypo'], data)
+        cache_key = GenerationCache.make_key(model_to_use, GENERATION_TEMPERATURE, prompt)
+        cached = None if data.get('force') else generation_cache.get(cache_key)
+    except UnknownPromptError as e:
+        return jsonify({"error": f"Prompt introuvable : {e}"}), 404
     except KeyError as e:
         print(f"[CCTP] Erreur KeyError: {e}")
         return jsonify({"error": f"Donnée manquante dans la requête: {e}"}), 400
     except Exception as e:
-        print(f"[CCTP] Erreur lors de la génération OpenAI: {e}")
+        print(f"[CCTP] Erreur lors de la préparation de la génération: {e}")
         return jsonify({"error": f"Erreur lors de la génération OpenAI: {str(e)}"}), 500
 
-@app.route('/api/export/pdf', methods=['POST'])
-def export_pdf():
-    """Génère un fichier PDF à partir des données du projet et le renvoie pour téléchargement."""
-    data = request.json
+    if not data.get('force'):
+        metrics.inc("cctp_generation_cache_total", result="miss" if cached is None else "hit")
+
+    def events():
+        if cached is not None:
+            if cached:
+                yield _sse_event("token", {"text": cached})
+            yield _sse_event("done", {"cached": True, "tokens": tokens})
+            return
+        cleaner = StreamingOutputCleaner()
+        # Texte nettoyé déjà envoyé, conservé pour le cache
+        sent = []
+        try:
+            for fragment in openai_chat_completion_stream(
+                model=model_to_use,
+                messages=[{"role": "user", "content": prompt}],
+                temperature=GENERATION_TEMPERATURE,
+            ):
+                text = cleaner.feed(fragment)
+                if text:
+                    sent.append(text)
+                    yield _sse_event("token", {"text": text})
+            text = cleaner.finish()
+            if text:
+                sent.append(text)
+                yield _sse_event("token", {"text": text})
+            generation_cache.put(cache_key, model_to_use, prompt, "".join(sent))
+            yield _sse_event("done", {"cached": False, "tokens": tokens})
+        except Exception as e:
+            print(f"[CCTP] Erreur lors de la génération OpenAI: {e}")
+            yield _sse_event("error", {"error": f"Erreur lors de la génération OpenAI: {str(e)}"})
+
+    return Response(events(), mimetype='text/event-stream', headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+    })
+
+@app.route('/api/generate/batch', methods=['POST'])
+def handle_batch_generation():
+    """Génère toutes les sections d'une typologie en parallèle.
+
+    Corps attendu : {"nomTypo": ..., "sections": [{"titreSection": ..., "notes": ...,
+    "contexteSummarized": ..., "customInstruction": ...}, ...], "maxParallel": 4, "force": false}.
+    La réponse est un flux NDJSON : une ligne par section, dans l'ordre de fin
+    des appels, puis une ligne finale {"done": true, ...}.
+    """
+    if not openai.api_key:
+        return jsonify({"error": "La clé API OpenAI n'est pas configurée sur le serveur."}), 503
+
+    data = request.json or {}
+    nom_typo = data.get('nomTypo')
+    sections = data.get('sections') or []
+    if not nom_typo or not isinstance(sections, list) or not sections:
+        return jsonify({"error": "Les champs 'nomTypo' et 'sections' sont requis."}), 400
+    invalid = [index for index, section_data in enumerate(sections) if not isinstance(section_data, dict)]
+    if invalid:
+        return jsonify({"error": f"Chaque élément de 'sections' doit être un objet (indices invalides : {invalid})."}), 400
+    try:
+        max_parallel = int(data.get('maxParallel', BATCH_MAX_PARALLEL))
+    except (TypeError, ValueError):
+        return jsonify({"error": "'maxParallel' doit être un entier."}), 400
+    max_parallel = max(1, min(max_parallel, BATCH_MAX_PARALLEL, len(sections)))
+    force = bool(data.get('force'))
+
+    # Recherche d'exemples et construction des prompts, une fois par section
+    jobs, errors = [], []
+    for index, section_data in enumerate(sections):
+        titre_section = section_data.get('titreSection', '')
+        try:
+            prompt, model_to_use, tokens = _preparer_generation(nom_typo, section_data)
+            jobs.append((index, titre_section, prompt, model_to_use, tokens))
+        except UnknownPromptError as e:
+            errors.append({"index": index, "titreSection": titre_section, "error": f"Prompt introuvable : {e}"})
+        except KeyError as e:
+            errors.append({"index": index, "titreSection": titre_section, "error": f"Donnée manquante dans la requête: {e}"})
+        except Exception as e:
+            print(f"[CCTP] Erreur lors de la préparation de la section {index}: {e}")
+            errors.append({"index": index, "titreSection": titre_section, "error": f"Erreur lors de la préparation de la section: {e}"})
+
+    def generate():
+        completed = 0
+        for error in errors:
+            yield json.dumps(error, ensure_ascii=False) + "\n"
+        executor = ThreadPoolExecutor(max_workers=max_parallel)
+        try:
+            futures = {
+                executor.submit(_generer_texte, prompt, model_to_use, force, PRIORITY_BULK): (index, titre_section, tokens)
+                for index, titre_section, prompt, model_to_use, tokens in jobs
+            }
+            for future in as_completed(futures):
+                index, titre_section, tokens = futures[future]
+                try:
+                    line = {"index": index, "titreSection": titre_section, "text": future.result(), "tokens": tokens}
+                    completed += 1
+                except Exception as e:
+                    print(f"[CCTP] Erreur lors de la génération OpenAI ({titre_section}): {e}")
+                    line = {"index": index, "titreSection": titre_section, "error": f"Erreur lors de la génération OpenAI: {str(e)}"}
+                yield json.dumps(line, ensure_ascii=False) + "\n"
+        finally:
+            # Client déconnecté ou fin normale : annuler ce qui n'a pas démarré
+            executor.shutdown(wait=False, cancel_futures=True)
+        yield json.dumps({"done": True, "completed": completed, "total": len(sections)}) + "\n"
+
+    return Response(generate(), mimetype='application/x-ndjson')
+
+@app.route('/api/generation-cache', methods=['GET'])
+def get_generation_cache_stats():
+    """Statistiques du cache des générations (succès, échecs, octets économisés)."""
+    return jsonify(generation_cache.stats())
+
+@app.route('/api/generation-cache', methods=['DELETE'])
+def clear_generation_cache():
+    """Vide le cache des générations."""
+    generation_cache.clear()
+    return jsonify({"message": "Cache des générations vidé."})
+
+def _preparer_export(data):
+    """Lit une demande d'export : (projet, aperçus, index des chapitres, notes IA).
+
+    L'index des numéros de chapitres est construit une seule fois par demande,
+    à partir du `chapterMap` envoyé par le client ou, à défaut, du projet.
+    """
     project_data = data.get('project', [])
     previews_data = data.get('previews', {})
-    chapter_map = data.get('chapterMap', [])
+    chapter_map = data.get('chapterMap') or compute_chapter_map(project_data)
     include_ai_notes = data.get('includeAiNotes', True)  # Par défaut, inclure les notes IA
+    return project_data, previews_data, build_chapter_index(chapter_map), include_ai_notes
 
-    try:
-        pdf_path = os.path.join(BASE_DIR, 'cctp_export.pdf')
-        pdf = PDF('P', 'mm', 'A4', chapter_map=chapter_map)
-        pdf.alias_nb_pages()
-        pdf.set_auto_page_break(auto=True, margin=15)
-        pdf.add_page()
-        
+# --- CACHE DES RENDUS D'EXPORT ---
+# Taille maximale (en Mo) des fragments d'export gardés en mémoire
+EXPORT_CACHE_MAX_MB = float(os.getenv("CCTP_EXPORT_CACHE_MAX_MB", "32"))
+
+class ExportRenderCache:
+    """Cache LRU en mémoire (octets) des rendus d'export, partagé par tout le processus.
+
+    Les clés sont des empreintes du contenu effectivement rendu : une entrée
+    n'est jamais périmée, elle finit simplement par être évincée.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(*parts):
+        return hashlib.sha256(json.dumps(parts, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value[0]
+
+    def put(self, key, value, size):
+        """Ajoute `value` (occupant `size` octets) puis évince les entrées les plus anciennes."""
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= previous[1]
+            self._entries[key] = (value, size)
+            self._size += size
+            while self._size > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._size -= evicted_size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "size_bytes": self._size,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+export_render_cache = ExportRenderCache(int(EXPORT_CACHE_MAX_MB * 1024 * 1024))
+
+def _preparer_typologie_export(typo_data, previews_data, chapter_index, include_ai_notes):
+    """Contenu exporté d'une typologie : (nom, blocs) ou None si elle n'a aucun texte.
+
+    Chaque bloc vaut [numéro, titre, texte principal, placeholders, exemples,
+    références croisées] : c'est exactement ce que les exporteurs écrivent.
+    """
+    nom_typo = typo_data.get("nomTypologie")
+    typo_previews = previews_data.get(nom_typo, {})
+    if not any(typo_previews.values()):
+        return None
+    blocs = []
+    for section in typo_data.get("sections", []):
+        titre_section = section.get("titre")
+        texte_genere = typo_previews.get(titre_section)
+        if texte_genere:
+            num_chapitre = chapter_index.get((nom_typo, titre_section), "")
+            # Séparer les parties du texte
+            main_text, placeholders, exemples, crossrefs = extract_parts_for_export(texte_genere, chapter_index, include_ai_notes)
+            blocs.append([num_chapitre, titre_section, main_text, placeholders, exemples, crossrefs])
+    return nom_typo, blocs
+
+def _typologies_export(project_data, previews_data, chapter_index, include_ai_notes):
+    """(index, nom, blocs, empreinte) des typologies à exporter, dans l'ordre du projet."""
+    typologies = []
+    with metrics.span("export_extract_parts"):
         for typo_idx, typo_data in enumerate(project_data):
-            nom_typo = typo_data.get("nomTypologie")
-            typo_previews = previews_data.get(nom_typo, {})
-            if not any(typo_previews.values()): 
+            prepared = _preparer_typologie_export(typo_data, previews_data, chapter_index, include_ai_notes)
+            if prepared is None:
                 continue
-            if pdf.get_y() > 230 and pdf.page_no() > 0: 
-                pdf.add_page()
-            pdf.add_typology_title(typo_idx, nom_typo)
-            for section in typo_data.get("sections", []):
-                titre_section = section.get("titre")
-                num_chapitre = next((item['number'] for item in chapter_map 
-                                   if item['nom_typo'] == nom_typo and item['titre_section'] == titre_section), "")
-                texte_genere = typo_previews.get(titre_section)
-                if texte_genere:
-                    if pdf.get_y() > 250: 
-                        pdf.add_page()
-                    pdf.add_section_title(num_chapitre, titre_section)
-                    
-                    # Séparer les parties du texte
-                    main_text, placeholders, exemples, crossrefs = extract_parts_for_export(texte_genere, chapter_map, include_ai_notes)
-                    
-                    # Écrire le texte principal
-                    if main_text:
-                        pdf.add_body_text(main_text)
-                    
-                    # Ajouter les éléments supplémentaires s'ils existent et si demandé
-                    if include_ai_notes:
-                        if placeholders:
-                            pdf.add_body_text("\nÀ compléter :")
-                            for placeholder in placeholders:
-                                pdf.add_body_text(f"• {placeholder}")
-                        
-                        if exemples:
-                            pdf.add_body_text("\nExemples :")
-                            for exemple in exemples:
-                                pdf.add_body_text(f"• {exemple}")
-                    
-                    if crossrefs:
-                        pdf.add_body_text("\nRéférences croisées :")
-                        for crossref in crossrefs:
-                            pdf.add_body_text(f"• {crossref}")
-        pdf.output(pdf_path)
-        return send_file(pdf_path, as_attachment=True, download_name=f"CCTP_{datetime.now().strftime('%Y%m%d')}.pdf")
-    except Exception as e:
-        print(f"Erreur d'export PDF: {e}")
-        return jsonify({"error": f"Erreur lors de la génération du PDF: {str(e)}"}), 500
+            nom_typo, blocs = prepared
+            digest = ExportRenderCache.make_key(typo_idx, nom_typo, include_ai_notes, blocs)
+            typologies.append((typo_idx, nom_typo, blocs, digest))
+    return typologies
 
-@app.route('/api/export/docx', methods=['POST'])
-def export_word():
-    """Génère un fichier Word et le renvoie pour téléchargement."""
-    if not DOCX_AVAILABLE:
-        return jsonify({"error": "La librairie pour l'export Word (python-docx) n'est pas installée sur le serveur."}), 501
+# Pied de page ajouté après l'assemblage : police standard (non embarquée), 8 pt,
+# centré et à la même hauteur que `PDF.footer` (ligne de base à ~10 mm du bas)
+PDF_FOOTER_FONT = "Helvetica"
+PDF_FOOTER_SIZE = 8
+PDF_FOOTER_BASELINE_MM = 10.15
+
+def _render_pdf_typologie(pdf, typo_idx, nom_typo, blocs, include_ai_notes):
+    """Ajoute une typologie (titre et sections) à la fin du document."""
+    pdf.add_typology_title(typo_idx, nom_typo)
+    for num_chapitre, titre_section, main_text, placeholders, exemples, crossrefs in blocs:
+        if pdf.get_y() > 250: 
+            pdf.add_page()
+        pdf.add_section_title(num_chapitre, titre_section)
     
-    data = request.json
-    project_data = data.get('project', [])
-    previews_data = data.get('previews', {})
-    chapter_map = data.get('chapterMap', [])
-    include_ai_notes = data.get('includeAiNotes', True)  # Par défaut, inclure les notes IA
+        # Écrire le texte principal
+        if main_text:
+            pdf.add_body_text(main_text)
+    
+        # Ajouter les éléments supplémentaires s'ils existent et si demandé
+        if include_ai_notes:
+            if placeholders:
+                pdf.add_body_text("\nÀ compléter :")
+                for placeholder in placeholders:
+                    pdf.add_body_text(f"• {placeholder}")
+        
+            if exemples:
+                pdf.add_body_text("\nExemples :")
+                for exemple in exemples:
+                    pdf.add_body_text(f"• {exemple}")
+    
+        if crossrefs:
+            pdf.add_body_text("\nRéférences croisées :")
+            for crossref in crossrefs:
+                pdf.add_body_text(f"• {crossref}")
 
-    try:
-        word_path = os.path.join(BASE_DIR, 'cctp_export.docx')
-        doc = Document()
-        style = doc.styles['Normal']
-        font = style.font
-        font.name = 'Calibri'
-        font.size = Pt(11)
+def _new_pdf_fragment():
+    """Document PDF vierge, sans numéros de page, prêt pour une typologie."""
+    pdf = PDF('P', 'mm', 'A4', page_numbers=False)
+    pdf.set_auto_page_break(auto=True, margin=15)
+    pdf.add_page()
+    return pdf
+
+def _pdf_fragment(typo_idx, nom_typo, blocs, include_ai_notes, digest):
+    """PDF (octets) des pages d'une typologie, depuis le cache si possible.
+
+    Une typologie commence toujours sur une nouvelle page : son rendu ne
+    dépend ni des typologies précédentes ni du nombre total de pages.
+    """
+    cache_key = ExportRenderCache.make_key("pdf", digest)
+    fragment = export_render_cache.get(cache_key)
+    if fragment is None:
+        pdf = _new_pdf_fragment()
+        _render_pdf_typologie(pdf, typo_idx, nom_typo, blocs, include_ai_notes)
+        fragment = bytes(pdf.output())
+        export_render_cache.put(cache_key, fragment, len(fragment))
+    return fragment
+
+def _numeroter_pages_pdf(writer):
+    """Ajoute le pied de page « Page n/total » à chaque page du document assemblé.
+
+    Chaque page reçoit un petit flux de contenu supplémentaire : le contenu
+    déjà rendu n'est ni relu ni réécrit.
+    """
+    font = writer._add_object(DictionaryObject({
+        NameObject("/Type"): NameObject("/Font"),
+        NameObject("/Subtype"): NameObject("/Type1"),
+        NameObject("/BaseFont"): NameObject(f"/{PDF_FOOTER_FONT}"),
+        NameObject("/Encoding"): NameObject("/WinAnsiEncoding"),
+    }))
+    widths = CORE_FONTS_CHARWIDTHS[PDF_FOOTER_FONT.lower()]
+    red, green, blue = (channel / 255 for channel in (105, 108, 111))
+    baseline = PDF_FOOTER_BASELINE_MM * 72 / 25.4
+    total = len(writer.pages)
+    for page_no, page in enumerate(writer.pages, start=1):
+        text = f"Page {page_no}/{total}"
+        width = sum(widths[char] for char in text) * PDF_FOOTER_SIZE / 1000
+        resources = page["/Resources"].get_object()
+        if "/Font" not in resources:
+            resources[NameObject("/Font")] = DictionaryObject()
+        resources["/Font"].get_object()[NameObject("/FPied")] = font
+        stream = DecodedStreamObject()
+        stream.set_data(
+            f"q {red:.3f} {green:.3f} {blue:.3f} rg BT /FPied {PDF_FOOTER_SIZE} Tf "
+            f"{float(page.mediabox.width) / 2 - width / 2:.2f} {baseline:.2f} Td ({text}) Tj ET Q".encode("ascii")
+        )
+        contents = page.get("/Contents")
+        if contents is None:
+            page[NameObject("/Contents")] = writer._add_object(stream)
+        else:
+            parts = contents.get_object()
+            parts = list(parts) if isinstance(parts, ArrayObject) else [contents]
+            page[NameObject("/Contents")] = ArrayObject(parts + [writer._add_object(stream)])
+
+def _render_pdf(output, project_data, previews_data, chapter_index, include_ai_notes):
+    """Écrit le PDF du projet dans `output` (chemin ou flux binaire).
+
+    Chaque typologie est rendue à part (voir `_pdf_fragment`) puis ses pages
+    sont ajoutées au document final ; une typologie inchangée est reprise du
+    cache. Les numéros de page sont posés en dernier, sur le document assemblé.
+    """
+    typologies = _typologies_export(project_data, previews_data, chapter_index, include_ai_notes)
+    with metrics.span("pdf_layout"):
+        if typologies:
+            fragments = [
+                _pdf_fragment(typo_idx, nom_typo, blocs, include_ai_notes, digest)
+                for typo_idx, nom_typo, blocs, digest in typologies
+            ]
+        else:
+            fragments = [bytes(_new_pdf_fragment().output())]
+        writer = PyPDF2.PdfWriter()
+        for fragment in fragments:
+            for page in PyPDF2.PdfReader(io.BytesIO(fragment)).pages:
+                writer.add_page(page)
+        _numeroter_pages_pdf(writer)
+        writer.add_metadata({
+            "/Producer": "fpdf2, PyPDF2",
+            "/CreationDate": datetime.now(timezone.utc).strftime("D:%Y%m%d%H%M%SZ"),
+        })
+    
+    if isinstance(output, (str, os.PathLike)):
+        with open(output, "wb") as f:
+            writer.write(f)
+    else:
+        writer.write(output)
+
+def _new_docx_document():
+    """Document Word vierge avec le style du CCTP."""
+    doc = Document()
+    style = doc.styles['Normal']
+    font = style.font
+    font.name = 'Calibri'
+    font.size = Pt(11)
+    return doc
+
+def _render_docx_typologie(doc, typo_idx, nom_typo, blocs, include_ai_notes):
+    """Ajoute une typologie (titre et sections) à la fin du document."""
+    doc.add_heading(f"{typo_idx + 1}. {nom_typo}", level=1)
+    for num_chapitre, titre_section, main_text, placeholders, exemples, crossrefs in blocs:
+        doc.add_heading(f"{num_chapitre} {titre_section}", level=2)
         
-        placeholder_color = RGBColor(220, 53, 69)
-        reference_color = RGBColor(40, 167, 69)
-        cross_ref_color = RGBColor(0, 123, 255)
+        # Texte principal
+        if main_text:
+            doc.add_paragraph(main_text)
         
-        for typo_idx, typo_data in enumerate(project_data):
-            nom_typo = typo_data.get("nomTypologie")
-            typo_previews = previews_data.get(nom_typo, {})
-            if not any(typo_previews.values()): 
+        # Ajouter les éléments supplémentaires s'ils existent et si demandé
+        if include_ai_notes:
+            # À compléter
+            if placeholders:
+                doc.add_paragraph("À compléter :")
+                for placeholder in placeholders:
+                    doc.add_paragraph(f"• {placeholder}")
+            
+            # Exemples
+            if exemples:
+                doc.add_paragraph("Exemples :")
+                for exemple in exemples:
+                    doc.add_paragraph(f"• {exemple}")
+        
+        # Références croisées
+        if crossrefs:
+            doc.add_paragraph("Références croisées :")
+            for crossref in crossrefs:
+                doc.add_paragraph(f"• {crossref}")
+
+def _docx_fragment(typo_idx, nom_typo, blocs, include_ai_notes, digest):
+    """Éléments XML du corps du document pour une typologie, depuis le cache si possible."""
+    cache_key = ExportRenderCache.make_key("docx", digest)
+    fragment = export_render_cache.get(cache_key)
+    if fragment is None:
+        doc = _new_docx_document()
+        _render_docx_typologie(doc, typo_idx, nom_typo, blocs, include_ai_notes)
+        body = doc.element.body
+        fragment = tuple(
+            etree.tostring(element) for element in body.iterchildren()
+            if element is not body.sectPr
+        )
+        export_render_cache.put(cache_key, fragment, sum(len(xml) for xml in fragment))
+    return fragment
+
+def _render_docx(output, project_data, previews_data, chapter_index, include_ai_notes):
+    """Écrit le document Word du projet dans `output` (chemin ou flux binaire).
+
+    Chaque typologie est rendue à part puis ses paragraphes sont recopiés dans
+    le document final : une typologie inchangée est reprise du cache.
+    """
+    typologies = _typologies_export(project_data, previews_data, chapter_index, include_ai_notes)
+    with metrics.span("docx_layout"):
+        doc = _new_docx_document()
+        body = doc.element.body
+        for typo_idx, nom_typo, blocs, digest in typologies:
+            for xml in _docx_fragment(typo_idx, nom_typo, blocs, include_ai_notes, digest):
+                # Les paragraphes se placent avant les propriétés de section, qui restent en dernier
+                body.sectPr.addprevious(parse_xml(xml))
+    with metrics.span("docx_save"):
+        doc.save(output)
+
+# --- FILE D'ATTENTE DES EXPORTS ---
+EXPORT_FORMATS = {
+    "pdf": {"render": _render_pdf, "label": "PDF", "mimetype": "application/pdf"},
+    "docx": {"render": _render_docx, "label": "Word",
+             "mimetype": "application/vnd.openxmlformats-officedocument.wordprocessingml.document"},
+}
+# Nombre d'exports rendus en parallèle et durée de conservation des fichiers produits
+EXPORT_MAX_WORKERS = int(os.getenv("CCTP_EXPORT_WORKERS", "2"))
+EXPORT_TTL_SECONDS = int(os.getenv("CCTP_EXPORT_TTL_SECONDS", "3600"))
+# Au-delà de cette taille (en Mo), un export est écrit sur disque plutôt que gardé en mémoire
+EXPORT_MEMORY_MAX_MB = float(os.getenv("CCTP_EXPORT_MEMORY_MAX_MB", "8"))
+# Serveur multi-processus : le résultat d'une tâche asynchrone est toujours écrit sur disque,
+# car son statut et son téléchargement peuvent arriver sur un autre processus
+EXPORT_SHARED_JOBS = os.getenv("CCTP_EXPORT_SHARED_JOBS", "0") == "1"
+
+class ExportJobQueue:
+    """Rend les exports sur un pool de threads, un résultat par tâche.
+
+    Le rendu se fait en mémoire ; le résultat y reste s'il ne dépasse pas
+    `memory_max_bytes`, sinon il est écrit dans un fichier propre à la tâche
+    dans `directory`. Deux exports simultanés ne partagent donc rien. Les
+    tâches (et leurs fichiers) sont supprimées `ttl` secondes après la fin du
+    rendu ; le ménage est fait à chaque soumission ou consultation.
+
+    L'état de chaque tâche est aussi écrit dans `<id>.json` : avec plusieurs
+    processus, n'importe lequel peut répondre sur une tâche et servir son
+    fichier. Avec `shared`, le résultat des tâches asynchrones va donc
+    toujours sur disque ; une tâche `local` (export synchrone, servi par le
+    processus qui l'a rendue) garde le seuil de `memory_max_bytes`.
+    """
+
+    JOB_ID_PATTERN = re.compile(r"[0-9a-f]{32}")
+    # Intervalle (s) entre deux ménages des fichiers laissés par d'autres processus
+    STALE_SCAN_INTERVAL = 60
+
+    def __init__(self, directory, max_workers, ttl, memory_max_bytes, shared=False):
+        self.directory = directory
+        self.ttl = ttl
+        self.memory_max_bytes = memory_max_bytes
+        self.shared = shared
+        self.max_workers = max(1, max_workers)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="export")
+        self._lock = threading.Lock()
+        self._jobs = {}
+        os.makedirs(directory, exist_ok=True)
+        self._remove_stale_files()
+
+    def reset_after_fork(self):
+        """Dans un processus fils : les threads du pool ne survivent pas au fork."""
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="export")
+        self._lock = threading.Lock()
+        self._jobs = {}
+
+    def _record_path(self, job_id):
+        return os.path.join(self.directory, f"{job_id}.json")
+
+    def _write_record(self, job):
+        """Publie l'état de la tâche pour les autres processus."""
+        record = {key: job[key] for key in ("id", "format", "status", "error", "path", "download_name", "size", "created_at", "finished_at")}
+        record["in_memory"] = job["data"] is not None
+        tmp_path = self._record_path(job["id"]) + ".tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(record, f)
+            os.replace(tmp_path, self._record_path(job["id"]))
+        except OSError as e:
+            print(f"⚠️ État de la tâche d'export {job['id']} non publié: {e}")
+
+    def _read_record(self, job_id):
+        """Tâche d'un autre processus d'après son fichier d'état, ou None."""
+        if not self.JOB_ID_PATTERN.fullmatch(job_id):
+            return None
+        try:
+            with open(self._record_path(job_id), "r", encoding="utf-8") as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if record["finished_at"] is not None and time.time() - record["finished_at"] > self.ttl:
+            return None
+        if record.pop("in_memory"):
+            record["status"] = "error"
+            record["error"] = "Le résultat de cet export est gardé par un autre processus du serveur."
+        record["data"] = None
+        record["future"] = None
+        record["local"] = False
+        return record
+
+    def _remove_stale_files(self):
+        """Supprime les fichiers laissés par un processus précédent et expirés."""
+        self._stale_scan_at = time.time()
+        limit = time.time() - self.ttl
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if os.path.getmtime(path) < limit:
+                    os.remove(path)
+            except OSError:
                 continue
-            doc.add_heading(f"{typo_idx + 1}. {nom_typo}", level=1)
-            for section in typo_data.get("sections", []):
-                titre_section = section.get("titre")
-                num_chapitre = next((item['number'] for item in chapter_map 
-                                   if item['nom_typo'] == nom_typo and item['titre_section'] == titre_section), "")
-                texte_genere = typo_previews.get(titre_section)
-                
-                if texte_genere:
-                    doc.add_heading(f"{num_chapitre} {titre_section}", level=2)
-                    
-                    # Séparer les parties du texte
-                    main_text, placeholders, exemples, crossrefs = extract_parts_for_export(texte_genere, chapter_map, include_ai_notes)
-                    
-                    # Texte principal
-                    if main_text:
-                        doc.add_paragraph(main_text)
-                    
-                    # Ajouter les éléments supplémentaires s'ils existent et si demandé
-                    if include_ai_notes:
-                        # À compléter
-                        if placeholders:
-                            doc.add_paragraph("À compléter :")
-                            for placeholder in placeholders:
-                                doc.add_paragraph(f"• {placeholder}")
-                        
-                        # Exemples
-                        if exemples:
-                            doc.add_paragraph("Exemples :")
-                            for exemple in exemples:
-                                doc.add_paragraph(f"• {exemple}")
-                    
-                    # Références croisées
-                    if crossrefs:
-                        doc.add_paragraph("Références croisées :")
-                        for crossref in crossrefs:
-                            doc.add_paragraph(f"• {crossref}")
-        doc.save(word_path)
-        return send_file(word_path, as_attachment=True, download_name=f"CCTP_{datetime.now().strftime('%Y%m%d')}.docx")
-    except Exception as e:
-        print(f"Erreur d'export Word: {e}")
-        return jsonify({"error": f"Erreur lors de la génération du Word: {str(e)}"}), 500
+
+    def _cleanup(self):
+        now = time.time()
+        if now - self._stale_scan_at > self.STALE_SCAN_INTERVAL:
+            self._remove_stale_files()
+        with self._lock:
+            expired = [
+                job_id for job_id, job in self._jobs.items()
+                if job["finished_at"] is not None and now - job["finished_at"] > self.ttl
+            ]
+            for job_id in expired:
+                job = self._jobs[job_id]
+                try:
+                    if os.path.exists(job["path"]):
+                        os.remove(job["path"])
+                    if os.path.exists(self._record_path(job_id)):
+                        os.remove(self._record_path(job_id))
+                except OSError:
+                    # Fichier encore ouvert (téléchargement en cours) : nouvel essai plus tard
+                    continue
+                del self._jobs[job_id]
+
+    def submit(self, export_format, project_data, previews_data, chapter_index, include_ai_notes, local=False):
+        """Met un export en file et renvoie l'identifiant de la tâche.
+
+        `local` : le résultat sera lu par le processus courant uniquement.
+        """
+        self._cleanup()
+        job_id = uuid.uuid4().hex
+        job = {
+            "id": job_id,
+            "format": export_format,
+            "status": "pending",
+            "error": None,
+            "path": os.path.join(self.directory, f"{job_id}.{export_format}"),
+            "data": None,
+            "download_name": f"CCTP_{datetime.now().strftime('%Y%m%d')}.{export_format}",
+            "size": None,
+            "created_at": time.time(),
+            "finished_at": None,
+            "local": local,
+        }
+        self._write_record(job)
+        job["future"] = self._executor.submit(
+            self._run, job, project_data, previews_data, chapter_index, include_ai_notes
+        )
+        with self._lock:
+            self._jobs[job_id] = job
+        return job_id
+
+    def _run(self, job, project_data, previews_data, chapter_index, include_ai_notes):
+        spec = EXPORT_FORMATS[job["format"]]
+        job["status"] = "running"
+        self._write_record(job)
+        try:
+            buffer = io.BytesIO()
+            with metrics.span(f"export_{job['format']}"):
+                spec["render"](buffer, project_data, previews_data, chapter_index, include_ai_notes)
+            size = buffer.getbuffer().nbytes
+            if size > self.memory_max_bytes or (self.shared and not job["local"]):
+                # Gros export, ou résultat attendu par d'autres processus : écrit sur disque
+                with open(job["path"], "wb") as f:
+                    f.write(buffer.getbuffer())
+            else:
+                job["data"] = buffer.getvalue()
+            job["size"] = size
+            job["status"] = "done"
+        except Exception as e:
+            print(f"Erreur d'export {spec['label']}: {e}")
+            job["error"] = f"Erreur lors de la génération du {spec['label']}: {str(e)}"
+            job["status"] = "error"
+        finally:
+            job["finished_at"] = time.time()
+            self._write_record(job)
+
+    def get(self, job_id):
+        """Renvoie la tâche (dict) ou None si elle est inconnue ou expirée."""
+        self._cleanup()
+        with self._lock:
+            job = self._jobs.get(job_id)
+        return job if job is not None else self._read_record(job_id)
+
+    def wait(self, job_id, timeout=None):
+        """Attend la fin du rendu d'une tâche et la renvoie."""
+        job = self.get(job_id)
+        if job is not None:
+            job["future"].result(timeout=timeout)
+        return job
+
+    def discard(self, job_id):
+        """Supprime une tâche terminée et son résultat ; False si elle est inconnue ou en cours."""
+        with self._lock:
+            job = self._jobs.pop(job_id, None)
+            if job is not None and job["finished_at"] is None:
+                self._jobs[job_id] = job
+                return False
+        if job is None:
+            # Tâche rendue par un autre processus
+            job = self._read_record(job_id)
+            if job is None or job["finished_at"] is None:
+                return False
+        for path in (job["path"], self._record_path(job_id)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        return True
+
+    def describe(self, job):
+        """Représentation JSON d'une tâche pour l'API."""
+        expires_at = job["finished_at"] + self.ttl if job["finished_at"] is not None else None
+        return {
+            "jobId": job["id"],
+            "format": job["format"],
+            "status": job["status"],
+            "error": job["error"],
+            "size": job["size"],
+            "storage": None if job["status"] != "done" else ("memory" if job["data"] is not None else "disk"),
+            "createdAt": datetime.fromtimestamp(job["created_at"]).isoformat(timespec='seconds'),
+            "expiresAt": datetime.fromtimestamp(expires_at).isoformat(timespec='seconds') if expires_at else None,
+            "downloadUrl": f"/api/export/jobs/{job['id']}/download" if job["status"] == "done" else None,
+        }
+
+export_jobs = ExportJobQueue(EXPORTS_DIR, EXPORT_MAX_WORKERS, EXPORT_TTL_SECONDS, int(EXPORT_MEMORY_MAX_MB * 1024 * 1024), EXPORT_SHARED_JOBS)
+
+def _send_export(job):
+    """Envoie le résultat d'une tâche terminée (requêtes Range et conditionnelles acceptées).
+
+    Chaque envoi lit son propre flux : des téléchargements simultanés d'une
+    même tâche ne partagent pas de position de lecture.
+    """
+    source = io.BytesIO(job["data"]) if job["data"] is not None else job["path"]
+    return send_file(
+        source,
+        mimetype=EXPORT_FORMATS[job["format"]]["mimetype"],
+        as_attachment=True,
+        download_name=job["download_name"],
+        conditional=True,
+    )
+
+def _submit_export(export_format, local=False):
+    """Valide une demande d'export et la met en file ; renvoie (job_id, None) ou (None, réponse d'erreur)."""
+    if export_format not in EXPORT_FORMATS:
+        return None, (jsonify({"error": f"Format d'export inconnu: {export_format}"}), 400)
+    if export_format == "docx" and not DOCX_AVAILABLE:
+        return None, (jsonify({"error": "La librairie pour l'export Word (python-docx) n'est pas installée sur le serveur."}), 501)
+    data = request.json or {}
+    project_data, previews_data, chapter_index, include_ai_notes = _preparer_export(data)
+    return export_jobs.submit(export_format, project_data, previews_data, chapter_index, include_ai_notes, local), None
+
+def _export_now(export_format):
+    """Export synchrone (routes de compatibilité) : BLOQUANT.
+
+    Le thread de la requête attend la fin du rendu dans la file d'attente
+    avant de renvoyer le fichier. L'interface et tout nouvel appelant passent
+    par /api/export/jobs (soumission, suivi, téléchargement).
+    """
+    job_id, error_response = _submit_export(export_format, local=True)
+    if error_response:
+        return error_response
+    job = export_jobs.wait(job_id)
+    if job["status"] != "done":
+        export_jobs.discard(job_id)
+        return jsonify({"error": job["error"]}), 500
+    response = _send_export(job)
+    # Personne ne redemandera ce résultat : le flux envoyé garde sa propre référence
+    # aux données en mémoire ; un fichier sur disque expire avec la durée de conservation
+    if job["data"] is not None:
+        export_jobs.discard(job_id)
+    return response
+
+@app.route('/api/export/pdf', methods=['POST'])
+def export_pdf():
+    """Compatibilité, BLOQUANT : génère le PDF et le renvoie dans la même requête.
+
+    Préférer POST /api/export/jobs avec {"format": "pdf"}.
+    """
+    return _export_now("pdf")
+
+@app.route('/api/export/docx', methods=['POST'])
+def export_word():
+    """Compatibilité, BLOQUANT : génère le fichier Word et le renvoie dans la même requête.
+
+    Préférer POST /api/export/jobs avec {"format": "docx"}.
+    """
+    return _export_now("docx")
+
+@app.route('/api/export/jobs', methods=['POST'])
+def create_export_job():
+    """Met un export en file : {"format": "pdf"|"docx", "project", "previews", ...} -> 202 + jobId."""
+    data = request.json or {}
+    job_id, error_response = _submit_export(data.get("format", "pdf"))
+    if error_response:
+        return error_response
+    return jsonify(export_jobs.describe(export_jobs.get(job_id))), 202
+
+@app.route('/api/export/jobs/<job_id>', methods=['GET'])
+def get_export_job(job_id):
+    """Statut d'une tâche d'export (pending, running, done, error)."""
+    job = export_jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Tâche d'export introuvable ou expirée."}), 404
+    return jsonify(export_jobs.describe(job))
+
+@app.route('/api/export/jobs/<job_id>/download', methods=['GET'])
+def download_export_job(job_id):
+    """Télécharge le fichier d'une tâche terminée (supporte l'en-tête Range)."""
+    job = export_jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Tâche d'export introuvable ou expirée."}), 404
+    if job["status"] == "error":
+        return jsonify({"error": job["error"]}), 500
+    if job["status"] != "done":
+        return jsonify({"error": "Export en cours de génération."}), 409
+    return _send_export(job)
+
+@app.route('/api/export/jobs/<job_id>', methods=['DELETE'])
+def delete_export_job(job_id):
+    """Supprime une tâche terminée et son fichier."""
+    if not export_jobs.discard(job_id):
+        return jsonify({"error": "Tâche d'export introuvable ou en cours."}), 404
+    return jsonify({"message": "Export supprimé."})
+
+def _publier_statut_analyse():
+    """Écrit le statut de l'analyse pour les autres processus du serveur."""
+    tmp_path = ANALYSIS_STATUS_PATH + ".tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(dict(analysis_status, updated_at=time.time()), f, ensure_ascii=False)
+        os.replace(tmp_path, ANALYSIS_STATUS_PATH)
+    except OSError as e:
+        print(f"⚠️ Statut de l'analyse non publié: {e}")
+
+def _statut_analyse():
+    """Statut de l'analyse, qu'elle tourne dans ce processus ou dans un autre."""
+    if analysis_status["running"]:
+        return analysis_status
+    try:
+        with open(ANALYSIS_STATUS_PATH, "r", encoding="utf-8") as f:
+            status = json.load(f)
+    except (OSError, ValueError):
+        return analysis_status
+    updated_at = status.pop("updated_at", 0)
+    if status.get("running") and time.time() - updated_at > ANALYSIS_STALE_SECONDS:
+        status["running"] = False
+        status["error"] = status.get("error") or "Analyse interrompue."
+    return status
 
 @app.route('/api/analyze-pdfs', methods=['POST'])
 def analyze_pdfs():
     """Analyse un dossier de PDFs pour créer/mettre à jour la base de connaissances."""
     global analysis_status
     
-    if analysis_status["running"]:
+    if _statut_analyse()["running"]:
         return jsonify({"error": "Une analyse est déjà en cours"}), 400
     
     data = request.json
@@ -854,16 +4099,17 @@ def analyze_pdfs():
     if not pdf_files:
         return jsonify({"error": "Aucun fichier PDF trouvé dans le dossier spécifié"}), 400
     
-    # Lancer l'analyse en arrière-plan
-    analysis_status = {"running": True, "progress": 0, "max_files": len(pdf_files), "current_file": "", "error": None}
-    threading.Thread(target=analyze_pdfs_thread, args=(pdf_directory,), daemon=True).start()
+    # Lancer l'analyse en arrière-plan (incrémentale, sauf si "full" est demandé)
+    analysis_status = {"running": True, "progress": 0, "max_files": len(pdf_files), "current_file": "", "error": None, "reused": 0}
+    _publier_statut_analyse()
+    threading.Thread(target=analyze_pdfs_thread, args=(pdf_directory, bool(data.get('full'))), daemon=True).start()
     
     return jsonify({"message": "Analyse des PDFs démarrée", "total_files": len(pdf_files)})
 
 @app.route('/api/analyze-pdfs/status', methods=['GET'])
 def get_analysis_status():
     """Récupère le statut de l'analyse en cours."""
-    return jsonify(analysis_status)
+    return jsonify(_statut_analyse())
 
 @app.route('/api/browse-directories', methods=['POST'])
 def browse_directories():
@@ -928,8 +4174,48 @@ def browse_directories():
         print(f"Erreur dans browse_directories: {e}")
         return jsonify({"error": f"Erreur lors de la navigation: {str(e)}"}), 500
 
-def analyze_pdfs_thread(pdf_directory):
-    """Thread d'analyse des PDFs et génération de la base de connaissances JSON."""
+# Nombre de processus pour l'analyse des PDFs (par défaut : un par cœur)
+ANALYSIS_MAX_WORKERS = int(os.getenv("CCTP_ANALYSIS_WORKERS", "0")) or (os.cpu_count() or 1)
+
+# Version du découpage en sections : l'incrémenter invalide le manifeste
+KB_PARSER_VERSION = 1
+
+def _charger_manifeste():
+    """Manifeste de la dernière analyse : {chemin absolu: {size, mtime_ns, sha1, has_sections}}."""
+    try:
+        with open(KNOWLEDGE_BASE_MANIFEST_PATH, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if manifest.get("parser_version") != KB_PARSER_VERSION:
+        return {}
+    return manifest.get("files", {})
+
+def _sauvegarder_manifeste(files):
+    tmp_path = KNOWLEDGE_BASE_MANIFEST_PATH + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"parser_version": KB_PARSER_VERSION, "files": files}, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_path, KNOWLEDGE_BASE_MANIFEST_PATH)
+
+def _fichier_inchange(entry, pdf_path, stat):
+    """Vrai si le PDF n'a pas changé depuis l'entrée du manifeste.
+
+    Taille et date identiques suffisent ; si seule la date a changé, on
+    compare le contenu (SHA-1).
+    """
+    if entry.get("size") != stat.st_size:
+        return False
+    if entry.get("mtime_ns") == stat.st_mtime_ns:
+        return True
+    return entry.get("sha1") == hash_fichier(pdf_path)
+
+def analyze_pdfs_thread(pdf_directory, full_rebuild=False):
+    """Thread d'analyse des PDFs et génération de la base de connaissances.
+
+    Seuls les PDFs nouveaux ou modifiés depuis la dernière analyse (d'après le
+    manifeste) sont relus ; les autres reprennent leurs sections de la base
+    existante. `full_rebuild` force la relecture de tous les fichiers.
+    """
     global analysis_status
     
     try:
@@ -937,23 +4223,54 @@ def analyze_pdfs_thread(pdf_directory):
         knowledge_base_data = {}
         pdf_files = glob.glob(os.path.join(pdf_directory, "*.pdf"))
         
-        for i, pdf_path in enumerate(pdf_files):
+        manifest = {} if full_rebuild else _charger_manifeste()
+        previous_kb = kb_store.get() if manifest else None
+        if not isinstance(previous_kb, KnowledgeBaseDB):
+            previous_kb = None
+        new_manifest = {}
+        to_parse = []
+        parsed = []
+        
+        # Réutiliser les fichiers inchangés ; les fichiers supprimés disparaissent d'eux-mêmes
+        for pdf_path in pdf_files:
+            key = os.path.abspath(pdf_path)
             filename = os.path.basename(pdf_path)
-            analysis_status["progress"] = i
-            analysis_status["current_file"] = filename
-            
+            entry = manifest.get(key)
             try:
-                with open(pdf_path, "rb") as f:
-                    reader = PyPDF2.PdfReader(f)
-                    text = ""
-                    for page in reader.pages:
-                        page_text = page.extract_text()
-                        if page_text:
-                            text += page_text + "\n"
-                
-                # Traiter le texte et créer les sections avec structure hiérarchique
-                if text.strip():
-                    sections = _parse_document_structure(text)
+                stat = os.stat(pdf_path)
+                unchanged = entry is not None and _fichier_inchange(entry, pdf_path, stat)
+            except OSError:
+                unchanged = False
+            cached = previous_kb.read_document(filename) if previous_kb is not None and unchanged else None
+            if unchanged and (cached is not None or not entry.get("has_sections")):
+                if cached is not None:
+                    knowledge_base_data[filename] = cached
+                new_manifest[key] = {**entry, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+                analysis_status["reused"] += 1
+                analysis_status["progress"] += 1
+                analysis_status["current_file"] = filename
+            else:
+                to_parse.append(pdf_path)
+        _publier_statut_analyse()
+        
+        # Extraction et découpage en parallèle, un processus par cœur
+        if to_parse:
+            max_workers = max(1, min(ANALYSIS_MAX_WORKERS, len(to_parse)))
+            # Processus lancés par spawn : un fork depuis ce thread copierait les verrous
+            # des autres threads du serveur dans l'état où ils se trouvent
+            with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+                futures = {executor.submit(extraire_sections_pdf, pdf_path): pdf_path for pdf_path in to_parse}
+                for future in as_completed(futures):
+                    pdf_path = futures[future]
+                    filename, sections, error, digest = future.result()
+                    parsed.append(filename)
+                    analysis_status["progress"] += 1
+                    analysis_status["current_file"] = filename
+                    _publier_statut_analyse()
+                    
+                    if error:
+                        print(f"AVERTISSEMENT: Impossible de lire le fichier {filename}: {error}")
+                        continue
                     
                     # Créer une typologie principale avec toutes les sections
                     if sections:
@@ -961,156 +4278,59 @@ def analyze_pdfs_thread(pdf_directory):
                             "nom_typo": filename.replace('.pdf', '').replace('_', ' ').title(),
                             "sections": sections
                         }]
-                
-            except Exception as e:
-                print(f"AVERTISSEMENT: Impossible de lire le fichier {filename}: {e}")
-                continue
+                    try:
+                        stat = os.stat(pdf_path)
+                    except OSError:
+                        continue
+                    new_manifest[os.path.abspath(pdf_path)] = {
+                        "size": stat.st_size,
+                        "mtime_ns": stat.st_mtime_ns,
+                        "sha1": digest,
+                        "has_sections": bool(sections),
+                    }
         
         # Trier les données par nom de fichier pour un résultat cohérent
         sorted_data = dict(sorted(knowledge_base_data.items()))
         
         # Créer le répertoire knowledge_base s'il n'existe pas
-        knowledge_base_dir = os.path.join(os.path.dirname(__file__), "knowledge_base")
-        os.makedirs(knowledge_base_dir, exist_ok=True)
+        os.makedirs(KNOWLEDGE_BASE_DIR, exist_ok=True)
         
-        # Sauvegarder la base de connaissances au format JSON
-        json_path = os.path.join(knowledge_base_dir, "knowledge_base.json")
-        with open(json_path, "w", encoding="utf-8") as f:
-            json.dump(sorted_data, f, indent=2, ensure_ascii=False)
+        # Sauvegarder la base de connaissances (SQLite, index et poids de recherche compris)
+        if previous_kb is None:
+            kb_store.replace(sorted_data)
+        else:
+            # Seuls les documents relus ou disparus sont réécrits dans la base
+            removed = [filename for filename in previous_kb.filenames() if filename not in sorted_data]
+            kb_store.update(sorted_data, [filename for filename in parsed if filename in sorted_data], removed)
         
-        # Également sauvegarder au format texte pour compatibilité avec l'existant
-        with open(KNOWLEDGE_BASE_PATH, "w", encoding="utf-8") as f:
-            contenu_complet = ""
-            for filename, data in sorted_data.items():
-                contenu_complet += f"\n\n--- EXTRAIT DU DOCUMENT : {filename} ---\n\n"
-                for typo in data:
-                    for section in typo["sections"]:
-                        contenu_complet += f"{section['titre']}\n{section['contenu']}\n\n"
-            f.write(contenu_complet)
+        _sauvegarder_manifeste(new_manifest)
         
         analysis_status["progress"] = len(pdf_files)
         analysis_status["current_file"] = "Terminé"
         analysis_status["running"] = False
+        _publier_statut_analyse()
         
     except Exception as e:
         analysis_status["error"] = str(e)
         analysis_status["running"] = False
+        _publier_statut_analyse()
         print(f"Erreur lors de l'analyse des PDFs: {e}")
 
 def _parse_document_structure(text):
     """Parse le texte pour extraire la structure hiérarchique des sections."""
-    sections = []
-    
-    # Diviser en lignes pour un traitement plus précis
-    lines = text.split('\n')
-    
-    current_section = None
-    current_content = []
-    
-    for i, line in enumerate(lines):
-        line = line.strip()
-        
-        # Pattern pour détecter les titres de section avec numérotation
-        # Exemples: "2 DESCRIPTION GENERALE", "2.1 Convention de nomenclature", "2.1.1 Modules"
-        section_pattern = r'^\s*(\d+(?:\.\d+)*)\s+(.+)$'
-        match = re.match(section_pattern, line)
-        
-        if match:
-            section_number = match.group(1)
-            section_title = match.group(2).strip()
-            
-            # Vérifier s'il y a du contenu après ce titre
-            has_content_after = False
-            content_lines = []
-            
-            # Regarder les lignes suivantes pour voir s'il y a du contenu
-            for j in range(i + 1, len(lines)):
-                next_line = lines[j].strip()
-                
-                # Si on trouve une ligne vide, continuer
-                if not next_line:
-                    continue
-                
-                # Si on trouve un autre titre de section, arrêter
-                if re.match(r'^\s*\d+(?:\.\d+)*\s+.+$', next_line):
-                    break
-                
-                # Sinon, c'est du contenu
-                has_content_after = True
-                break
-            # Si on a du contenu après ce titre, c'est une vraie section
-            if has_content_after:
-                # Sauvegarder la section précédente s'il y en a une
-                if current_section and current_content:
-                    sections.append({
-                        "titre": current_section,
-                        "contenu": "\n".join(current_content).strip()
-                    })
-                
-                # Commencer une nouvelle section
-                current_section = section_title
-                current_content = []
-            
-        elif current_section:
-            # Ajouter la ligne au contenu de la section courante
-            if line:  # Ignorer les lignes vides
-                current_content.append(line)
-    
-    # Ajouter la dernière section si elle existe
-    if current_section and current_content:
-        sections.append({
-            "titre": current_section,
-            "contenu": "\n".join(current_content).strip()
-        })
-    
-    # Si aucune section structurée n'a été trouvée, essayer l'approche par paragraphes
-    if not sections:
-        paragraphs = [p.strip() for p in text.split('\n\n') if p.strip()]
-        
-        for paragraph in paragraphs[:20]:  # Limiter à 20 sections
-            lines = paragraph.split('\n')
-            first_line = lines[0].strip()
-            
-            # Vérifier si la première ligne ressemble à un titre
-            if len(first_line) < 150 and len(lines) > 1:
-                sections.append({
-                    "titre": first_line,
-                    "contenu": "\n".join(lines[1:]).strip()
-                })
-            else:
-                # Utiliser les premiers mots comme titre
-                words = first_line.split()[:8]
-                title = " ".join(words)
-                if len(first_line) > len(title):
-                    title += "..."
-                
-                sections.append({
-                    "titre": title,
-                    "contenu": paragraph
-                })
-    
-    # Si toujours rien, créer une section par défaut
-    if not sections and text.strip():
-        sections.append({
-            "titre": "Document",
-            "contenu": text.strip()
-        })
-    
+    parser = IncrementalSectionParser()
+    sections = parser.feed(text)
+    sections.extend(parser.close())
     return sections
 
 @app.route('/api/models/<model_name>/typologies/<int:typo_index>/sections/<int:section_index>', methods=['DELETE'])
 def delete_section(model_name, typo_index, section_index):
     """Supprime une section d'une typologie dans un modèle."""
-    project_path = os.path.join(MODELES_DIR, f"{model_name}.json")
-    previews_path = os.path.join(PREVIEWS_DIR, f"{model_name}_previews.json")
-
-    if not os.path.exists(project_path):
-        return jsonify({"error": "Modèle non trouvé."}), 404
-
     try:
-        # Charger les données du projet
-        with open(project_path, 'r', encoding='utf-8') as f:
-            project_data = json.load(f)
+        stored = project_store.get(model_name)
+        if stored is None:
+            return jsonify({"error": "Modèle non trouvé."}), 404
+        project_data, previews_data, version = stored
         
         # Vérifier que la typologie existe
         if typo_index >= len(project_data):
@@ -1127,29 +4347,17 @@ def delete_section(model_name, typo_index, section_index):
         section_titre = sections[section_index].get('titre', '')
         nom_typologie = typologie.get('nomTypologie', '')
         
-        # Supprimer la section
-        sections.pop(section_index)
-        
-        # Sauvegarder le projet modifié
-        with open(project_path, 'w', encoding='utf-8') as f:
-            json.dump(project_data, f, indent=2, ensure_ascii=False)
-        
-        # Nettoyer les previews associées
-        previews_data = {}
-        if os.path.exists(previews_path):
-            with open(previews_path, 'r', encoding='utf-8') as f:
-                previews_data = json.load(f)
-        
-        # Supprimer la preview de la section supprimée
+        # Supprimer la section, ainsi que sa preview si elle existe
+        operations = [{"op": "remove", "path": f"/project/{typo_index}/sections/{section_index}"}]
         if nom_typologie in previews_data and section_titre in previews_data[nom_typologie]:
-            del previews_data[nom_typologie][section_titre]
+            escape = lambda token: token.replace("~", "~0").replace("/", "~1")
+            operations.append({"op": "remove", "path": f"/previews/{escape(nom_typologie)}/{escape(section_titre)}"})
+        # Les index viennent de la copie lue plus haut : refuser si le projet a changé depuis
+        project_store.apply(model_name, operations, version)
         
-        # Sauvegarder les previews modifiées
-        with open(previews_path, 'w', encoding='utf-8') as f:
-            json.dump(previews_data, f, indent=2, ensure_ascii=False)
-        
-        # Mettre à jour la bibliothèque de sections
-        enrichir_bibliotheque_sections()
+        # Écrire tout de suite (met aussi à jour la bibliothèque de sections)
+        project_store.flush(model_name)
+        project_data, previews_data, _ = project_store.get(model_name)
         
         return jsonify({
             "message": f"Section '{section_titre}' supprimée avec succès.",
@@ -1157,6 +4365,8 @@ def delete_section(model_name, typo_index, section_index):
             "previews": previews_data
         })
         
+    except ProjectVersionConflict as e:
+        return jsonify({"error": "Le projet a été modifié entre-temps, rechargez-le puis recommencez.", "version": e.version}), 409
     except Exception as e:
         return jsonify({"error": f"Erreur lors de la suppression de la section: {str(e)}"}), 500
 
@@ -1183,10 +4393,56 @@ def improve_prompt():
     except Exception as e:
         return jsonify({"error": f"Erreur lors de l'amélioration du prompt: {str(e)}"}), 500
 
+# --- MODE PRODUCTION (préchargement, processus multiples) ---
+def warm_up():
+    """Charge ce que toutes les requêtes partagent, pour que la première ne paie pas le démarrage.
+
+    Appelée par wsgi.py avant la création des processus du serveur : les
+    données chargées (index des titres, classement, bibliothèque, polices)
+    sont partagées en copie sur écriture. Renvoie la durée de chaque étape (ms).
+    """
+    steps = (
+        ("knowledge_base", kb_store.get_search),
+        ("section_library", section_library.titles),
+        ("prompts", prompt_registry.system_prompt),
+        ("pdf_fonts", lambda: PDF('P', 'mm', 'A4')),
+        ("tokenizer", lambda: _encodage_tokens(GENERATION_MODEL)),
+    )
+    timings = {}
+    for name, step in steps:
+        start = time.perf_counter()
+        try:
+            step()
+        except Exception as e:
+            print(f"⚠️ Préchargement '{name}' impossible: {e}")
+        timings[name] = round((time.perf_counter() - start) * 1000, 1)
+    # Une connexion SQLite ne doit pas être partagée entre processus : chacun rouvrira la sienne
+    kb_store.db.close()
+    generation_cache.close()
+    return timings
+
+def reset_after_fork():
+    """Dans un processus du serveur créé par fork (post_fork de gunicorn.conf.py) :
+    ressources propres à chaque processus (connexions, threads)."""
+    kb_store.db.reset_after_fork()
+    generation_cache.reset_after_fork()
+    openai_client.reset_after_fork()
+    metrics.reset_after_fork()
+    export_jobs.reset_after_fork()
+    project_store.reset_after_fork()
+
 # --- Lancement de l'application ---
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serveur de développement du générateur de CCTP.")
+    parser.add_argument("--export-knowledge-base", action="store_true",
+                        help="Écrit knowledge_base.json (copie lisible de la base SQLite) puis quitte")
+    args = parser.parse_args()
+    if args.export_knowledge_base:
+        count = kb_store.export_json()
+        print(f"{count} documents exportés dans {KNOWLEDGE_BASE_JSON_PATH}")
+        sys.exit(0)
     # Au démarrage, s'assurer que la bibliothèque de sections est à jour
-    enrichir_bibliotheque_sections()
+    section_library.titles()
     # Lance le serveur de développement Flask
-    # En production, utilisez un serveur WSGI comme Gunicorn ou Waitress
+    # En production, utilisez wsgi.py (Gunicorn ou Waitress, voir le README)
     app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Mesure du temps et de la taille des exports PDF, avec et sans cache des polices
+
+Usage : python bench_export_pdf.py [--typologies 5] [--sections 20] [--runs 5]
+"""
+
+import argparse
+import io
+import os
+import statistics
+import time
+
+import app
+
+
+def construire_projet(nb_typologies, nb_sections):
+    """Projet synthétique : texte accentué, placeholders, exemples et références croisées."""
+    project = []
+    previews = {}
+    for t in range(nb_typologies):
+        nom_typo = f"Typologie {t + 1}"
+        sections = [{"titre": f"Section {s + 1} — Généralités"} for s in range(nb_sections)]
+        project.append({"nomTypologie": nom_typo, "sections": sections})
+        previews[nom_typo] = {
+            section["titre"]: (
+                "Le présent lot comprend la fourniture et la pose des menuiseries extérieures, "
+                "y compris les éléments de façade. [À PRÉCISER : performances thermiques] "
+                f"(voir exemple CCTP exemple.pdf -> {section['titre']}) "
+                f"{{{{REF:{nom_typo}|Section 1 — Généralités}}}} "
+            ) * 6
+            for section in sections
+        }
+    return project, previews
+
+
+def mesurer(project, previews, runs):
+    """Exports alternés sans/avec cache des polices : {cache: (durées ms, construction ms, taille)}."""
+    chapter_index = app.build_chapter_index(app.compute_chapter_map(project))
+    modes = (False, True) if app.PDF_FONT_CACHE_AVAILABLE else (False,)
+    resultats = {mode: ([], [], 0) for mode in modes}
+    # Alterner les deux modes limite l'effet des variations de charge de la machine
+    for _ in range(runs):
+        for cache_polices in modes:
+            app.PDF_FONT_CACHE_AVAILABLE = cache_polices
+            durees, constructions, _ = resultats[cache_polices]
+            start = time.perf_counter()
+            app.PDF('P', 'mm', 'A4')
+            constructions.append((time.perf_counter() - start) * 1000)
+            buffer = io.BytesIO()
+            # Mesurer un rendu complet, pas une réutilisation du cache des exports
+            app.export_render_cache.clear()
+            start = time.perf_counter()
+            app._render_pdf(buffer, project, previews, chapter_index, True)
+            durees.append((time.perf_counter() - start) * 1000)
+            resultats[cache_polices] = (durees, constructions, buffer.getbuffer().nbytes)
+    app.PDF_FONT_CACHE_AVAILABLE = modes[-1]
+    return resultats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--typologies", type=int, default=5)
+    parser.add_argument("--sections", type=int, default=20)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    project, previews = construire_projet(args.typologies, args.sections)
+    polices = sum(os.path.getsize(os.path.join(app.FONTS_DIR, f)) for _, f in app.PDF_FONTS)
+    print(f"📄 Export PDF de {args.typologies} typologies x {args.sections} sections ({args.runs} exports)")
+    print(f"   Polices TTF complètes : {polices / 1024:.0f} Ko")
+
+    if not app.PDF_FONT_CACHE_AVAILABLE:
+        print("⚠️ Cache des polices indisponible (version de fpdf2 incompatible)")
+    labels = {False: "Sans cache des polices", True: "Avec cache des polices"}
+    for cache_polices, (durees, constructions, taille) in mesurer(project, previews, args.runs).items():
+        print(f"⏱️ {labels[cache_polices]}: export médian {statistics.median(durees):.1f} ms, "
+              f"dont PDF() {statistics.median(constructions):.2f} ms, fichier {taille / 1024:.1f} Ko")
+
+
+if __name__ == "__main__":
+    main()
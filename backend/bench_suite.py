@@ -0,0 +1,388 @@
+#!/usr/bin/env python3
+"""
+Banc de mesure reproductible du backend sur un corpus CCTP synthétique
+
+Mesure le découpage des documents, la recherche d'exemples, le découpage des
+textes pour l'export, les exports PDF et Word et /api/generate de bout en bout
+(avec un faux modèle, sans clé OpenAI). Les résultats sont écrits en JSON pour
+comparer deux commits.
+
+Usage : python bench_suite.py [--preset small|medium|large] [--documents 500] [--sections 200]
+                              [--llm stub|http] [--latency 0.05] [--output resultats.json]
+                              [--compare precedent.json] [--only retrieval,export_pdf]
+"""
+
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from types import SimpleNamespace
+
+import app
+
+# Taille du corpus : documents de la base de connaissances, sections du projet et du document découpé
+PRESETS = {
+    "small": {"documents": 10, "sections": 10, "runs": 5},
+    "medium": {"documents": 500, "sections": 200, "runs": 5},
+    "large": {"documents": 10000, "sections": 2000, "runs": 3},
+}
+BENCHMARKS = ("parse", "retrieval", "extract_parts", "export_pdf", "export_docx", "generate")
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_results")
+# Un écart de médiane au-delà de ce ratio est signalé comme une régression
+REGRESSION_THRESHOLD = 1.10
+
+LOTS = [
+    "Gros œuvre", "Charpente", "Couverture", "Étanchéité", "Menuiseries extérieures",
+    "Menuiseries intérieures", "Cloisons et doublages", "Revêtements de sols", "Peinture",
+    "Plomberie", "Chauffage ventilation", "Électricité courants forts", "Façades", "Serrurerie",
+]
+TITRES = [
+    "Généralités", "Objet du lot", "Documents de référence", "Normes et règlements",
+    "Description des ouvrages", "Performances thermiques", "Performances acoustiques",
+    "Sécurité incendie", "Mise en œuvre", "Essais et contrôles", "Localisation",
+    "Limites de prestations", "Échantillons", "Garanties", "Nettoyage", "Réception",
+]
+VOCABULAIRE = (
+    "fourniture pose menuiseries vitrage isolant thermique acoustique béton armé enduit "
+    "mortier étanchéité membrane façade ossature acier galvanisé aluminium laqué joint "
+    "calfeutrement résistance feu classement réaction conformité DTU norme NF essai "
+    "réception chantier entreprise maître œuvre ouvrage localisation niveau local "
+    "plancher dalle cloison plâtre doublage laine minérale ventilation réseau gaine"
+).split()
+
+
+class CorpusGenerator:
+    """Corpus CCTP synthétique et déterministe (même graine, même corpus)."""
+
+    def __init__(self, seed=42):
+        self.random = random.Random(seed)
+
+    def phrase(self, words=14):
+        mots = [self.random.choice(VOCABULAIRE) for _ in range(words)]
+        return " ".join(mots).capitalize() + "."
+
+    def paragraphe(self, phrases=4):
+        return " ".join(self.phrase(self.random.randint(8, 20)) for _ in range(phrases))
+
+    def titre(self):
+        titre = self.random.choice(TITRES)
+        if self.random.random() < 0.4:
+            titre += f" {self.random.choice(VOCABULAIRE)}"
+        return titre
+
+    def document_text(self, nb_sections):
+        """Texte extrait d'un PDF : sommaire, puis sections numérotées (pour le découpage)."""
+        lines = ["CAHIER DES CLAUSES TECHNIQUES PARTICULIÈRES", "", "SOMMAIRE"]
+        titres = [self.titre() for _ in range(nb_sections)]
+        lines.extend(f"{i + 1}. {titre}" for i, titre in enumerate(titres[:20]))
+        lines.append("")
+        for i, titre in enumerate(titres):
+            lines.append(f"{i // 10 + 1}.{i % 10 + 1} {titre}")
+            for _ in range(self.random.randint(1, 3)):
+                lines.append(self.paragraphe(self.random.randint(2, 5)))
+            lines.append("")
+        return "\n".join(lines)
+
+    def knowledge_base(self, nb_documents, sections_per_document=20):
+        """Base au format de knowledge_base.json : {fichier: [typologies]}."""
+        kb_data = {}
+        for d in range(nb_documents):
+            typologies = []
+            for lot in self.random.sample(LOTS, self.random.randint(1, 3)):
+                sections = [
+                    {"titre": self.titre(), "contenu": self.paragraphe(self.random.randint(2, 6))}
+                    for _ in range(max(1, sections_per_document // 2))
+                ]
+                typologies.append({"nom_typo": lot, "sections": sections})
+            kb_data[f"CCTP_{d + 1:05d}.pdf"] = typologies
+        return kb_data
+
+    def project(self, nb_sections, sections_per_typology=20):
+        """Projet et prévisualisations avec placeholders, exemples et références croisées."""
+        project, previews = [], {}
+        nb_typologies = max(1, (nb_sections + sections_per_typology - 1) // sections_per_typology)
+        for t in range(nb_typologies):
+            nom_typo = f"{LOTS[t % len(LOTS)]} {t + 1}"
+            count = min(sections_per_typology, nb_sections - t * sections_per_typology)
+            sections = [{"titre": f"{self.titre()} {s + 1}"} for s in range(count)]
+            project.append({"nomTypologie": nom_typo, "sections": sections})
+            previews[nom_typo] = {}
+            for section in sections:
+                cible = project[self.random.randrange(len(project))]
+                texte = [self.paragraphe(3)]
+                if self.random.random() < 0.6:
+                    texte.append(f"[À PRÉCISER : {self.random.choice(VOCABULAIRE)}]")
+                if self.random.random() < 0.4:
+                    texte.append(f"(voir exemple CCTP CCTP_00001.pdf -> {self.titre()})")
+                if self.random.random() < 0.3:
+                    texte.append(f"{{{{REF:{cible['nomTypologie']}|{cible['sections'][0]['titre']}}}}}")
+                texte.append(self.paragraphe(2))
+                previews[nom_typo][section["titre"]] = " ".join(texte)
+        return project, previews
+
+
+def mesurer(fonction, runs, warmup=1):
+    """Exécute `fonction` (warmup + runs fois) ; statistiques des durées en ms."""
+    for _ in range(warmup):
+        fonction()
+    durees = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        fonction()
+        durees.append((time.perf_counter() - start) * 1000)
+    durees.sort()
+    return {
+        "runs": runs,
+        "median_ms": round(statistics.median(durees), 3),
+        "mean_ms": round(statistics.fmean(durees), 3),
+        "min_ms": round(durees[0], 3),
+        "p95_ms": round(durees[min(len(durees) - 1, int(len(durees) * 0.95))], 3),
+    }
+
+
+def bench_parse(gen, args):
+    texte = gen.document_text(args.sections)
+    sections = app._parse_document_structure(texte)
+    return dict(mesurer(lambda: app._parse_document_structure(texte), args.runs),
+                chars=len(texte), sections=len(sections))
+
+
+def bench_retrieval(corpus, args):
+    index, ranker, db = corpus["index"], corpus["ranker"], corpus["db"]
+    requetes = [(f"{titre} {i}", lot) for i, (titre, lot) in enumerate(zip(TITRES * 4, LOTS * 5))][:args.queries]
+
+    def rechercher():
+        for titre, lot in requetes:
+            app._retrouver_exemples_pertinents(titre, db, index, ranker, "menuiseries vitrage", lot)
+
+    return dict(mesurer(rechercher, args.runs), queries=len(requetes),
+                kb_sections=len(index.entries), kb_build_ms=corpus["build_ms"])
+
+
+def bench_extract_parts(corpus, args):
+    textes = [texte for typo in corpus["previews"].values() for texte in typo.values()]
+    chapter_index = corpus["chapter_index"]
+
+    def decouper():
+        for texte in textes:
+            app.extract_parts_for_export(texte, chapter_index, True)
+
+    return dict(mesurer(decouper, args.runs), texts=len(textes))
+
+
+def _bench_export(corpus, args, render):
+    taille = {}
+
+    def exporter():
+        # Rendu complet : pas de réutilisation du cache des exports
+        app.export_render_cache.clear()
+        buffer = io.BytesIO()
+        render(buffer, corpus["project"], corpus["previews"], corpus["chapter_index"], True)
+        taille["bytes"] = buffer.getbuffer().nbytes
+
+    resultat = mesurer(exporter, args.runs)
+    return dict(resultat, sections=args.sections, bytes=taille["bytes"])
+
+
+def bench_export_pdf(corpus, args):
+    return _bench_export(corpus, args, app._render_pdf)
+
+
+def bench_export_docx(corpus, args):
+    if not app.DOCX_AVAILABLE:
+        return {"skipped": "python-docx non installé"}
+    return _bench_export(corpus, args, app._render_docx)
+
+
+def _faux_modele(latency):
+    """Remplace openai_chat_completion : attend `latency` secondes et renvoie un texte fixe."""
+    def openai_chat_completion(model, messages, temperature=0.3, priority=app.PRIORITY_INTERACTIVE):
+        time.sleep(latency)
+        texte = "Le présent lot comprend la fourniture et la pose des ouvrages. [À PRÉCISER : classement]"
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=texte))])
+    return openai_chat_completion
+
+
+def bench_generate(corpus, args):
+    """POST /api/generate via le client de test Flask, avec la base synthétique et un faux modèle."""
+    sauvegarde = {name: getattr(app, name) for name in ("kb_store", "generation_cache", "openai_chat_completion", "openai_client")}
+    cle = app.openai.api_key
+    server = None
+    try:
+        app.kb_store = corpus["kb_store"]
+        app.generation_cache = app.GenerationCache(os.path.join(corpus["dir"], "generation_cache.sqlite3"), 64 * 1024 * 1024)
+        app.openai.api_key = cle or "bench"
+        if args.llm == "http":
+            from fake_openai_server import start_fake_server
+            server = start_fake_server(latency=args.latency)
+            # Quotas très larges : on mesure le backend, pas l'ordonnanceur
+            scheduler = app.OpenAIScheduler(rpm=10 ** 6, tpm=10 ** 9, max_concurrency=64)
+            app.openai_client = app.OpenAIClient(scheduler, base_url=server.base_url, api_key="bench")
+        else:
+            app.openai_chat_completion = _faux_modele(args.latency)
+
+        client = app.app.test_client()
+        requetes = [
+            {"nomTypo": lot, "titreSection": titre, "notes": "menuiseries aluminium, vitrage isolant", "force": True}
+            for titre, lot in zip(TITRES, LOTS * 2)
+        ][:args.queries]
+
+        def generer():
+            for corps in requetes:
+                response = client.post("/api/generate", json=corps)
+                if response.status_code != 200:
+                    raise RuntimeError(f"/api/generate a répondu {response.status_code}: {response.get_json()}")
+
+        return dict(mesurer(generer, args.runs), requests=len(requetes), llm=args.llm, latency_s=args.latency)
+    finally:
+        for name, value in sauvegarde.items():
+            setattr(app, name, value)
+        app.openai.api_key = cle
+        if server is not None:
+            server.shutdown()
+
+
+def preparer_corpus(gen, args, directory):
+    """Base SQLite synthétique (avec index et classement BM25) et projet à exporter."""
+    start = time.perf_counter()
+    kb_data = gen.knowledge_base(args.documents, args.sections_per_document)
+    store_path = os.path.join(directory, "knowledge_base.sqlite3")
+    kb_store = app.KnowledgeBaseStore(store_path, os.path.join(directory, "absent.json"), os.path.join(directory, "absent.txt"))
+    kb_store.db.write(kb_data)
+    db, index, ranker = kb_store.get_search()
+    build_ms = round((time.perf_counter() - start) * 1000, 1)
+    project, previews = gen.project(args.sections)
+    return {
+        "dir": directory,
+        "kb_store": kb_store,
+        "db": db,
+        "index": index,
+        "ranker": ranker,
+        "build_ms": build_ms,
+        "project": project,
+        "previews": previews,
+        "chapter_index": app.build_chapter_index(app.compute_chapter_map(project)),
+    }
+
+
+def environnement():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "tiktoken": app.TIKTOKEN_AVAILABLE,
+    }
+
+
+def comparer(resultats, reference_path):
+    """Affiche les écarts de médiane avec un résultat précédent ; renvoie les régressions."""
+    with open(reference_path, "r", encoding="utf-8") as f:
+        reference = json.load(f)
+    print(f"\n📊 Comparaison avec {os.path.basename(reference_path)} (commit {reference['environment'].get('commit')})")
+    if reference.get("parameters") != resultats["parameters"]:
+        print("⚠️ Paramètres différents : la comparaison est indicative")
+    regressions = []
+    for name, result in resultats["results"].items():
+        before = reference["results"].get(name, {}).get("median_ms")
+        after = result.get("median_ms")
+        if not before or after is None:
+            continue
+        ratio = after / before
+        marque = "🔺" if ratio > REGRESSION_THRESHOLD else ("🔻" if ratio < 1 / REGRESSION_THRESHOLD else "  ")
+        print(f"{marque} {name:<14} {before:>10.2f} ms -> {after:>10.2f} ms  (x{ratio:.2f})")
+        if ratio > REGRESSION_THRESHOLD:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--preset", choices=sorted(PRESETS), default="small")
+    parser.add_argument("--documents", type=int, help="Documents de la base de connaissances (10 à 10 000)")
+    parser.add_argument("--sections", type=int, help="Sections du projet et du document découpé (10 à 2 000)")
+    parser.add_argument("--sections-per-document", type=int, default=20)
+    parser.add_argument("--runs", type=int, help="Mesures par banc (après une exécution à blanc)")
+    parser.add_argument("--queries", type=int, default=10, help="Recherches / générations par mesure")
+    parser.add_argument("--llm", choices=("stub", "http"), default="stub",
+                        help="stub : openai_chat_completion remplacé ; http : faux serveur OpenAI local")
+    parser.add_argument("--latency", type=float, default=0.05, help="Latence du faux modèle (s)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--only", help=f"Bancs à lancer, séparés par des virgules ({','.join(BENCHMARKS)})")
+    parser.add_argument("--output", help="Fichier JSON des résultats (défaut : bench_results/<commit>-<date>.json)")
+    parser.add_argument("--compare", help="Résultats précédents à comparer ; code de sortie 1 en cas de régression")
+    args = parser.parse_args()
+
+    preset = PRESETS[args.preset]
+    args.documents = args.documents or preset["documents"]
+    args.sections = args.sections or preset["sections"]
+    args.runs = args.runs or preset["runs"]
+    selection = args.only.split(",") if args.only else list(BENCHMARKS)
+    inconnus = set(selection) - set(BENCHMARKS)
+    if inconnus:
+        parser.error(f"Bancs inconnus : {', '.join(sorted(inconnus))}")
+
+    gen = CorpusGenerator(args.seed)
+    env = environnement()
+    print(f"🏁 Banc CCTP : {args.documents} documents, {args.sections} sections, {args.runs} mesures "
+          f"(commit {env['commit']}, Python {env['python']})")
+
+    resultats = {
+        "environment": env,
+        "parameters": {key: getattr(args, key) for key in
+                       ("documents", "sections", "sections_per_document", "runs", "queries", "llm", "latency", "seed")},
+        "results": {},
+    }
+    with tempfile.TemporaryDirectory() as directory:
+        corpus = preparer_corpus(gen, args, directory)
+        print(f"   Base synthétique : {len(corpus['index'].entries)} sections en {corpus['build_ms']:.0f} ms")
+        benches = {
+            "parse": lambda: bench_parse(gen, args),
+            "retrieval": lambda: bench_retrieval(corpus, args),
+            "extract_parts": lambda: bench_extract_parts(corpus, args),
+            "export_pdf": lambda: bench_export_pdf(corpus, args),
+            "export_docx": lambda: bench_export_docx(corpus, args),
+            "generate": lambda: bench_generate(corpus, args),
+        }
+        for name in BENCHMARKS:
+            if name not in selection:
+                continue
+            result = benches[name]()
+            resultats["results"][name] = result
+            if "skipped" in result:
+                print(f"⏭️ {name:<14} ignoré : {result['skipped']}")
+            else:
+                print(f"⏱️ {name:<14} médiane {result['median_ms']:>10.2f} ms  p95 {result['p95_ms']:>10.2f} ms")
+        corpus["kb_store"].db.close()
+
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"{env['commit'] or 'local'}-{datetime.now():%Y%m%d-%H%M%S}.json")
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(resultats, f, indent=2, ensure_ascii=False)
+    print(f"💾 Résultats : {output}")
+
+    if args.compare:
+        regressions = comparer(resultats, args.compare)
+        if regressions:
+            print(f"❌ Régressions (> x{REGRESSION_THRESHOLD:.2f}) : {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+Faux serveur OpenAI (chat completions) pour tester le client sans clé ni quota
+
+Usage : python fake_openai_server.py [--port 8089] [--latency 0.2] [--rate-limit-every 0] [--error-every 0]
+Puis lancer le backend avec OPENAI_BASE_URL=http://127.0.0.1:8089/v1 OPENAI_API_KEY=test
+"""
+
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    """Répond à POST /v1/chat/completions, en JSON ou en flux SSE."""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length) or b"{}")
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": f"Route inconnue : {self.path}"}})
+            return
+
+        number = self.server.next_request()
+        if self.server.rate_limit_every and number % self.server.rate_limit_every == 0:
+            self._send_json(429, {"error": {"message": "Rate limit reached", "type": "requests"}},
+                            {"Retry-After": str(self.server.retry_after)})
+            return
+        if self.server.error_every and number % self.server.error_every == 0:
+            self._send_json(500, {"error": {"message": "Erreur simulée", "type": "server_error"}})
+            return
+
+        time.sleep(self.server.latency)
+        prompt = " ".join(str(m.get("content", "")) for m in body.get("messages", []))
+        text = self.server.reply(prompt)
+        prompt_tokens = max(1, len(prompt) // 4)
+        completion_tokens = max(1, len(text) // 4)
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+        base = {"id": f"chatcmpl-fake-{number}", "created": int(time.time()), "model": body.get("model", "fake")}
+
+        if not body.get("stream"):
+            self._send_json(200, dict(base, object="chat.completion", usage=usage, choices=[{
+                "index": 0,
+                "message": {"role": "assistant", "content": text},
+                "finish_reason": "stop",
+            }]))
+            return
+
+        # Flux SSE : un fragment par mot, puis l'usage si demandé
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        chunk = dict(base, object="chat.completion.chunk")
+        try:
+            self._stream(chunk, text, usage if (body.get("stream_options") or {}).get("include_usage") else None)
+        except (BrokenPipeError, ConnectionResetError):
+            # Le client a abandonné le flux
+            pass
+
+    def _stream(self, chunk, text, usage):
+        words = text.split(" ")
+        for i, word in enumerate(words):
+            content = word if i == len(words) - 1 else word + " "
+            payload = dict(chunk, choices=[{"index": 0, "delta": {"content": content}, "finish_reason": None}])
+            self.wfile.write(f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+            time.sleep(self.server.chunk_latency)
+        payload = dict(chunk, choices=[{"index": 0, "delta": {}, "finish_reason": "stop"}])
+        self.wfile.write(f"data: {json.dumps(payload)}\n\n".encode("utf-8"))
+        if usage is not None:
+            self.wfile.write(f"data: {json.dumps(dict(chunk, choices=[], usage=usage))}\n\n".encode("utf-8"))
+        self.wfile.write(b"data: [DONE]\n\n")
+
+
+class FakeOpenAIServer(ThreadingHTTPServer):
+    """Serveur HTTP multi-thread ; `requests` compte les appels reçus."""
+
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.0, chunk_latency=0.0, rate_limit_every=0, error_every=0,
+                 retry_after=0.1, reply=None, verbose=False):
+        super().__init__(address, FakeOpenAIHandler)
+        self.latency = latency
+        self.chunk_latency = chunk_latency
+        self.rate_limit_every = rate_limit_every
+        self.error_every = error_every
+        self.retry_after = retry_after
+        self.reply = reply or (lambda prompt: f"Texte généré pour : {prompt[:80].strip()}")
+        self.verbose = verbose
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def next_request(self):
+        with self._lock:
+            self.requests += 1
+            return self.requests
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+
+def start_fake_server(port=0, **options):
+    """Démarre le faux serveur dans un thread ; renvoie le serveur (à arrêter avec shutdown())."""
+    server = FakeOpenAIServer(("127.0.0.1", port), **options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency", type=float, default=0.2, help="Délai avant chaque réponse (s)")
+    parser.add_argument("--chunk-latency", type=float, default=0.01, help="Délai entre fragments du flux (s)")
+    parser.add_argument("--rate-limit-every", type=int, default=0, help="Répondre 429 à une requête sur N")
+    parser.add_argument("--error-every", type=int, default=0, help="Répondre 500 à une requête sur N")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="En-tête Retry-After des 429 (s)")
+    args = parser.parse_args()
+
+    server = FakeOpenAIServer(
+        ("127.0.0.1", args.port),
+        latency=args.latency,
+        chunk_latency=args.chunk_latency,
+        rate_limit_every=args.rate_limit_every,
+        error_every=args.error_every,
+        retry_after=args.retry_after,
+        verbose=True,
+    )
+    print(f"🤖 Faux serveur OpenAI sur {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
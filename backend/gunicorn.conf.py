@@ -0,0 +1,47 @@
+"""
+Configuration Gunicorn : gunicorn -c gunicorn.conf.py wsgi:application
+
+Plusieurs processus (CCTP_WORKERS) de plusieurs threads (CCTP_THREADS) ; l'application
+est chargée une fois dans le maître puis partagée en copie sur écriture.
+"""
+
+import gc
+import multiprocessing
+import os
+
+# Doit précéder le chargement de l'application (preload_app) : avec plusieurs
+# processus, le résultat des exports asynchrones passe par le disque (les exports
+# synchrones restent en mémoire) et les projets sont écrits avant chaque réponse
+# pour que les autres processus voient les modifications
+os.environ.setdefault("CCTP_EXPORT_SHARED_JOBS", "1")
+
+bind = f"{os.getenv('CCTP_HOST', '0.0.0.0')}:{os.getenv('CCTP_PORT', '5000')}"
+workers = int(os.getenv("CCTP_WORKERS", str(min(4, multiprocessing.cpu_count() * 2 + 1))))
+worker_class = "gthread"
+threads = int(os.getenv("CCTP_THREADS", "8"))
+# Les générations en flux et les exports lourds peuvent durer plusieurs minutes
+timeout = int(os.getenv("CCTP_TIMEOUT", "300"))
+graceful_timeout = 30
+keepalive = 5
+preload_app = True
+accesslog = "-"
+
+
+def when_ready(server):
+    # Les objets chargés par le maître ne seront plus touchés par le ramasse-miettes,
+    # ce qui évite de recopier leurs pages mémoire dans chaque processus
+    gc.collect()
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    import app
+    # Connexions SQLite, pool HTTP et threads propres au processus
+    app.reset_after_fork()
+    # Les quotas OpenAI sont ceux du compte : chaque processus en reçoit une part
+    count = max(1, server.cfg.workers)
+    app.openai_scheduler.set_limits(
+        max(1, app.OPENAI_RPM_LIMIT // count),
+        max(1, app.OPENAI_TPM_LIMIT // count),
+        max(1, app.OPENAI_MAX_CONCURRENCY // count),
+    )
@@ -0,0 +1,187 @@
+"""
+Extraction du texte des PDFs et découpage en sections
+
+Module sans effet de bord à l'import (ni configuration, ni serveur, ni
+cache) : les processus de l'analyse (lancés par spawn) n'importent que lui,
+et pas toute l'application.
+"""
+
+import hashlib
+import os
+import re
+
+import PyPDF2
+
+def hash_fichier(path):
+    """SHA-1 du contenu d'un fichier, lu par blocs."""
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def iter_pdf_pages(pdf_path):
+    """Produit le texte de chaque page non vide d'un PDF, une page à la fois."""
+    with open(pdf_path, "rb") as f:
+        reader = PyPDF2.PdfReader(f)
+        for page in reader.pages:
+            page_text = page.extract_text()
+            if page_text:
+                yield page_text
+
+# Titre de section numéroté : "2 DESCRIPTION GENERALE", "2.1 Convention de nomenclature", "2.1.1 Modules"
+SECTION_TITLE_PATTERN = re.compile(r'^\s*(\d+(?:\.\d+)*)\s+(.+)$')
+
+# Nombre maximal de paragraphes retenus quand le document n'a pas de titres numérotés
+MAX_FALLBACK_PARAGRAPHS = 20
+
+class IncrementalSectionParser:
+    """Découpe un texte reçu par morceaux (pages) en sections, au fil de l'eau.
+
+    Parcours unique des lignes : un titre numéroté reste « en attente » jusqu'à
+    la ligne non vide suivante. Si c'est du contenu, le titre ouvre une
+    nouvelle section ; si c'est un autre titre (sommaire, liste numérotée),
+    il est ignoré. `feed()` renvoie les sections terminées ; seules la ligne
+    et la section en cours restent en mémoire.
+
+    Tant qu'aucune section numérotée n'a été trouvée, les premiers paragraphes
+    sont conservés pour le découpage de repli (au plus
+    MAX_FALLBACK_PARAGRAPHS).
+    """
+
+    def __init__(self):
+        self.has_text = False
+        self._partial_line = ""
+        self._current_section = None
+        self._current_content = []
+        self._pending_title = None
+        self._structured = False
+        # Repli par paragraphes : paragraphes complets + morceaux du paragraphe en cours
+        self._paragraphs = []
+        self._paragraph_tail = []
+
+    def _finish_section(self, completed):
+        if self._current_section and self._current_content:
+            completed.append({
+                "titre": self._current_section,
+                "contenu": "\n".join(self._current_content).strip()
+            })
+            self._structured = True
+            self._paragraphs = self._paragraph_tail = None
+
+    def _feed_line(self, line, completed):
+        line = line.strip()
+        if not line:
+            return
+        self.has_text = True
+        
+        # Pré-filtre : un titre commence forcément par un chiffre
+        match = SECTION_TITLE_PATTERN.match(line) if line[0].isdecimal() else None
+        if match:
+            self._pending_title = match.group(2).strip()
+            return
+        
+        if self._pending_title is not None:
+            # Le titre en attente a du contenu : c'est une vraie section
+            self._finish_section(completed)
+            self._current_section = self._pending_title
+            self._current_content = []
+            self._pending_title = None
+        
+        if self._current_section:
+            self._current_content.append(line)
+
+    def _feed_paragraphs(self, chunk):
+        """Suit le découpage `text.split('\\n\\n')` sans garder tout le texte."""
+        last = self._paragraph_tail[-1][-1:] if self._paragraph_tail else ""
+        if "\n\n" not in last + chunk:
+            self._paragraph_tail.append(chunk)
+            return
+        parts = ("".join(self._paragraph_tail) + chunk).split("\n\n")
+        for part in parts[:-1]:
+            part = part.strip()
+            if part:
+                self._paragraphs.append(part)
+        self._paragraph_tail = [parts[-1]]
+        if len(self._paragraphs) >= MAX_FALLBACK_PARAGRAPHS:
+            # Le repli est entièrement déterminé : plus besoin de suivre le texte
+            del self._paragraphs[MAX_FALLBACK_PARAGRAPHS:]
+            self._paragraph_tail = None
+
+    def feed(self, chunk):
+        """Ajoute un morceau de texte et renvoie les sections terminées."""
+        completed = []
+        if not self._structured and self._paragraph_tail is not None:
+            self._feed_paragraphs(chunk)
+        lines = (self._partial_line + chunk).split("\n")
+        self._partial_line = lines.pop()
+        for line in lines:
+            self._feed_line(line, completed)
+        return completed
+
+    def close(self):
+        """Termine le texte et renvoie les dernières sections (ou le découpage de repli)."""
+        completed = []
+        self._feed_line(self._partial_line, completed)
+        self._partial_line = ""
+        # Ajouter la dernière section si elle existe
+        self._finish_section(completed)
+        if self._structured:
+            return completed
+        
+        # Si aucune section structurée n'a été trouvée, essayer l'approche par paragraphes
+        paragraphs = self._paragraphs
+        if self._paragraph_tail is not None:
+            tail = "".join(self._paragraph_tail).strip()
+            if tail:
+                paragraphs.append(tail)
+        
+        for paragraph in paragraphs[:MAX_FALLBACK_PARAGRAPHS]:
+            lines = paragraph.split('\n')
+            first_line = lines[0].strip()
+            
+            # Vérifier si la première ligne ressemble à un titre
+            if len(first_line) < 150 and len(lines) > 1:
+                completed.append({
+                    "titre": first_line,
+                    "contenu": "\n".join(lines[1:]).strip()
+                })
+            else:
+                # Utiliser les premiers mots comme titre
+                words = first_line.split()[:8]
+                title = " ".join(words)
+                if len(first_line) > len(title):
+                    title += "..."
+                
+                completed.append({
+                    "titre": title,
+                    "contenu": paragraph
+                })
+        # Un texte non vide a toujours au moins un paragraphe : pas d'autre repli
+        return completed
+
+def extraire_sections_pdf(pdf_path):
+    """Extrait le texte d'un PDF et le découpe en sections.
+
+    Les pages sont lues une à une et envoyées au découpage incrémental : le
+    texte complet du document n'est jamais construit en mémoire.
+
+    Exécutée dans un processus de travail : renvoie (nom du fichier, sections
+    ou None, message d'erreur ou None, SHA-1 du fichier) au lieu de lever
+    une exception.
+    """
+    filename = os.path.basename(pdf_path)
+    try:
+        digest = hash_fichier(pdf_path)
+        parser = IncrementalSectionParser()
+        sections = []
+        for page_text in iter_pdf_pages(pdf_path):
+            sections.extend(parser.feed(page_text + "\n"))
+        sections.extend(parser.close())
+        
+        # Document sans texte exploitable
+        if not parser.has_text:
+            return filename, None, None, digest
+        return filename, sections, None, digest
+    except Exception as e:
+        return filename, None, str(e), None
@@ -5,9 +5,47 @@ Script de test pour l'API d'analyse des PDFs
 
 import requests
 import json
+import os
 import time
+from collections.abc import MutableMapping
+from contextlib import contextmanager
 
 API_URL = "http://127.0.0.1:5000"
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+_ABSENT = object()
+
+@contextmanager
+def remplacer(cible, **valeurs):
+    """Remplace des attributs de `cible` (module app, objet) ou des clés (dict, os.environ) le temps du bloc.
+
+    Les valeurs d'origine sont remises en place à la sortie, même en cas
+    d'échec ; une clé absente au départ est retirée.
+    """
+    mapping = isinstance(cible, MutableMapping)
+    lire = (lambda nom: cible.get(nom, _ABSENT)) if mapping else (lambda nom: getattr(cible, nom))
+    ecrire = cible.__setitem__ if mapping else (lambda nom, valeur: setattr(cible, nom, valeur))
+    origines = {nom: lire(nom) for nom in valeurs}
+    try:
+        for nom, valeur in valeurs.items():
+            ecrire(nom, valeur)
+        yield cible
+    finally:
+        for nom, valeur in origines.items():
+            if valeur is _ABSENT:
+                cible.pop(nom, None)
+            else:
+                ecrire(nom, valeur)
+
+def espionner(objet, nom):
+    """Enveloppe la méthode `nom` de `objet` : renvoie la liste (remplie au fil des appels) de leurs arguments."""
+    appels = []
+    methode = getattr(objet, nom)
+    def espion(*args, **kwargs):
+        appels.append(args)
+        return methode(*args, **kwargs)
+    setattr(objet, nom, espion)
+    return appels
 
 def test_browse_directories():
     """Teste la fonction de navigation dans les dossiers"""
@@ -52,6 +90,691 @@ def test_server_status():
     except Exception as e:
         print(f"❌ Erreur lors du test: {e}")
 
+def test_parse_document_structure():
+    """Vérifie le découpage en sections contre la fixture de référence (sans serveur)"""
+    print("🧩 Test du découpage des documents en sections...")
+    from app import _parse_document_structure
+    
+    with open(os.path.join(FIXTURES_DIR, "parse_document_structure.json"), "r", encoding="utf-8") as f:
+        cases = json.load(f)
+    
+    for case in cases:
+        sections = _parse_document_structure(case["text"])
+        assert sections == case["sections"], f"Découpage différent pour le cas '{case['name']}'"
+    print(f"✅ {len(cases)} cas de référence identiques")
+
+def test_knowledge_base_db():
+    """Vérifie l'aller-retour de la base SQLite et la recherche d'exemples (sans serveur)"""
+    print("🗄️ Test de la base de connaissances SQLite...")
+    import tempfile
+    from app import KnowledgeBaseDB, ExampleRanker, _retrouver_exemples_pertinents
+    
+    kb_data = {
+        "a.pdf": [{"nom_typo": "A", "sections": [
+            {"titre": "Généralités", "contenu": "Objet du présent lot."},
+            {"titre": "Sommaire", "contenu": ""},
+        ]}],
+        "b.pdf": [{"nom_typo": "B", "sections": [
+            {"titre": "Généralités du lot façades", "contenu": "Façades vitrées et menuiseries."},
+        ]}],
+    }
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = KnowledgeBaseDB(os.path.join(tmp_dir, "kb.sqlite3"))
+        db.write(kb_data)
+        assert {f: db.read_document(f) for f in kb_data} == kb_data
+        assert "".join(db.iter_legacy_text()).startswith("\n\n--- EXTRAIT DU DOCUMENT : a.pdf ---\n\nGénéralités\n")
+        
+        index, lengths = db.search_index()
+        ranker = ExampleRanker(index, db.postings, lengths)
+        exemples = _retrouver_exemples_pertinents("generalites", db, index, ranker, "façades", "B")
+        assert [ex["source"] for ex in exemples] == ["b.pdf", "a.pdf"]
+        
+        # Mise à jour incrémentale : même résultat qu'une réécriture complète
+        updated = {
+            "b.pdf": [{"nom_typo": "B", "sections": [
+                {"titre": "Généralités du lot façades", "contenu": "Façades vitrées, menuiseries et brise-soleil."},
+            ]}],
+            "c.pdf": [{"nom_typo": "C", "sections": [{"titre": "Généralités", "contenu": "Objet du lot façades."}]}],
+        }
+        assert db.update(updated, removed=["a.pdf"])
+        full = KnowledgeBaseDB(os.path.join(tmp_dir, "full.sqlite3"))
+        full.write(updated)
+        assert sorted(db.filenames()) == ["b.pdf", "c.pdf"]
+        assert {f: db.read_document(f) for f in updated} == updated
+        resultats = []
+        for base in (db, full):
+            index, lengths = base.search_index()
+            ranker = ExampleRanker(index, base.postings, lengths)
+            resultats.append(_retrouver_exemples_pertinents("generalites", base, index, ranker, "façades", "C"))
+        assert resultats[0] == resultats[1] and len(resultats[0]) == 2
+        # Terme du seul document retiré : sa liste disparaît
+        assert db.postings(["present"]) == {}
+        full.close()
+        db.close()
+    print("✅ Base SQLite cohérente")
+
+def test_knowledge_base_store():
+    """Vérifie le cache de la base de connaissances : relecture sur changement, construction depuis le JSON (sans serveur)"""
+    print("🧠 Test du cache de la base de connaissances...")
+    import tempfile
+    from app import KnowledgeBaseDB, KnowledgeBaseStore
+    
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        store_path, json_path, text_path = (os.path.join(tmp_dir, name) for name in ("kb.sqlite3", "kb.json", "kb.txt"))
+        
+        def nouveau_store():
+            store = KnowledgeBaseStore(store_path, json_path, text_path)
+            store.ecritures = espionner(store.db, "write")
+            return store
+        
+        # Format texte legacy : relu seulement quand le fichier change
+        store = nouveau_store()
+        assert store.get() == {}
+        with open(text_path, "w", encoding="utf-8") as f:
+            f.write("Généralités\nObjet du lot.")
+        assert store.get() == "Généralités\nObjet du lot."
+        assert store.get_search()[1:] == (None, None)
+        misses = store.misses
+        store.get()
+        assert store.misses == misses
+        with open(text_path, "a", encoding="utf-8") as f:
+            f.write(" Suite.")
+        assert store.get().endswith("Suite.") and store.misses == misses + 1
+        
+        # JSON présent : la base SQLite est construite au premier accès, puis réutilisée
+        kb_data = {"a.pdf": [{"nom_typo": "A", "sections": [{"titre": "Généralités", "contenu": "Objet du lot."}]}]}
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump(kb_data, f)
+        data, index, ranker = store.get_search()
+        assert isinstance(data, KnowledgeBaseDB) and len(store.ecritures) == 1
+        assert [entry[1:] for entry in ranker.rank("Généralités")] == [["a.pdf", "Généralités"]]
+        hits = store.hits
+        store.get()
+        assert store.hits == hits + 1
+        
+        # Autre processus (nouveau store), puis JSON seulement « touché » : pas de reconstruction
+        autre = nouveau_store()
+        assert autre.get().read_document("a.pdf") == kb_data["a.pdf"] and len(autre.ecritures) == 0
+        os.utime(json_path, ns=(time.time_ns() + 10 ** 9,) * 2)
+        assert store.get().read_document("a.pdf") == kb_data["a.pdf"] and len(store.ecritures) == 1
+        
+        # Contenu du JSON modifié (mise à jour du dépôt) : reconstruction
+        kb_data["b.pdf"] = [{"nom_typo": "B", "sections": [{"titre": "Pose", "contenu": "Pose des menuiseries."}]}]
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump(kb_data, f)
+        assert autre.get().stats() == {"documents": 2, "sections": 2} and len(autre.ecritures) == 1
+        
+        # replace() n'écrit que la base : le JSON est intact et n'est pas réimporté par-dessus
+        with open(json_path, "rb") as f:
+            json_avant = f.read()
+        kb_data["b.pdf"][0]["sections"][0]["contenu"] = "Pose modifiée."
+        store.replace(kb_data)
+        with open(json_path, "rb") as f:
+            assert f.read() == json_avant
+        assert autre.get().read_document("b.pdf") == kb_data["b.pdf"] and len(autre.ecritures) == 1
+        
+        # Export explicite : le JSON reflète la base, qui n'a rien à reconstruire ensuite
+        assert store.export_json() == 2
+        with open(json_path, "r", encoding="utf-8") as f:
+            assert json.load(f) == kb_data
+        assert autre.get().read_document("b.pdf") == kb_data["b.pdf"] and len(autre.ecritures) == 1
+        store.db.close()
+        autre.db.close()
+    print("✅ Cache de la base de connaissances cohérent")
+
+def test_openai_client():
+    """Vérifie reprises, quotas et priorités du client OpenAI contre le faux serveur (sans clé)"""
+    print("🤖 Test du client OpenAI contre le faux serveur...")
+    import threading
+    from app import OpenAIClient, OpenAIScheduler, PRIORITY_BULK, PRIORITY_INTERACTIVE
+    from fake_openai_server import start_fake_server
+    
+    server = start_fake_server(latency=0.02, rate_limit_every=2, retry_after=0.05)
+    try:
+        scheduler = OpenAIScheduler(rpm=6000, tpm=1000000, max_concurrency=1)
+        client = OpenAIClient(scheduler, base_url=server.base_url, api_key="test", max_retries=5)
+        messages = [{"role": "user", "content": "Généralités"}]
+        response = client.chat("gpt-test", messages)
+        assert response.choices[0].message.content == "Texte généré pour : Généralités"
+        assert "".join(client.chat_stream("gpt-test", messages)) == "Texte généré pour : Généralités"
+        assert scheduler.stats()["retries"] >= 1
+        
+        # Une seule place : les appels interactifs passent devant les lots déjà en attente
+        server.rate_limit_every = 0
+        order = []
+        def call(priority, name):
+            client.chat("gpt-test", [{"role": "user", "content": name}], priority=priority)
+            order.append(name)
+        threads = [threading.Thread(target=call, args=(PRIORITY_BULK, f"lot{i}")) for i in range(4)]
+        for thread in threads:
+            thread.start()
+            time.sleep(0.005)
+        interactive = threading.Thread(target=call, args=(PRIORITY_INTERACTIVE, "section"))
+        interactive.start()
+        for thread in threads + [interactive]:
+            thread.join()
+        assert order.index("section") <= 1, order
+        assert scheduler.stats()["running"] == 0
+    finally:
+        server.shutdown()
+    print("✅ Client OpenAI conforme")
+
+def test_prompt_budget():
+    """Vérifie que le prompt respecte le budget de tokens et coupe les exemples aux fins de phrase (sans serveur)"""
+    print("🧮 Test du budget de tokens du prompt...")
+    import app
+    
+    model = "modele-de-test"
+    exemples = [
+        {"source": f"{i}.pdf", "section_originale": "Généralités", "texte": "Première phrase de l'exemple. Deuxième phrase plus longue de l'exemple. " * 40}
+        for i in range(3)
+    ]
+    notes_longues = "Menuiseries en aluminium à rupture de pont thermique. " * 200
+    consigne_longue = "Détailler chaque exigence. " * 400
+    with remplacer(app.PROMPT_TOKEN_BUDGETS, **{model: 900}):
+        prompt, tokens = app._construire_prompt_generation("Façades", "Généralités", "Notes", "", exemples, "", model=model)
+        prompt_notes, tokens_notes = app._construire_prompt_generation("Façades", "Généralités", notes_longues, "", [], "", model=model)
+        _, tokens_consigne = app._construire_prompt_generation("Façades", "Généralités", "Notes", "", [], consigne_longue, model=model)
+    assert model not in app.PROMPT_TOKEN_BUDGETS
+    assert tokens["total"] == app._compter_tokens(prompt, model) <= 900
+    assert tokens["exemples"][-1]["tronque"] and not tokens["depasseBudget"]
+    # Le dernier exemple retenu s'arrête sur une phrase complète
+    assert prompt.rstrip().endswith("de l'exemple.")
+    # Notes trop longues : coupées à une fin de phrase pour tenir dans le budget
+    assert tokens_notes["notesTronquees"] and tokens_notes["total"] <= 900 and not tokens_notes["depasseBudget"]
+    assert "rupture de pont thermique.\n```" in prompt_notes
+    # Instruction trop longue à elle seule : jamais coupée, mais signalée
+    assert tokens_consigne["depasseBudget"] and tokens_consigne["total"] > 900
+    assert app._couper_aux_phrases("Une phrase. Une autre phrase.", app._compter_tokens("Une phrase.", model), model) == "Une phrase."
+    
+    # Budget propre à chaque modèle, réglable par variable d'environnement
+    assert app._budget_modele("modele-de-test-1.0", 3000) == 3000
+    with remplacer(os.environ, CCTP_PROMPT_TOKEN_BUDGET_MODELE_DE_TEST_1_0="1500"):
+        assert app._budget_modele("modele-de-test-1.0", 3000) == 1500
+    assert "CCTP_PROMPT_TOKEN_BUDGET_MODELE_DE_TEST_1_0" not in os.environ
+    print(f"✅ Prompt de {tokens['total']} tokens ({tokens['tokenizer']})")
+
+def test_prompt_registry():
+    """Vérifie le prompt système mémorisé et les versions des prompts nommés (sans serveur)"""
+    print("📜 Test du registre des prompts...")
+    import tempfile
+    import app
+    
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        system_path, registry_path = os.path.join(tmp_dir, "system_prompt.txt"), os.path.join(tmp_dir, "prompts.json")
+        registry = app.PromptRegistry(system_path, registry_path, "Prompt par défaut")
+        assert registry.system_prompt() == "Prompt par défaut"
+        registry.save_system_prompt("  Prompt personnalisé\n")
+        assert registry.system_prompt() == "Prompt personnalisé"
+        
+        assert registry.save("localisation", "Version 1", name="Localisation") == 1
+        assert registry.save("localisation", " Version 2 ") == 2
+        assert registry.get("localisation") == ("Version 2", 2)
+        assert registry.get("localisation", 1) == ("Version 1", 1)
+        assert registry.get() == registry.get(app.PromptRegistry.SYSTEM_ID) == ("Prompt personnalisé", None)
+        for prompt_id, version in (("localisation", 3), ("absent", None)):
+            try:
+                registry.get(prompt_id, version)
+                assert False, "KeyError attendue"
+            except KeyError:
+                pass
+        described, = registry.describe()
+        assert (described["name"], described["latest_version"]) == ("Localisation", 2)
+        assert [v["version"] for v in described["versions"]] == [1, 2]
+        
+        # Un autre processus relit les fichiers ; sans changement sur disque, rien n'est relu
+        autre = app.PromptRegistry(system_path, registry_path, "Prompt par défaut")
+        assert autre.get("localisation", 2) == ("Version 2", 2)
+        with remplacer(app, PROMPT_RELOAD_INTERVAL=0):
+            lectures = espionner(autre, "_read_registry")
+            autre.get("localisation")
+            assert not lectures
+            registry.save("localisation", "Version 3")
+            with open(system_path, "w", encoding="utf-8") as f:
+                f.write("Prompt modifié à la main, plus long")
+            assert autre.get("localisation") == ("Version 3", 3) and len(lectures) == 1
+            assert autre.system_prompt() == "Prompt modifié à la main, plus long"
+        
+        # Route : la version renvoyée est celle qui a été résolue, même sans ?version=
+        with remplacer(app, prompt_registry=registry):
+            client = app.app.test_client()
+            assert client.get("/api/prompts/localisation").get_json() == {"id": "localisation", "version": 3, "prompt": "Version 3"}
+            assert client.get("/api/prompts/localisation?version=1").get_json()["version"] == 1
+            
+            registry.delete("localisation")
+            assert registry.describe() == []
+            
+            # Prompt sans aucune version (fichier modifié à la main) : introuvable, pas d'erreur serveur
+            with open(registry_path, "w", encoding="utf-8") as f:
+                json.dump({"vide": {"name": "Vide", "versions": []}}, f)
+            with remplacer(app, PROMPT_RELOAD_INTERVAL=0):
+                assert client.get("/api/prompts/vide").status_code == 404
+                assert [entry["id"] for entry in registry.describe()] == ["vide"]
+    print("✅ Registre des prompts conforme")
+
+def test_generation_cache():
+    """Vérifie les clés, l'éviction LRU, la persistance et le contournement (force) du cache des générations (sans serveur)"""
+    print("💾 Test du cache des générations...")
+    import tempfile
+    from types import SimpleNamespace
+    import app
+    
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "generations.sqlite3")
+        cache = app.GenerationCache(path, 50)
+        key = app.GenerationCache.make_key
+        assert key("m", 0.3, "p") == key("m", 0.3, "p")
+        assert len({key("m", 0.3, "p"), key("m", 0.4, "p"), key("n", 0.3, "p"), key("m", 0.3, "q")}) == 4
+        
+        # Entrées de 20 octets (texte + prompt) pour 50 octets : la moins récemment lue part
+        for name in ("a", "b"):
+            cache.put(name, "m", "prompt-" + name * 3, "texte-" + name * 4)
+            time.sleep(0.01)
+        assert cache.get("a") == "texte-aaaa"
+        time.sleep(0.01)
+        cache.put("c", "m", "prompt-ccc", "texte-cccc")
+        assert cache.get("b") is None and cache.get("c") == "texte-cccc"
+        stats = cache.stats()
+        assert (stats["entries"], stats["bytes_stored"], stats["hits"], stats["misses"]) == (2, 40, 2, 1)
+        
+        # Persistance : un nouveau processus relit les entrées
+        cache.close()
+        cache = app.GenerationCache(path, 50)
+        assert cache.get("a") == "texte-aaaa"
+        cache.close()
+        
+        # _generer_texte : le modèle n'est rappelé qu'avec force, et le cache prend le nouveau texte
+        appels = []
+        def faux_modele(model, messages, temperature=0.3, priority=app.PRIORITY_INTERACTIVE):
+            appels.append(model)
+            return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=f"Texte {len(appels)}."))])
+        force_cache = app.GenerationCache(os.path.join(tmp_dir, "force.sqlite3"), 1024 * 1024)
+        with remplacer(app, generation_cache=force_cache, openai_chat_completion=faux_modele):
+            assert app._generer_texte("Prompt", "gpt-test") == "Texte 1."
+            assert app._generer_texte("Prompt", "gpt-test") == "Texte 1." and len(appels) == 1
+            assert app._generer_texte("Prompt", "gpt-test", force=True) == "Texte 2." and len(appels) == 2
+            assert app._generer_texte("Prompt", "gpt-test") == "Texte 2." and len(appels) == 2
+        force_cache.close()
+    print("✅ Cache des générations conforme")
+
+def test_batch_generation():
+    """Vérifie le flux NDJSON de /api/generate/batch et la validation des sections (sans serveur ni clé)"""
+    print("📚 Test de la génération par lot...")
+    import tempfile
+    from types import SimpleNamespace
+    import app
+    
+    def faux_modele(model, messages, temperature=0.3, priority=app.PRIORITY_INTERACTIVE):
+        prompt = messages[0]["content"]
+        if "Section en échec" in prompt:
+            raise RuntimeError("modèle indisponible")
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content="Texte généré."))])
+    
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        kb_store = app.KnowledgeBaseStore(*(os.path.join(tmp_dir, name) for name in ("kb.sqlite3", "kb.json", "kb.txt")))
+        generation_cache = app.GenerationCache(os.path.join(tmp_dir, "generations.sqlite3"), 1024 * 1024)
+        with remplacer(app, kb_store=kb_store, generation_cache=generation_cache, openai_chat_completion=faux_modele), \
+                remplacer(app.openai, api_key="test"):
+            client = app.app.test_client()
+            
+            # Éléments qui ne sont pas des objets : refus de toute la demande
+            response = client.post("/api/generate/batch", json={"nomTypo": "T", "sections": [{"titreSection": "A"}, "B", None]})
+            assert response.status_code == 400 and "[1, 2]" in response.get_json()["error"]
+            
+            sections = [
+                {"titreSection": "Généralités"}, {"notes": "sans titre"}, {"titreSection": "Section en échec"}, {"titreSection": "Pose"},
+                {"titreSection": "Variante", "promptId": "absent"}, {"titreSection": "Contexte invalide", "contexteSummarized": 5},
+            ]
+            response = client.post("/api/generate/batch", json={"nomTypo": "T", "sections": sections})
+            assert response.status_code == 200 and response.mimetype == "application/x-ndjson"
+            lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+            assert lines[-1] == {"done": True, "completed": 2, "total": 6}
+            results = {line["index"]: line for line in lines[:-1]}
+            assert sorted(results) == [0, 1, 2, 3, 4, 5]
+            assert results[0]["text"] == results[3]["text"] == "Texte généré."
+            assert "titreSection" in results[1]["error"]
+            assert "modèle indisponible" in results[2]["error"]
+            # Chaque section en erreur a sa propre ligne : prompt inconnu, puis erreur inattendue
+            assert results[4]["error"] == "Prompt introuvable : absent"
+            assert results[5]["titreSection"] == "Contexte invalide" and "préparation" in results[5]["error"]
+    print("✅ Génération par lot conforme")
+
+def test_streaming_output_cleaner():
+    """Vérifie que le nettoyage en flux donne le même texte que clean_ai_output, quel que soit le découpage (sans serveur)"""
+    print("🌊 Test du nettoyage en flux...")
+    import random
+    import app
+    
+    textes = [
+        "## Généralités\n\n**OBJET**\nLe présent lot concerne les façades.  \n---\nMISE EN ŒUVRE\n  Pose des menuiseries.\n\n",
+        "  # Titre\nPremière ligne\n#hashtag conservé\n***\nDERNIÈRE LIGNE EN MAJUSCULES MAIS DE PLUS DE QUATRE-VINGTS CARACTÈRES POUR ÊTRE GARDÉE\n",
+        "Texte sans retour à la ligne",
+        "\n\n---\n",
+    ]
+    rng = random.Random(0)
+    for texte in textes:
+        attendu = app.clean_ai_output(texte.strip())
+        decoupages = [[texte[:i], texte[i:]] for i in range(len(texte) + 1)]
+        for _ in range(50):
+            coupes = sorted(rng.sample(range(len(texte) + 1), min(len(texte) + 1, 6)))
+            decoupages.append([texte[a:b] for a, b in zip([0] + coupes, coupes + [len(texte)])])
+        decoupages.append(list(texte))
+        for fragments in decoupages:
+            cleaner = app.StreamingOutputCleaner()
+            obtenu = "".join(cleaner.feed(fragment) for fragment in fragments) + cleaner.finish()
+            assert obtenu == attendu, (fragments, obtenu, attendu)
+    
+    # Échec de préparation : même réponse JSON 500 que la route sans flux
+    def echec(nom_typo, section_data):
+        raise RuntimeError("base illisible")
+    with remplacer(app, _preparer_generation=echec), remplacer(app.openai, api_key="test"):
+        for route in ("/api/generate", "/api/generate/stream"):
+            response = app.app.test_client().post(route, json={"nomTypo": "T", "titreSection": "Généralités"})
+            assert response.status_code == 500 and "base illisible" in response.get_json()["error"]
+    print(f"✅ Nettoyage en flux identique sur {len(textes)} textes")
+
+def test_extract_parts_for_export():
+    """Vérifie le découpage des textes pour l'export, références croisées comprises (sans serveur)"""
+    print("✂️ Test du découpage des textes pour l'export...")
+    import random
+    import app
+    
+    project = [{"nomTypologie": "Façades", "sections": [{"titre": "Généralités"}, {"titre": "Pose"}]}]
+    chapter_index = app.build_chapter_index(app.compute_chapter_map(project))
+    texte = (
+        "<p>Le lot comprend les façades [À PRÉCISER : type de vitrage].</p>\n"
+        "Voir {{REF:Façades|Pose}} et {{REF:Lot absent|Section}} (voir exemple CCTP a.pdf -> Généralités) "
+        "[À PRÉCISER : type de vitrage] &lt;fin&gt;   {{REF:Façades|Pose}}"
+    )
+    main, placeholders, exemples, crossrefs = app.extract_parts_for_export(texte, chapter_index)
+    assert main == "Le lot comprend les façades . Voir et <fin>"
+    assert placeholders == ["[À PRÉCISER : type de vitrage]"]
+    assert exemples == ["(voir exemple CCTP a.pdf -> Généralités)"]
+    # Les références sont résolues avec le numéro de chapitre (liste du frontend ou index)
+    assert crossrefs == ["(voir section 1.2 Pose)", "(référence introuvable: Lot absent|Section)"]
+    assert app.extract_parts_for_export(texte, app.compute_chapter_map(project))[3] == crossrefs
+    assert app.extract_parts_for_export(texte, chapter_index, include_ai_notes=False) == (main, [], [], crossrefs)
+    assert app._render_cross_references_for_export("Voir {{REF:Façades|Généralités}}.", chapter_index) == "Voir (voir section 1.1 Généralités)."
+    assert app.extract_parts_for_export("", chapter_index) == ("", [], [], [])
+    
+    # Même résultat que l'ancien enchaînement de findall/sub (références lues dans les bons groupes)
+    def reference(text, include_ai_notes):
+        text = app._clean_text_for_export(text)
+        parts = []
+        for pattern in (app.PLACEHOLDER_PATTERN, app.REFERENCE_PATTERN):
+            found = []
+            for match in pattern.findall(text):
+                if include_ai_notes and match not in found:
+                    found.append(match)
+            parts.append(found)
+            text = pattern.sub('', text)
+        crossrefs = []
+        def crossref(match):
+            number = chapter_index.get((match.group(2), match.group(3)))
+            ref = f"(voir section {number} {match.group(3)})" if number else f"(référence introuvable: {match.group(2)}|{match.group(3)})"
+            if ref not in crossrefs:
+                crossrefs.append(ref)
+            return ''
+        text = app.CROSS_REF_PATTERN.sub(crossref, text)
+        return (" ".join(text.split()), *parts, crossrefs)
+    
+    morceaux = [
+        "[À PRÉCISER : x]", "[À VALIDER : EI60]", "(voir exemple CCTP a.pdf -> Pose)", "(voir exemple CCTP b.pdf)",
+        "{{REF:Façades|Pose}}", "{{REF:X|Y}}", "texte", " ", "\n", "<b>", "</b>", "[", "]", "(", ")", "{{REF:", "|", "}}", "&lt;",
+    ]
+    rng = random.Random(0)
+    for _ in range(2000):
+        texte = "".join(rng.choice(morceaux) for _ in range(rng.randint(1, 12)))
+        for include_ai_notes in (True, False):
+            assert app.extract_parts_for_export(texte, chapter_index, include_ai_notes) == reference(texte, include_ai_notes), texte
+    print("✅ Découpage pour l'export conforme")
+
+def test_export_render_cache():
+    """Vérifie la réutilisation et l'invalidation du cache des rendus d'export (sans serveur)"""
+    print("🗂️ Test du cache des rendus d'export...")
+    import io
+    import PyPDF2
+    import app
+    
+    project = [{"nomTypologie": f"T{t}", "sections": [{"titre": "Généralités"}, {"titre": "Mise en œuvre"}]} for t in range(2)]
+    previews = {f"T{t}": {"Généralités": f"Texte {t} [À PRÉCISER : vitrage]", "Mise en œuvre": "Pose."} for t in range(2)}
+    chapter_index = app.build_chapter_index(app.compute_chapter_map(project))
+    cache = app.ExportRenderCache(8 * 1024 * 1024)
+    with remplacer(app, export_render_cache=cache):
+        first = io.BytesIO()
+        app._render_pdf(first, project, previews, chapter_index, True)
+        assert cache.stats() == dict(cache.stats(), hits=0, misses=2, entries=2)
+        reader = PyPDF2.PdfReader(io.BytesIO(first.getvalue()))
+        pages = [page.extract_text() for page in reader.pages]
+        # Une typologie par page, numérotées après l'assemblage
+        assert len(pages) == 2 and "1. T0" in pages[0] and "2. T1" in pages[1]
+        assert "Page 1/2" in pages[0] and "Page 2/2" in pages[1]
+        
+        # Une section modifiée : seule sa typologie est rendue à nouveau
+        previews["T1"]["Mise en œuvre"] = "Pose modifiée."
+        second = io.BytesIO()
+        app._render_pdf(second, project, previews, chapter_index, True)
+        assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 3
+        assert "Pose modifiée." in PyPDF2.PdfReader(io.BytesIO(second.getvalue())).pages[1].extract_text()
+        
+        if app.DOCX_AVAILABLE:
+            app._render_docx(io.BytesIO(), project, previews, chapter_index, True)
+            hits = cache.stats()["hits"]
+            previews["T1"]["Mise en œuvre"] = "Pose modifiée deux fois."
+            app._render_docx(io.BytesIO(), project, previews, chapter_index, True)
+            # Seule la typologie modifiée est rendue à nouveau
+            assert cache.stats()["hits"] == hits + 1
+    print("✅ Cache des rendus cohérent")
+
+def test_export_jobs():
+    """Vérifie le cycle de vie des tâches d'export et l'écriture sur disque des gros résultats (sans serveur)"""
+    print("📦 Test de la file des exports...")
+    import tempfile
+    import app
+    
+    payload = {
+        "format": "pdf",
+        "project": [{"nomTypologie": "T", "sections": [{"titre": "Généralités"}]}],
+        "previews": {"T": {"Généralités": "Texte de la section."}},
+        "includeAiNotes": True,
+    }
+    client = app.app.test_client()
+    queues = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        try:
+            # Petit export gardé en mémoire, export au-delà du seuil ou partagé entre processus écrit sur disque
+            for name, memory_max_bytes, shared, storage in (
+                ("memoire", 64 * 1024 * 1024, False, "memory"),
+                ("seuil", 0, False, "disk"),
+                ("partage", 64 * 1024 * 1024, True, "disk"),
+            ):
+                queue = app.ExportJobQueue(os.path.join(tmp_dir, name), 1, 60, memory_max_bytes, shared)
+                queues.append(queue)
+                with remplacer(app, export_jobs=queue):
+                    response = client.post("/api/export/jobs", json=payload)
+                    assert response.status_code == 202
+                    job_id = response.get_json()["jobId"]
+                    queue.wait(job_id)
+                    status = client.get(f"/api/export/jobs/{job_id}").get_json()
+                    assert status["status"] == "done" and status["storage"] == storage, status
+                    assert os.path.exists(os.path.join(tmp_dir, name, f"{job_id}.pdf")) == (storage == "disk")
+                    
+                    download = client.get(status["downloadUrl"])
+                    assert download.status_code == 200 and download.data.startswith(b"%PDF")
+                    download.close()
+                    assert client.delete(f"/api/export/jobs/{job_id}").status_code == 200
+                    assert client.get(f"/api/export/jobs/{job_id}").status_code == 404
+                    assert not os.listdir(os.path.join(tmp_dir, name))
+            
+            # Route synchrone de compatibilité : le fichier revient dans la même requête,
+            # en mémoire même si les tâches sont partagées, et n'est pas conservé
+            with remplacer(app, export_jobs=queues[-1]):
+                response = client.post("/api/export/pdf", json=payload)
+                assert response.status_code == 200 and response.data.startswith(b"%PDF")
+                response.close()
+                assert not os.listdir(os.path.join(tmp_dir, "partage"))
+                assert client.post("/api/export/jobs", json=dict(payload, format="odt")).status_code == 400
+        finally:
+            for queue in queues:
+                queue._executor.shutdown()
+    print("✅ File des exports conforme")
+
+def test_section_library():
+    """Vérifie les compteurs de titres par modèle et la relecture limitée aux modèles modifiés (sans serveur)"""
+    print("📖 Test de la bibliothèque de sections...")
+    import tempfile
+    from collections import Counter
+    import app
+    
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        models_dir = os.path.join(tmp_dir, "modeles")
+        os.makedirs(models_dir)
+        library_path, index_path = os.path.join(tmp_dir, "bibliotheque.json"), os.path.join(tmp_dir, "index.json")
+        
+        def ecrire_modele(name, titres):
+            project = [{"nomTypologie": "Lot", "sections": [{"titre": titre} for titre in titres]}]
+            with open(os.path.join(models_dir, f"{name}.json"), "w", encoding="utf-8") as f:
+                json.dump(project, f)
+            return app.SectionLibrary.count_titles(project)
+        
+        def bibliotheque():
+            library = app.SectionLibrary(models_dir, library_path, index_path)
+            # Arguments de chaque lecture de modèle : [(nom,), ...]
+            library.lectures = espionner(library, "_read_model")
+            return library
+        
+        ecrire_modele("m1", ["Généralités", "Pose", " "])
+        ecrire_modele("m2", ["Pose", "Essais"])
+        library = bibliotheque()
+        assert library.titles() == ["Essais", "Généralités", "Pose"]
+        assert sorted(library.lectures) == [("m1",), ("m2",)]
+        
+        # Un titre encore utilisé par un autre modèle reste ; la bibliothèque n'est pas réécrite
+        mtime = os.stat(library_path).st_mtime_ns
+        library.update_model("m1", ecrire_modele("m1", ["Généralités"]))
+        assert library.titles() == ["Essais", "Généralités", "Pose"]
+        assert os.stat(library_path).st_mtime_ns == mtime
+        library.update_model("m2", ecrire_modele("m2", ["Essais", "Essais"]))
+        with open(library_path, "r", encoding="utf-8") as f:
+            assert json.load(f) == library.titles() == ["Essais", "Généralités"]
+        
+        # Modèle supprimé : ses titres disparaissent
+        os.remove(os.path.join(models_dir, "m1.json"))
+        library.update_model("m1", Counter())
+        assert library.titles() == ["Essais"]
+        
+        # Autre processus : l'index évite de relire les modèles inchangés
+        autre = bibliotheque()
+        assert autre.titles() == ["Essais"] and autre.lectures == []
+        
+        # Modèles ajoutés ou modifiés hors de l'application : seuls ceux-là sont relus au démarrage
+        time.sleep(0.01)
+        ecrire_modele("m3", ["Réception"])
+        ecrire_modele("m2", ["Essais", "Nettoyage"])
+        demarrage = bibliotheque()
+        assert demarrage.titles() == ["Essais", "Nettoyage", "Réception"]
+        assert sorted(demarrage.lectures) == [("m2",), ("m3",)]
+        # ... et les autres processus relisent l'index réécrit, sans relire les modèles
+        assert library.titles() == autre.titles() == ["Essais", "Nettoyage", "Réception"]
+        assert sorted(library.lectures) == [("m1",), ("m2",)] and autre.lectures == []
+        assert library.rebuild() == 3
+    print("✅ Bibliothèque de sections conforme")
+
+def test_project_store():
+    """Vérifie les opérations JSON-Patch, leur annulation, les conflits de version et l'écriture différée (sans serveur)"""
+    print("📝 Test du stockage des projets...")
+    import tempfile
+    import app
+    
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        models_dir, previews_dir = os.path.join(tmp_dir, "modeles"), os.path.join(tmp_dir, "previews")
+        os.makedirs(models_dir)
+        os.makedirs(previews_dir)
+        library = app.SectionLibrary(models_dir, os.path.join(tmp_dir, "lib.json"), os.path.join(tmp_dir, "index.json"))
+        store = app.ProjectStore(models_dir, previews_dir, delay=60)
+        with remplacer(app, section_library=library):
+            version = store.replace("m", [{"nomTypologie": "Lot 1", "sections": [{"titre": "Généralités"}]}], {})
+            assert store.get("absent") is None
+            
+            version = store.apply("m", [
+                {"op": "add", "path": "/project/0/sections/-", "value": {"titre": "Mise en œuvre"}},
+                {"op": "add", "path": "/previews/Lot 1", "value": {"Généralités": "Texte"}},
+                {"op": "replace", "path": "/previews/Lot 1/Généralités", "value": "Texte ~ a/b"},
+            ], version)
+            project, previews, current = store.get("m")
+            assert current == version
+            assert [s["titre"] for s in project[0]["sections"]] == ["Généralités", "Mise en œuvre"]
+            
+            # Les données renvoyées sont des copies : les modifier ne touche pas le projet
+            project[0]["sections"].clear()
+            assert len(store.get("m")[0][0]["sections"]) == 2
+            
+            # Une opération invalide annule tout le lot
+            try:
+                store.apply("m", [
+                    {"op": "remove", "path": "/project/0/sections/1"},
+                    {"op": "replace", "path": "/previews/Lot 1/Absent", "value": "x"},
+                ])
+                assert False, "ProjectPatchError attendue"
+            except app.ProjectPatchError:
+                pass
+            assert store.get("m")[2] == version
+            assert len(store.get("m")[0][0]["sections"]) == 2
+            
+            # Version périmée refusée ; la version est une empreinte du contenu
+            try:
+                store.apply("m", [{"op": "remove", "path": "/previews/Lot 1"}], "perimee")
+                assert False, "ProjectVersionConflict attendue"
+            except app.ProjectVersionConflict as e:
+                assert e.version == version
+            
+            # Écriture différée : rien sur disque avant flush, puis relecture identique
+            assert store.pending() == ["m"]
+            store.flush()
+            assert store.pending() == []
+            reread = app.ProjectStore(models_dir, previews_dir, delay=60).get("m")
+            assert reread == store.get("m")
+            assert "Mise en œuvre" in app.section_library.titles()
+            
+            # Mode partagé (plusieurs processus) : chaque modification est écrite avant la réponse,
+            # l'autre processus la voit aussitôt et peut enchaîner sur la même version
+            lock_path = os.path.join(tmp_dir, "projects.lock")
+            worker_a, worker_b = (app.ProjectStore(models_dir, previews_dir, 60, lock_path) for _ in range(2))
+            version = worker_b.get("m")[2]
+            version = worker_a.apply("m", [{"op": "replace", "path": "/previews/Lot 1/Généralités", "value": "Texte A"}], version)
+            assert worker_a.pending() == [] and worker_b.get("m")[1]["Lot 1"]["Généralités"] == "Texte A"
+            version = worker_b.apply("m", [{"op": "add", "path": "/project/0/sections/-", "value": {"titre": "Réception"}}], version)
+            assert worker_a.get("m")[2] == version and "Réception" in app.section_library.titles()
+    print("✅ Stockage des projets cohérent")
+
+def test_metrics():
+    """Vérifie les histogrammes, le format Prometheus et l'addition des valeurs des autres processus (sans serveur)"""
+    print("📈 Test des métriques...")
+    import tempfile
+    from app import Metrics, app
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        metrics = Metrics(tmp, publish_interval=3600)
+        metrics.describe("cctp_test_total", "counter", "Test.")
+        metrics.inc("cctp_test_total", model="gpt")
+        metrics.inc("cctp_test_total", 2, model="gpt")
+        with metrics.span("etape"):
+            time.sleep(0.002)
+        # Valeurs publiées par un autre processus encore en vie (le parent)
+        with open(os.path.join(tmp, f"{os.getppid()}.json"), "w", encoding="utf-8") as f:
+            json.dump({"counters": [["cctp_test_total", [["model", "gpt"]], 4]], "histograms": []}, f)
+        text = metrics.render()
+        assert "# TYPE cctp_test_total counter" in text
+        assert 'cctp_test_total{model="gpt"} 7' in text
+        assert 'cctp_stage_duration_seconds_bucket{stage="etape",le="+Inf"} 1' in text
+        assert 'cctp_stage_duration_seconds_bucket{stage="etape",le="0.001"} 0' in text
+    
+    response = app.test_client().get("/api/status")
+    assert response.status_code == 200
+    text = app.test_client().get("/metrics").get_data(as_text=True)
+    assert 'route="/api/status"' in text, text
+    print("✅ Métriques conformes")
+
 if __name__ == "__main__":
     print("🚀 Démarrage des tests de l'API CCTP")
     print("=" * 50)
@@ -59,6 +782,36 @@ if __name__ == "__main__":
     test_server_status()
     print()
     test_browse_directories()
+    print()
+    test_parse_document_structure()
+    print()
+    test_knowledge_base_db()
+    print()
+    test_knowledge_base_store()
+    print()
+    test_openai_client()
+    print()
+    test_prompt_budget()
+    print()
+    test_prompt_registry()
+    print()
+    test_generation_cache()
+    print()
+    test_batch_generation()
+    print()
+    test_streaming_output_cleaner()
+    print()
+    test_extract_parts_for_export()
+    print()
+    test_export_render_cache()
+    print()
+    test_export_jobs()
+    print()
+    test_section_library()
+    print()
+    test_project_store()
+    print()
+    test_metrics()
     
     print("\n" + "=" * 50)
     print("✅ Tests terminés !")
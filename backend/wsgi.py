@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+"""
+Point d'entrée WSGI pour la production
+
+Linux/macOS : gunicorn -c gunicorn.conf.py wsgi:application
+Windows     : python wsgi.py   (Waitress, plusieurs threads dans un seul processus)
+"""
+
+import os
+
+from app import app, warm_up
+
+# Chargé une seule fois dans le processus maître (preload_app) : les processus
+# créés ensuite partagent ces données en copie sur écriture
+_timings = warm_up()
+print("🔥 Préchargement terminé : " + ", ".join(f"{k} {v} ms" for k, v in _timings.items()))
+
+application = app
+
+
+if __name__ == "__main__":
+    try:
+        from waitress import serve
+    except ImportError:
+        raise SystemExit("Waitress n'est pas installé : pip install waitress (ou utilisez gunicorn)")
+    serve(
+        application,
+        host=os.getenv("CCTP_HOST", "0.0.0.0"),
+        port=int(os.getenv("CCTP_PORT", "5000")),
+        threads=int(os.getenv("CCTP_THREADS", "8")),
+    )